@@ -0,0 +1,203 @@
+import bisect
+import hashlib
+import random
+
+
+class FeistelPermutation:
+    # Pseudo random bijection of range(size): a balanced Feistel network over the
+    # smallest even number of bits covering size, with cycle walking to bring the
+    # values that fall outside of the range back into it
+    def __init__(self, size, key, num_rounds=4):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.num_bytes = (self.half_bits + 7) // 8
+        self.key = key.to_bytes(8, "little")
+        self.num_rounds = num_rounds
+
+    def _round(self, i, value):
+        digest = hashlib.blake2b(
+            bytes([i]) + value.to_bytes(self.num_bytes, "little"),
+            digest_size=min(64, self.num_bytes),
+            key=self.key,
+        ).digest()
+        return int.from_bytes(digest, "little") & self.mask
+
+    def _encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for i in range(self.num_rounds):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self.half_bits) | right
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if index < 0 or index >= self.size:
+            raise IndexError(f"Index {index} out of range")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+
+class RelationAssignmentSampler:
+    # Counts, for every (class, subtree shape), how many schema valid relation and
+    # class assignments the subtree has, and samples relations proportionally to
+    # those counts. Given the class of a node this draws uniformly among the valid
+    # assignments of its subtree, so a sampled assignment never hits a dead end.
+    #
+    # A shape is the sorted tuple of the branches of a node, a branch being
+    # (direction, shape id of the child) with direction 0 for an in relation and 1
+    # for an out relation. Shapes are interned to ids so they can be shared by all
+    # the patterns.
+    def __init__(self, relation_index, relations_info, classes):
+        self.relation_index = relation_index
+        self.relations_info = relations_info
+        self.classes = classes
+        self.shape_ids = {}
+        self.shapes = []
+        self.counts = {}
+        self.branches = {}
+        self.valid_classes = {}
+        self.node_shapes = []
+        self.relation_weights = None
+
+    def set_relation_weights(self, relation_weights):
+        # Every assignment is weighted by the product of the weights of its
+        # relations, the memoized counts depend on them so they are dropped
+        self.relation_weights = relation_weights
+        self.counts = {}
+        self.branches = {}
+        self.valid_classes = {}
+
+    def _get_relation_weight(self, relation):
+        if self.relation_weights is None:
+            return 1
+        return self.relation_weights.get(relation, 0)
+
+    def _intern_shape(self, shape):
+        if shape not in self.shape_ids:
+            self.shape_ids[shape] = len(self.shapes)
+            self.shapes.append(shape)
+        return self.shape_ids[shape]
+
+    def _get_subtree_shape(self, node, relation=None):
+        branches = []
+        for rel in node.in_relations:
+            if rel is not relation:
+                branches.append((0, self._get_subtree_shape(rel.in_node, rel)))
+        for rel in node.out_relations:
+            if rel is not relation:
+                branches.append((1, self._get_subtree_shape(rel.out_node, rel)))
+        shape_id = self._intern_shape(tuple(sorted(branches)))
+        self.node_shapes[node.id] = shape_id
+        return shape_id
+
+    def set_graph(self, graph):
+        self.node_shapes = [None for _ in graph.nodes]
+        return self._get_subtree_shape(graph.answer_node)
+
+    def _get_branch(self, class_type, direction, shape_id):
+        key = (class_type, direction, shape_id)
+        if key not in self.branches:
+            if direction == 0:
+                candidates = self.relation_index.get_range_relations(class_type)
+                target_field = "domain"
+            else:
+                candidates = self.relation_index.get_domain_relations(class_type)
+                target_field = "range"
+            relations = []
+            cum_weights = []
+            total = 0
+            for relation in candidates:
+                target_class = self.relations_info[relation][target_field]
+                weight = self._get_relation_weight(relation) * self.count(
+                    target_class, shape_id
+                )
+                if weight > 0:
+                    total += weight
+                    relations.append(relation)
+                    cum_weights.append(total)
+            self.branches[key] = (relations, cum_weights, total)
+        return self.branches[key]
+
+    def count(self, class_type, shape_id):
+        key = (class_type, shape_id)
+        if key not in self.counts:
+            total = 1
+            for direction, child_shape_id in self.shapes[shape_id]:
+                total *= self._get_branch(class_type, direction, child_shape_id)[2]
+                if total == 0:
+                    break
+            self.counts[key] = total
+        return self.counts[key]
+
+    def get_valid_classes(self, shape_id):
+        if shape_id not in self.valid_classes:
+            self.valid_classes[shape_id] = [
+                i for i in self.classes if self.count(i, shape_id) > 0
+            ]
+        return self.valid_classes[shape_id]
+
+    def sample_relation(self, class_type, target_node, in_rel=False):
+        relations, cum_weights, total = self._get_branch(
+            class_type, 0 if in_rel else 1, self.node_shapes[target_node.id]
+        )
+        if total == 0:
+            return None
+        return random.choices(relations, cum_weights=cum_weights)[0]
+
+    def _unrank_subtree(
+        self, node, class_type, index, node_shapes, rel_types, relation
+    ):
+        # Mixed radix decomposition of the index over the branches of the node, then
+        # within a branch the relation is found by the cumulative counts
+        for rel in node.in_relations + node.out_relations:
+            if rel is relation:
+                continue
+            in_rel = rel.out_node is node
+            target_node = rel.in_node if in_rel else rel.out_node
+            relations, cum_weights, total = self._get_branch(
+                class_type, 0 if in_rel else 1, node_shapes[target_node.id]
+            )
+            index, digit = divmod(index, total)
+            pos = bisect.bisect_right(cum_weights, digit)
+            if pos > 0:
+                digit -= cum_weights[pos - 1]
+            rel_types[rel] = relations[pos]
+            target_class = self.relations_info[relations[pos]][
+                "domain" if in_rel else "range"
+            ]
+            self._unrank_subtree(
+                target_node, target_class, digit, node_shapes, rel_types, rel
+            )
+
+    def unrank_assignment(self, graph, index, node_shapes):
+        # The index-th valid assignment of the graph, as the class of the answer node
+        # and the relation of every edge in the order of graph.relations
+        shape_id = node_shapes[graph.answer_node.id]
+        for class_type in self.get_valid_classes(shape_id):
+            count = self.count(class_type, shape_id)
+            if index < count:
+                break
+            index -= count
+        rel_types = {}
+        self._unrank_subtree(
+            graph.answer_node, class_type, index, node_shapes, rel_types, None
+        )
+        return class_type, [rel_types[rel] for rel in graph.relations]
+
+    def iter_assignments(self, graph):
+        # Every valid assignment of the graph exactly once, in a random order. The
+        # counts must be integers, so this needs a sampler without relation weights
+        shape_id = self.set_graph(graph)
+        node_shapes = self.node_shapes
+        num_assignments = sum(
+            self.count(i, shape_id) for i in self.get_valid_classes(shape_id)
+        )
+        if num_assignments == 0:
+            return
+        permutation = FeistelPermutation(num_assignments, random.getrandbits(64))
+        for i in range(num_assignments):
+            yield self.unrank_assignment(graph, permutation[i], node_shapes)
@@ -0,0 +1,77 @@
+import hashlib
+import math
+import os
+import struct
+
+BLOOM_MAGIC = b"SPOTBLOM"
+BLOOM_VERSION = 1
+# magic, version, number of bits, number of hashes, number of added keys
+BLOOM_HEADER = struct.Struct("<8sHQHQ")
+
+
+class BloomFilter:
+    # Set of strings with no false negatives and a false positive rate of about
+    # error_rate once capacity keys have been added
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.num_bits = max(
+            8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        )
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _get_positions(self, key):
+        # Double hashing, the k positions are h1 + i * h2
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        h2 |= 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        return all(
+            self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._get_positions(key)
+        )
+
+    def add(self, key):
+        if key in self:
+            return
+        for pos in self._get_positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self.count
+
+    def save(self, path):
+        # Written to a temporary file first so an interrupted run keeps the old filter
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(
+                BLOOM_HEADER.pack(
+                    BLOOM_MAGIC,
+                    BLOOM_VERSION,
+                    self.num_bits,
+                    self.num_hashes,
+                    self.count,
+                )
+            )
+            file.write(self.bits)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, num_bits, num_hashes, count = BLOOM_HEADER.unpack_from(data, 0)
+        if magic != BLOOM_MAGIC or version != BLOOM_VERSION:
+            raise ValueError(f"Not a bloom filter: {path}")
+        bloom = cls.__new__(cls)
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.count = count
+        bloom.bits = bytearray(data[BLOOM_HEADER.size :])
+        return bloom
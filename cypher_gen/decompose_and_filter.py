@@ -6,11 +6,11 @@ from query_writer import CypherQueryWriter
 from nl_provider import JsonSchemaCypherNLProvider
 from generate_batch import get_graph_string
 from grounder import CypherGraphGrounder
-from utils import build_cypher_graph
+from utils import build_cypher_graph, add_backend_arguments, configure_backend
+from resilience import BackendUnavailableError
 from collections import Counter
 from tqdm import tqdm
 import itertools
-import copy
 
 
 def is_edge_node(node):
@@ -179,6 +179,14 @@ def get_all_inside_nodes_comb(gr, node_id):
     return all_combinations
 
 
+def copy_graph_info(graph):
+    # The graph dicts only hold scalars, so a two level copy is enough
+    new_graph = dict(graph)
+    new_graph["nodes"] = [dict(node) for node in graph["nodes"]]
+    new_graph["relations"] = [dict(rel) for rel in graph["relations"]]
+    return new_graph
+
+
 def remove_nodes_from_graph(graph, nodes):
     graph["nodes"] = [i for i in graph["nodes"] if i["id"] in nodes]
     graph["relations"] = [
@@ -208,7 +216,7 @@ def get_decomposed_graphs(gr, graph):
 
     trimmed_graphs = []
     for comb in combs:
-        new_graph = copy.deepcopy(graph)
+        new_graph = copy_graph_info(graph)
         new_graph = remove_nodes_from_graph(new_graph, comb)
         new_graph = remap_nodes_numbers(new_graph)
         trimmed_graphs.append(new_graph)
@@ -231,6 +239,7 @@ def cypher_decomposition(args):
     entity_mappings = df["entity_mapping"].tolist()
 
     grounder = CypherGraphGrounder(args.json_schema)
+    configure_backend(grounder, args)
     cypher_provider = JsonSchemaCypherNLProvider(args.json_schema)
 
     samples_queries = set()
@@ -250,9 +259,9 @@ def cypher_decomposition(args):
         for d_graph in dec_graphs:
             gr = build_cypher_graph(d_graph, ent_map)
             cypher_writer = CypherQueryWriter(gr)
-            query = cypher_writer.write_query()
+            query, parameters = cypher_writer.write_parameterized_query()
             try:
-                res = grounder._execute_query(query)
+                res = grounder._execute_query(query, parameters)
                 res = extract_cypher_values(res)
                 res = [j.element_id if hasattr(j, "element_id") else j for j in res]
                 res = tuple(sorted(list((set(res)))))
@@ -260,6 +269,8 @@ def cypher_decomposition(args):
                     dec_res_map[res].append(gr)
                 else:
                     dec_res_map[res] = [gr]
+            except BackendUnavailableError as e:
+                raise e
             except:
                 continue
 
@@ -273,6 +284,9 @@ def cypher_decomposition(args):
                     samples.append(sample)
                     samples_queries.add(sample["query"])
 
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
     return samples
 
 
@@ -285,6 +299,7 @@ if __name__ == "__main__":
         "--json-schema", type=str, help="kg json schema path", required=True
     )
     parser.add_argument("--output-file", type=str, help="output file", required=True)
+    add_backend_arguments(parser)
     args = parser.parse_args()
 
     samples = cypher_decomposition(args)
@@ -1,13 +1,91 @@
 import argparse
+import asyncio
+import collections
 from pattern_generator import PatternGenerator
+from pattern_catalog import PatternCatalog
+from kg_statistics import load_statistics
+from bloom_filter import BloomFilter
+from assignment_cache import AssignmentCache
+from query_timeouts import AdaptiveTimeouts
+from resilience import BackendUnavailableError
 from grounder import CypherGraphGrounder
 from query_writer import CypherQueryWriter
 from nl_provider import JsonSchemaCypherNLProvider
+from utils import add_backend_arguments, configure_backend
 import csv
 from tqdm import tqdm
 import random
-import copy
+import itertools
 import json
+import os
+
+
+def ground_pattern(grounder, graph_orig, args):
+    groundings = []
+    external_retries = 0
+    for _ in range(args.grounding_per_pattern):
+        graph = graph_orig.clone()
+        is_grounded = False
+        while not is_grounded and external_retries < args.max_pattern_retries:
+            external_retries += 1
+            try:
+                grounded_graphs, is_grounded = grounder.ground_graph(graph)
+            except BackendUnavailableError as e:
+                raise e
+            except:
+                is_grounded = False
+
+        if is_grounded:
+            groundings.append((graph, grounded_graphs))
+    return groundings
+
+
+async def ground_pattern_async(grounder, graph_orig, args):
+    groundings = []
+    external_retries = 0
+    for _ in range(args.grounding_per_pattern):
+        graph = graph_orig.clone()
+        is_grounded = False
+        while not is_grounded and external_retries < args.max_pattern_retries:
+            external_retries += 1
+            try:
+                grounded_graphs, is_grounded = await grounder.ground_graph_async(graph)
+            except BackendUnavailableError as e:
+                raise e
+            except:
+                is_grounded = False
+
+        if is_grounded:
+            groundings.append((graph, grounded_graphs))
+    return groundings
+
+
+def iter_pattern_groundings(grounder, graphs, args):
+    # Groundings of every pattern, in the order of the patterns. In async mode up
+    # to --max-in-flight patterns are grounded concurrently on one event loop
+    if not args.async_grounding:
+        for graph_orig in graphs:
+            yield ground_pattern(grounder, graph_orig, args)
+        return
+
+    loop = asyncio.new_event_loop()
+    pending = collections.deque()
+    try:
+        for graph_orig in graphs:
+            if len(pending) >= args.max_in_flight:
+                yield loop.run_until_complete(pending.popleft())
+            pending.append(
+                loop.create_task(ground_pattern_async(grounder, graph_orig, args))
+            )
+        while pending:
+            yield loop.run_until_complete(pending.popleft())
+    finally:
+        if pending:
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(grounder.async_backend.close())
+        loop.close()
 
 
 def get_graph_string(graph):
@@ -119,6 +197,16 @@ if __name__ == "__main__":
         nargs="+",
         help="List of modifiers to remove that will not be instantiated.",
     )
+    parser.add_argument(
+        "--exhaustive-patterns",
+        action="store_true",
+        help="Enumerate every distinct pattern up to --max-nodes instead of sampling them",
+    )
+    parser.add_argument(
+        "--pattern-catalog",
+        type=str,
+        help="Pattern catalog file built with pattern_catalog.py, --resume-from then refers to catalog pattern ids",
+    )
     parser.add_argument(
         "--diverse-sampling", action="store_true", help="Sample diverse relations"
     )
@@ -127,6 +215,77 @@ if __name__ == "__main__":
         action="store_true",
         help="Sample diverse relations for parallel edges",
     )
+    parser.add_argument(
+        "--schema-aware-sampling",
+        action="store_true",
+        help="Sample only relation assignments that are valid for the schema",
+    )
+    parser.add_argument(
+        "--systematic-assignments",
+        action="store_true",
+        help="Try the valid relation assignments of each pattern in a random order without repetitions instead of sampling them",
+    )
+    parser.add_argument(
+        "--kg-statistics",
+        type=str,
+        help="Statistics file built with kg_statistics.py to weight the sampling of classes and relations by their number of instances",
+    )
+    parser.add_argument(
+        "--statistics-temperature",
+        type=float,
+        default=1.0,
+        help="Exponent applied to the instance counts, 0 samples uniformly among the classes and relations with instances",
+    )
+    parser.add_argument(
+        "--negative-cache",
+        type=str,
+        help="Filepath of the bloom filter of sub-patterns known to have no matches, loaded if it exists and saved with the samples",
+    )
+    parser.add_argument(
+        "--assignment-cache",
+        type=str,
+        help="Filepath of the fingerprints of the assignments already tried, loaded if it exists and saved with the samples",
+    )
+    parser.add_argument(
+        "--assignment-cache-size",
+        type=int,
+        default=500000,
+        help="Max number of tried assignments to remember, the least recently seen are evicted",
+    )
+    parser.add_argument(
+        "--max-query-cost",
+        type=float,
+        help="Skip the grounding queries whose cost estimated with EXPLAIN, the sum of the estimated rows of the plan operators, is above this budget",
+    )
+    parser.add_argument(
+        "--adaptive-timeouts",
+        action="store_true",
+        help="Set the timeout of the grounding queries of every pattern shape from their observed latencies",
+    )
+    parser.add_argument(
+        "--max-query-timeout",
+        type=float,
+        default=60,
+        help="Upper bound in seconds of the adaptive timeouts",
+    )
+    parser.add_argument(
+        "--grounding-sample-size",
+        type=int,
+        help="Keep a random sample of at most this many matches of every grounding query instead of all of them",
+    )
+    parser.add_argument(
+        "--grounding-sampling",
+        type=str,
+        choices=["server", "reservoir"],
+        default="server",
+        help="Draw the sample with ORDER BY rand() LIMIT in the query, or with reservoir sampling over the streamed records",
+    )
+    parser.add_argument(
+        "--grounding-batch-size",
+        type=int,
+        default=1,
+        help="Number of candidate groundings of a pattern whose grounding queries are sent to neo4j as one query, in the branches of a CALL subquery",
+    )
     parser.add_argument(
         "--save-diverse-sampling",
         type=str,
@@ -137,6 +296,18 @@ if __name__ == "__main__":
         type=str,
         help="Filepath to load the classes and relation sampled for diverse sampling",
     )
+    parser.add_argument(
+        "--async-grounding",
+        action="store_true",
+        help="Ground several patterns concurrently on the async neo4j driver",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=16,
+        help="Max number of patterns grounded at the same time with --async-grounding",
+    )
+    add_backend_arguments(parser)
     args = parser.parse_args()
 
     if args.seed:
@@ -148,15 +319,29 @@ if __name__ == "__main__":
     if args.remove_modifiers:
         pattern_generator.remove_modifiers = args.remove_modifiers
 
-    graphs = pattern_generator.generate_patterns(num_patterns, unique=True)
+    if args.pattern_catalog:
+        pattern_catalog = PatternCatalog(args.pattern_catalog)
+        graphs = pattern_catalog.iter_patterns(
+            start=args.resume_from, num_nodes=args.exact_nodes
+        )
+    else:
+        if args.exhaustive_patterns:
+            print(f"Enumerating {pattern_generator.count_patterns()} patterns")
+            graphs = pattern_generator.enumerate_patterns()
+        else:
+            # Patterns are sampled lazily while grounding, so they get their own RNG to
+            # keep the pattern sequence (and --resume-from) independent of the grounder
+            pattern_generator.rng = random.Random(args.seed)
+            graphs = pattern_generator.iter_patterns(num_patterns, unique=True)
 
-    if args.exact_nodes:
-        graphs = [i for i in graphs if len(i.nodes) == args.exact_nodes]
+        if args.exact_nodes:
+            graphs = (i for i in graphs if len(i.nodes) == args.exact_nodes)
 
-    if args.resume_from:
-        graphs = graphs[args.resume_from :]
+        if args.resume_from:
+            graphs = itertools.islice(graphs, args.resume_from, None)
 
     grounder = CypherGraphGrounder(args.json_schema)
+    configure_backend(grounder, args)
     cypher_provider = JsonSchemaCypherNLProvider(args.json_schema)
 
     if args.diverse_sampling:
@@ -171,63 +356,85 @@ if __name__ == "__main__":
 
     if args.diverse_parallel_relations:
         grounder.diverse_parallel_relations = True
+    if args.schema_aware_sampling:
+        grounder.schema_aware_sampling = True
+    if args.systematic_assignments:
+        grounder.systematic_assignments = True
+    if args.kg_statistics:
+        class_weights, relation_weights = load_statistics(
+            args.kg_statistics, args.statistics_temperature
+        )
+        grounder.set_statistics(class_weights, relation_weights)
+
+    if args.assignment_cache and os.path.exists(args.assignment_cache):
+        grounder.assignment_cache = AssignmentCache.load(
+            args.assignment_cache, args.assignment_cache_size
+        )
+    else:
+        grounder.assignment_cache = AssignmentCache(args.assignment_cache_size)
+    if args.negative_cache:
+        if os.path.exists(args.negative_cache):
+            grounder.negative_cache = BloomFilter.load(args.negative_cache)
+        else:
+            grounder.negative_cache = BloomFilter()
 
     grounder.max_iterations = args.max_grounder_iterations
+    grounder.max_query_cost = args.max_query_cost
+    grounder.sample_size = args.grounding_sample_size
+    grounder.server_side_sampling = args.grounding_sampling == "server"
+    grounder.candidates_per_query = args.grounding_batch_size
+    if args.adaptive_timeouts:
+        grounder.adaptive_timeouts = AdaptiveTimeouts(
+            max_timeout=args.max_query_timeout
+        )
+        grounder.backend.adaptive_timeouts = grounder.adaptive_timeouts
+        grounder.async_backend.adaptive_timeouts = grounder.adaptive_timeouts
 
     samples = []
 
-    for ittr, graph_orig in tqdm(enumerate(graphs), total=len(graphs)):
-        external_retries = 0
-        for _ in range(args.grounding_per_pattern):
-            graph = copy.deepcopy(graph_orig)
-            is_grounded = False
-            while not is_grounded and external_retries < args.max_pattern_retries:
-                external_retries += 1
+    for ittr, groundings in tqdm(
+        enumerate(iter_pattern_groundings(grounder, graphs, args))
+    ):
+        for graph, grounded_graphs in groundings:
+            for grounded_graph in grounded_graphs:
                 try:
-                    grounded_graphs, is_grounded = grounder.ground_graph(graph)
+                    cypher_writer = CypherQueryWriter(grounded_graph)
+                    cypher_writer.cast_modifiers = args.cast_cypher_modifiers
+                    cypher_query = cypher_writer.write_query()
+                    cypher_writer.set_nl_provider(cypher_provider)
+                    cypher_proto_nl = cypher_writer.write_proto_nl()
+
+                    entity_mapping = grounded_graph.entity_mapping
+
+                    graph_string = get_graph_string(grounded_graph)
+
+                    grounded_graph = entity_graph_anonymization(grounded_graph)
+                    cypher_writer = CypherQueryWriter(grounded_graph)
+                    cypher_writer.cast_modifiers = args.cast_cypher_modifiers
+                    cypher_query_ent_anon = cypher_writer.write_query()
+                    cypher_writer.set_nl_provider(cypher_provider)
+                    cypher_proto_nl_ent_anon = cypher_writer.write_proto_nl()
+
+                    graph.ground_anonymously()
+                    cypher_writer = CypherQueryWriter(graph)
+                    anon_cypher_query = cypher_writer.write_query()
+                    cypher_writer.set_nl_provider(cypher_provider)
+                    anon_cypher_proto_nl = cypher_writer.write_proto_nl()
+
+                    sample = {
+                        "anon_proto_nl": anon_cypher_proto_nl,
+                        "anon_query": anon_cypher_query,
+                        "proto_nl": cypher_proto_nl,
+                        "query": cypher_query,
+                        "entity_mapping": entity_mapping,
+                        "graph": graph_string,
+                        "ent_anon_proto_nl": cypher_proto_nl_ent_anon,
+                        "ent_anon_query": cypher_query_ent_anon,
+                    }
+                    samples.append(sample)
+
                 except:
-                    is_grounded = False
-
-            if is_grounded:
-                for grounded_graph in grounded_graphs:
-                    try:
-                        cypher_writer = CypherQueryWriter(grounded_graph)
-                        cypher_writer.cast_modifiers = args.cast_cypher_modifiers
-                        cypher_query = cypher_writer.write_query()
-                        cypher_writer.set_nl_provider(cypher_provider)
-                        cypher_proto_nl = cypher_writer.write_proto_nl()
-
-                        entity_mapping = grounded_graph.entity_mapping
-
-                        graph_string = get_graph_string(grounded_graph)
-
-                        grounded_graph = entity_graph_anonymization(grounded_graph)
-                        cypher_writer = CypherQueryWriter(grounded_graph)
-                        cypher_writer.cast_modifiers = args.cast_cypher_modifiers
-                        cypher_query_ent_anon = cypher_writer.write_query()
-                        cypher_writer.set_nl_provider(cypher_provider)
-                        cypher_proto_nl_ent_anon = cypher_writer.write_proto_nl()
-
-                        graph.ground_anonymously()
-                        cypher_writer = CypherQueryWriter(graph)
-                        anon_cypher_query = cypher_writer.write_query()
-                        cypher_writer.set_nl_provider(cypher_provider)
-                        anon_cypher_proto_nl = cypher_writer.write_proto_nl()
-
-                        sample = {
-                            "anon_proto_nl": anon_cypher_proto_nl,
-                            "anon_query": anon_cypher_query,
-                            "proto_nl": cypher_proto_nl,
-                            "query": cypher_query,
-                            "entity_mapping": entity_mapping,
-                            "graph": graph_string,
-                            "ent_anon_proto_nl": cypher_proto_nl_ent_anon,
-                            "ent_anon_query": cypher_query_ent_anon,
-                        }
-                        samples.append(sample)
-
-                    except:
-                        continue
+                    continue
 
         if ittr % args.saving_interval == 0 or ittr == args.num_patterns - 1:
             if len(samples) > 0:
@@ -245,4 +452,25 @@ if __name__ == "__main__":
                     with open(args.save_diverse_sampling, "w") as json_file:
                         json.dump(div_dict, json_file, indent=4)
 
+            if args.negative_cache:
+                grounder.negative_cache.save(args.negative_cache)
+            if args.assignment_cache:
+                grounder.assignment_cache.save(args.assignment_cache)
+
+    if args.assignment_cache:
+        grounder.assignment_cache.save(args.assignment_cache)
+    if args.negative_cache:
+        grounder.negative_cache.save(args.negative_cache)
+        print(f"Known empty sub-patterns: {len(grounder.negative_cache)}")
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
+    if args.max_query_cost is not None:
+        print(
+            f"Grounding queries over the cost budget: {grounder.num_rejected_queries}"
+        )
+    if grounder.adaptive_timeouts is not None:
+        print(grounder.adaptive_timeouts.report())
+    if args.backend == "neo4j":
+        print(grounder.backend.retry_policy.report())
     print(f"Total produced samples: {len(samples)}")
@@ -1,9 +1,15 @@
 import random
-import copy
 import json
-from query_writer import CypherQueryWriter
+from graph import GraphOverlay
+from query_writer import CypherQueryWriter, write_batched_grounding_query
+from relation_index import RelationIndex
+from assignment_sampler import RelationAssignmentSampler
+from assignment_cache import AssignmentCache
+from resilience import QueryError
+from reservoir import reservoir_sample
 from utils import (
     Neo4jConnection,
+    AsyncNeo4jConnection,
     CYPHER_MODIFIER_DATE_TYPES,
     CYPHER_MODIFIER_NUMBER_TYPES,
 )
@@ -19,40 +25,105 @@ class CypherGraphGrounder:
         self.relations = list(data["relations"].keys())
         self.properties = list(data["properties"].keys())
         self.properties_info = data["properties"]
+        self.relation_index = RelationIndex(
+            self.relations, self.relations_info, self.classes
+        )
         self.max_iterations = 100
 
         self.diverse_sampling = True
 
         self.diverse_parallel_relations = False
 
-        self.pattern_rel_cache = (
-            set()
-        )  # Set of patterns with instantiated rels that we have tried to ground already
-
+        # Sample relations proportionally to the number of schema valid completions
+        self.schema_aware_sampling = False
+        self.assignment_sampler = RelationAssignmentSampler(
+            self.relation_index, self.relations_info, self.classes
+        )
+
+        # Walk the valid assignments of every pattern in a random order instead of
+        # sampling them, so none is drawn twice. The counts of the walk do not use
+        # the statistics weights, so it has its own sampler
+        self.systematic_assignments = False
+        self.assignment_enumerator = RelationAssignmentSampler(
+            self.relation_index, self.relations_info, self.classes
+        )
+        self.assignment_iterators = {}
+        self.enumerated_relations = None
+
+        # Instance counts of the KG, None samples classes and relations uniformly
+        self.class_weights = None
+        self.relation_weights = None
+
+        # Fingerprints of the patterns with instantiated rels that we have tried to
+        # ground already
+        self.assignment_cache = AssignmentCache()
+
+        # Bloom filter of typed sub-patterns and queries known to have no matches
+        self.negative_cache = None
+        self.nonempty_subpatterns = set()
+
+        # Where the queries run, any object with query(query, parameters),
+        # is_healthy() and close() like Neo4jConnection, e.g. the in process
+        # PropertyGraphConnection. See utils.configure_backend
         uri = "bolt://localhost:7687"
         user = "neo4j"
         password = "neo4jneo4j"
-        self.neo4j = Neo4jConnection(uri, user, password)
-
-    def _execute_query(self, query: str):
-        results = self.neo4j.query(query)
+        self.backend = Neo4jConnection(uri, user, password)
+        self.async_backend = AsyncNeo4jConnection(uri, user, password)
+        # QueryCache shared by the neo4j connections, if any
+        self.query_cache = None
+
+        # Grounding queries the planner estimates to cost more than this are not
+        # run, see Neo4jConnection.explain. None runs all of them
+        self.max_query_cost = None
+        self.num_rejected_queries = 0
+        # AdaptiveTimeouts shared by the connections, if any
+        self.adaptive_timeouts = None
+
+        # Keep a random sample of at most sample_size matches of every grounding
+        # query instead of all of them, None keeps all. The sample is drawn by the
+        # server with ORDER BY rand() LIMIT, or if server_side_sampling is False
+        # with reservoir sampling while the records are streamed
+        self.sample_size = None
+        self.server_side_sampling = True
+
+        # Return of every node of the grounding queries only the list of values of
+        # the properties the grounding can pick, instead of the whole node
+        self.project_properties = True
+
+        # Number of candidate groundings of a pattern whose grounding queries run as
+        # one, in the branches of a CALL subquery, to save round trips to the backend
+        self.candidates_per_query = 1
+
+    def set_statistics(self, class_weights, relation_weights):
+        self.class_weights = class_weights
+        self.relation_weights = relation_weights
+        self.assignment_sampler.set_relation_weights(relation_weights)
+
+    def _get_weights(self, items, item_weights):
+        # None when no statistics are loaded or none of the items has instances, in
+        # which case the items are sampled uniformly
+        if item_weights is None:
+            return None
+        weights = [item_weights.get(i, 0) for i in items]
+        if sum(weights) == 0:
+            return None
+        return weights
+
+    def _sample_class(self, classes):
+        weights = self._get_weights(classes, self.class_weights)
+        if weights is None:
+            return random.choice(classes)
+        return random.choices(classes, weights=weights)[0]
+
+    def _sample_relations(self, relations, k):
+        weights = self._get_weights(relations, self.relation_weights)
+        return random.choices(relations, weights=weights, k=k)
+
+    def _execute_query(self, query: str, parameters=None, shape=None, sample_size=None):
+        results = self.backend.query(query, parameters, shape, sample_size)
         return results
 
-    def edit_query(self, query, graph):
-        query = query.split("\n")
-        query = [i for i in query if not i.startswith("WHERE")]
-        query = [i for i in query if not i.startswith("WITH")]
-        query = [i for i in query if not i.startswith("ORDER")]
-
-        added_return_variables = "RETURN x0"
-        for node in graph.nodes[1:]:
-            added_return_variables += f", x{node.id}"
-        query = [added_return_variables if i.startswith("RETURN") else i for i in query]
-
-        query = "\n".join(query)
-        query = query.replace("LIMIT 1", "")
-        return query
-
     def _ground_rel(self, relation, rel_type, in_rel=False):
         relation.rel_type = rel_type
         if in_rel:
@@ -74,25 +145,54 @@ class CypherGraphGrounder:
             return True
 
         class_type = node.class_type
-        possible_out_relations = [
-            i
-            for i in self.relations
-            if self.relations_info[i]["domain"].startswith(class_type)
-        ]
-        possible_in_relations = [
-            i
-            for i in self.relations
-            if self.relations_info[i]["range"].startswith(class_type)
-        ]
-
-        if possible_in_relations:
-            sampled_in_relations = random.choices(possible_in_relations, k=num_in_rel)
-        if possible_out_relations:
-            sampled_out_relations = random.choices(
-                possible_out_relations, k=num_out_rel
-            )
-
-        if self.diverse_parallel_relations:
+        possible_out_relations = self.relation_index.get_domain_relations(class_type)
+        possible_in_relations = self.relation_index.get_range_relations(class_type)
+
+        if self.enumerated_relations is not None:
+            sampled_in_relations = [
+                self.enumerated_relations[relation]
+                for relation in node.in_relations
+                if not relation.rel_type
+            ]
+            sampled_out_relations = [
+                self.enumerated_relations[relation]
+                for relation in node.out_relations
+                if not relation.rel_type
+            ]
+        elif self.schema_aware_sampling:
+            sampled_in_relations = [
+                self.assignment_sampler.sample_relation(
+                    class_type, relation.in_node, in_rel=True
+                )
+                for relation in node.in_relations
+                if not relation.rel_type
+            ]
+            sampled_out_relations = [
+                self.assignment_sampler.sample_relation(
+                    class_type, relation.out_node, in_rel=False
+                )
+                for relation in node.out_relations
+                if not relation.rel_type
+            ]
+            if None in sampled_in_relations or None in sampled_out_relations:
+                return False
+        else:
+            if possible_in_relations:
+                sampled_in_relations = self._sample_relations(
+                    possible_in_relations, k=num_in_rel
+                )
+            if possible_out_relations:
+                sampled_out_relations = self._sample_relations(
+                    possible_out_relations, k=num_out_rel
+                )
+
+        if self.enumerated_relations is not None or self.schema_aware_sampling:
+            if self.diverse_parallel_relations and (
+                len(set(sampled_in_relations)) < len(sampled_in_relations)
+                or len(set(sampled_out_relations)) < len(sampled_out_relations)
+            ):
+                return False
+        elif self.diverse_parallel_relations:
             sampled_in_relations = list(set(sampled_in_relations))
             if len(sampled_in_relations) < (num_in_rel):
                 return False
@@ -172,6 +272,33 @@ class CypherGraphGrounder:
         cand = random.choice(candidates)
         return cand[0], cand[1], True, cand[2]
 
+    def _get_projected_properties(self, node):
+        # The properties _pick_random_property and _pick_modifier_property can pick
+        # for the node. The answer node can also get a return property of any type
+        if node.id == 0 or not node.modifier or node.modifier.startswith("count"):
+            types = None
+        else:
+            types = list(CYPHER_MODIFIER_NUMBER_TYPES.keys())
+            if not any(node.modifier.startswith(x) for x in ("sum", "avg")):
+                types += list(CYPHER_MODIFIER_DATE_TYPES.keys())
+        return [
+            i
+            for i in self.properties
+            if i not in ("keywords", "label")
+            and (types is None or self.properties_info[i]["type"] in types)
+        ]
+
+    def _get_property_maps(self, record, projections):
+        # Record of a grounding query with projected properties to the properties
+        # of every node, without the missing ones
+        res = {}
+        for node_id, properties in projections.items():
+            values = record[f"x{node_id}"]
+            res[f"x{node_id}"] = {
+                i: value for i, value in zip(properties, values) if value is not None
+            }
+        return res
+
     def _get_list_modifier_properties(self, modifier):
         candidates = []
         types = [i for i in CYPHER_MODIFIER_NUMBER_TYPES.keys()]
@@ -182,6 +309,62 @@ class CypherGraphGrounder:
                 candidates.append(i)
         return candidates
 
+    def _get_subpatterns(self, graph):
+        # Typed edges and pairs of edges joined at a node, with their probe query.
+        # Every MATCH clause of a probe holds a single relation, so there is no
+        # relationship uniqueness and an empty probe means that every pattern
+        # containing the sub-pattern is empty too
+        subpatterns = {}
+        for relation in graph.relations:
+            in_class = relation.in_node.class_type
+            out_class = relation.out_node.class_type
+            key = f"E|{relation.rel_type}|" + "|".join(sorted((in_class, out_class)))
+            subpatterns[key] = (
+                f"MATCH (a:{in_class})-[:{relation.rel_type}]-(b:{out_class})\n"
+                "RETURN 1 LIMIT 1"
+            )
+        for node in graph.nodes:
+            branches = []
+            for relation in node.in_relations + node.out_relations:
+                if relation.out_node is node:
+                    branches.append((relation.rel_type, relation.in_node.class_type))
+                else:
+                    branches.append((relation.rel_type, relation.out_node.class_type))
+            for (rel_a, class_a), (rel_b, class_b) in combinations(sorted(branches), 2):
+                key = f"P|{node.class_type}|{rel_a}:{class_a}|{rel_b}:{class_b}"
+                subpatterns[key] = (
+                    f"MATCH (c:{node.class_type})-[:{rel_a}]-(a:{class_a})\n"
+                    f"MATCH (c)-[:{rel_b}]-(b:{class_b})\n"
+                    "RETURN 1 LIMIT 1"
+                )
+        return subpatterns
+
+    def _has_empty_subpattern(self, subpatterns):
+        return any(key in self.negative_cache for key in subpatterns)
+
+    def _update_negative_cache(self, query, results, subpatterns):
+        # Generator, yields its probe queries like _ground_graph_steps
+        if len(results) > 0:
+            self.nonempty_subpatterns.update(subpatterns)
+            return
+        self.negative_cache.add(f"Q|{query}")
+        if len(subpatterns) == 1:
+            # A single typed edge, the query was its probe
+            self.negative_cache.update(subpatterns)
+            return
+        # Look for the sub-pattern without matches, edges before pairs
+        for key in sorted(subpatterns):
+            if key in self.nonempty_subpatterns:
+                continue
+            try:
+                probe_results = yield "query", subpatterns[key], None
+            except QueryError as e:
+                continue
+            if len(probe_results) == 0:
+                self.negative_cache.add(key)
+                return
+            self.nonempty_subpatterns.add(key)
+
     def _get_nodes_combinations(self, graph):
         number = len(graph.nodes)
         result = []
@@ -191,156 +374,337 @@ class CypherGraphGrounder:
                 result.append(combo)
         return result
 
+    def _get_pattern_shape(self, graph):
+        return (
+            tuple((i.in_node.id, i.out_node.id) for i in graph.relations),
+            tuple(i.modifier for i in graph.nodes),
+        )
+
+    def _get_assignment_iterator(self, graph):
+        # One walk per pattern, kept across calls so retries continue where the
+        # previous call stopped
+        key = self._get_pattern_shape(graph)
+        if key not in self.assignment_iterators:
+            self.assignment_iterators[key] = (
+                self.assignment_enumerator.iter_assignments(graph)
+            )
+        return self.assignment_iterators[key]
+
     def ground_graph(self, original_graph):
+        steps = self._ground_graph_steps(original_graph)
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    if request[0] == "explain":
+                        results = self.backend.explain(*request[1:])
+                    else:
+                        results = self._execute_query(*request[1:])
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(results)
+        except StopIteration as stop:
+            return stop.value
+
+    async def ground_graph_async(self, original_graph):
+        # Same as ground_graph, other groundings run while the queries are awaited
+        steps = self._ground_graph_steps(original_graph)
+        try:
+            request = next(steps)
+            while True:
+                try:
+                    if request[0] == "explain":
+                        results = await self.async_backend.explain(*request[1:])
+                    else:
+                        results = await self.async_backend.query(*request[1:])
+                except Exception as e:
+                    request = steps.throw(e)
+                else:
+                    request = steps.send(results)
+        except StopIteration as stop:
+            return stop.value
+
+    def _get_grounded_graphs(self, graph, results, projections):
+        # Groundings of the candidate graph from random matches of its query
         grounded_graphs = []
-        iter = 0
-        grounded = False
-        while not grounded and iter < self.max_iterations:
-            iter += 1
-            graph = copy.deepcopy(original_graph)
-            answer_node = graph.answer_node
-
-            answer_node_class = random.choice(self.classes)
-            answer_node.class_type = answer_node_class
-            if answer_node.modifier and answer_node.modifier != "count":
-                answer_node.modifier_edge = random.choice([True, False])
-
-            was_grounded = self._recursive_ground(
-                answer_node, modifier_edge=answer_node.modifier_edge
-            )
+        nodes_id_to_ground = self._get_nodes_combinations(graph)
+        if not graph.nodes[0].modifier:
+            modifier_nodes_id = [
+                x for x in range(len(graph.nodes)) if graph.nodes[x].modifier
+            ]
+            nodes_id_to_ground = [
+                tup
+                for tup in nodes_id_to_ground
+                if all(num in tup for num in modifier_nodes_id)
+            ]
+        elif graph.nodes[0].modifier in ("max", "min"):
+            nodes_id_to_ground = [tup for tup in nodes_id_to_ground if 0 not in tup]
+
+        to_return_attr = [False for _ in nodes_id_to_ground]
+        if not graph.nodes[0].modifier or graph.nodes[0].modifier in (
+            "min",
+            "max",
+        ):
+            to_return_attr += [True for _ in nodes_id_to_ground]
+            nodes_id_to_ground += nodes_id_to_ground
+
+        for ntg, t_r_a in zip(nodes_id_to_ground, to_return_attr):
+            try:
+                ntg_grounded = True
+                graph_tg = GraphOverlay(graph)
+
+                graph_tg.return_attribute = t_r_a
 
-            if not was_grounded:
+                res = random.choice(results)
+                if projections is not None:
+                    res = self._get_property_maps(res, projections)
+                for node_id in ntg:
+                    node = graph.nodes[node_id]
+
+                    if node.is_answer_node:
+                        if node.modifier:
+                            x0_property, x_ent, grnd, x0_datatype = (
+                                self._pick_modifier_property(res["x0"], node.modifier)
+                            )
+                            ntg_grounded = ntg_grounded and grnd
+                            graph.nodes[0].datatype = x0_datatype
+                            graph_tg.set_node_field(0, "datatype", x0_datatype)
+                        else:
+                            x0_property, x_ent = self._pick_random_property(res["x0"])
+                        graph_tg.set_node_field(node_id, "grounded_entity", x_ent)
+                        graph_tg.set_node_field(node_id, "attribute", x0_property)
+                    else:
+                        if node.modifier:
+                            x_prop, x_ent, grnd, x_datatype = (
+                                self._pick_modifier_property(
+                                    res[f"x{node.id}"], node.modifier
+                                )
+                            )
+                            if node.modifier.startswith("count") and len(
+                                node.modifier
+                            ) > len("count"):
+                                x_ent = res[f"z{node.id}"]
+                            ntg_grounded = ntg_grounded and grnd
+                            graph_tg.set_node_field(node_id, "datatype", x_datatype)
+                            if node.modifier[-1] == "<" or node.modifier[-1] == ">":
+                                try:
+                                    x_ent = int(x_ent)
+                                    if node.modifier[-1] == "<":
+                                        x_ent = x_ent + 1
+                                    else:
+                                        x_ent = x_ent - 1
+                                    x_ent = str(x_ent)
+                                except:
+                                    pass
+                        else:
+                            x_prop, x_ent = self._pick_random_property(
+                                res[f"x{node.id}"]
+                            )
+                        graph_tg.set_node_field(node_id, "grounded_entity", x_ent)
+                        graph_tg.set_node_field(node_id, "attribute", x_prop)
+
+                if 0 not in ntg:
+                    node = graph.nodes[0]
+                    if node.modifier and not node.modifier.startswith("count"):
+                        x0_property, _, grnd, x0_datatype = (
+                            self._pick_modifier_property(res["x0"], node.modifier)
+                        )
+                        ntg_grounded = ntg_grounded and grnd
+                        graph.nodes[0].datatype = x0_datatype
+                        graph_tg.set_node_field(0, "datatype", x0_datatype)
+                        graph_tg.set_node_field(0, "attribute", x0_property)
+
+                # If needs to return property choose it here. Property must not be the same as grounded attribute
+                if t_r_a:
+                    to_exclude = []
+                    x0_attribute = graph_tg.get_node_field(0, "attribute")
+                    if x0_attribute is not None:
+                        if graph.nodes[0].modifier not in (
+                            "count",
+                            "max",
+                            "min",
+                        ):
+                            to_exclude = [x0_attribute]
+                    if len(res["x0"].keys()) > len(to_exclude):
+                        x0_property, _ = self._pick_random_property(
+                            res["x0"], exclude=to_exclude
+                        )
+                        graph_tg.return_property = x0_property
+                    else:
+                        ntg_grounded = False
+
+                if ntg_grounded:
+                    grounded_graphs.append(graph_tg.materialize())
+            except:
                 continue
-            else:
-                cypher_writer = CypherQueryWriter(graph)
-                anon_query = cypher_writer.write_query()
-                if anon_query in self.pattern_rel_cache:
-                    continue
+        return grounded_graphs
+
+    def _ground_graph_steps(self, original_graph):
+        # Generator with the grounding logic, it yields every request it needs,
+        # ("query", query, parameters[, shape, sample_size]) or ("explain", query,
+        # parameters), and gets back the results, so it can be driven by the
+        # blocking and by the async driver. Returns (grounded_graphs, grounded)
+        grounded_graphs = []
+        iter = 0
+        grounded = False
+        exhausted = False
+        if self.systematic_assignments:
+            assignments = self._get_assignment_iterator(original_graph)
+        elif self.schema_aware_sampling:
+            root_shape = self.assignment_sampler.set_graph(original_graph)
+            possible_classes = self.assignment_sampler.get_valid_classes(root_shape)
+            if not possible_classes:
+                return grounded_graphs, grounded
+        else:
+            possible_classes = self.classes
+        projections = None
+        if self.project_properties:
+            projections = {
+                node.id: self._get_projected_properties(node)
+                for node in original_graph.nodes
+            }
+        while not grounded and not exhausted and iter < self.max_iterations:
+            # Up to candidates_per_query candidate groundings, each one an
+            # iteration, whose queries run as one
+            candidates = []
+            while (
+                len(candidates) < self.candidates_per_query
+                and iter < self.max_iterations
+            ):
+                iter += 1
+                graph = original_graph.clone()
+                answer_node = graph.answer_node
+
+                if self.systematic_assignments:
+                    assignment = next(assignments, None)
+                    if assignment is None:
+                        # Every valid assignment of the pattern has been tried
+                        exhausted = True
+                        break
+                    answer_node_class, rel_types = assignment
+                    self.enumerated_relations = dict(zip(graph.relations, rel_types))
                 else:
-                    self.pattern_rel_cache.add(anon_query)
+                    answer_node_class = self._sample_class(possible_classes)
+                answer_node.class_type = answer_node_class
+                if answer_node.modifier and answer_node.modifier != "count":
+                    answer_node.modifier_edge = random.choice([True, False])
+
+                if self.schema_aware_sampling and not self.systematic_assignments:
+                    # Other patterns may have been set since, when grounding concurrently
+                    self.assignment_sampler.set_graph(original_graph)
+                was_grounded = self._recursive_ground(
+                    answer_node, modifier_edge=answer_node.modifier_edge
+                )
+                self.enumerated_relations = None
+
+                if not was_grounded:
+                    continue
+                elif self.assignment_cache.check_and_add(
+                    graph.get_assignment_fingerprint()
+                ):
+                    continue
 
-            cypher_writer = CypherQueryWriter(graph)
-            cypher_query = cypher_writer.write_query()
-            cypher_query = self.edit_query(cypher_query, graph)
+                subpatterns = None
+                if self.negative_cache is not None:
+                    subpatterns = self._get_subpatterns(graph)
+                    if self._has_empty_subpattern(subpatterns):
+                        continue
 
-            try:
-                results = self._execute_query(cypher_query)
-            except Exception as e:
-
-                results = []
-
-            if len(results) > 0:
-                nodes_id_to_ground = self._get_nodes_combinations(graph)
-                if not graph.nodes[0].modifier:
-                    modifier_nodes_id = [
-                        x for x in range(len(graph.nodes)) if graph.nodes[x].modifier
-                    ]
-                    nodes_id_to_ground = [
-                        tup
-                        for tup in nodes_id_to_ground
-                        if all(num in tup for num in modifier_nodes_id)
-                    ]
-                elif graph.nodes[0].modifier in ("max", "min"):
-                    nodes_id_to_ground = [
-                        tup for tup in nodes_id_to_ground if 0 not in tup
-                    ]
-
-                to_return_attr = [False for _ in nodes_id_to_ground]
-                if not graph.nodes[0].modifier or graph.nodes[0].modifier in (
-                    "min",
-                    "max",
+                cypher_writer = CypherQueryWriter(graph)
+                cypher_query, parameters = cypher_writer.write_grounding_query(
+                    projections,
+                    self.sample_size if self.server_side_sampling else None,
+                )
+
+                if (
+                    self.negative_cache is not None
+                    and f"Q|{cypher_query}" in self.negative_cache
                 ):
-                    to_return_attr += [True for _ in nodes_id_to_ground]
-                    nodes_id_to_ground += nodes_id_to_ground
+                    continue
 
-                for ntg, t_r_a in zip(nodes_id_to_ground, to_return_attr):
+                if self.max_query_cost is not None:
                     try:
-                        ntg_grounded = True
-                        graph_tg = copy.deepcopy(graph)
-
-                        graph_tg.return_attribute = t_r_a
-
-                        res = random.choice(results)
-                        for node_id in ntg:
-                            node = graph_tg.nodes[node_id]
-
-                            if node.is_answer_node:
-                                if node.modifier:
-                                    x0_property, x_ent, grnd, x0_datatype = (
-                                        self._pick_modifier_property(
-                                            res["x0"], node.modifier
-                                        )
-                                    )
-                                    ntg_grounded = ntg_grounded and grnd
-                                    graph.nodes[0].datatype = x0_datatype
-                                else:
-                                    x0_property, x_ent = self._pick_random_property(
-                                        res["x0"]
-                                    )
-                                node.grounded_entity = x_ent
-                                node.attribute = x0_property
-                            else:
-                                if node.modifier:
-                                    x_prop, x_ent, grnd, x_datatype = (
-                                        self._pick_modifier_property(
-                                            res[f"x{node.id}"], node.modifier
-                                        )
-                                    )
-                                    if node.modifier.startswith("count") and len(
-                                        node.modifier
-                                    ) > len("count"):
-                                        x_ent = res[f"z{node.id}"]
-                                    ntg_grounded = ntg_grounded and grnd
-                                    node.datatype = x_datatype
-                                    if node.modifier[-1] == "<" or node.modifier[-1] == ">":
-                                        try:
-                                            x_ent = int(x_ent)
-                                            if node.modifier[-1] == "<":
-                                                x_ent = x_ent + 1
-                                            else:
-                                                x_ent = x_ent - 1
-                                            x_ent = str(x_ent)
-                                        except:
-                                            pass
-                                else:
-                                    x_prop, x_ent = self._pick_random_property(
-                                        res[f"x{node.id}"]
-                                    )
-                                node.grounded_entity = x_ent
-                                node.attribute = x_prop
-
-                        if 0 not in ntg:
-                            node = graph_tg.nodes[0]
-                            if node.modifier and not node.modifier.startswith("count"):
-                                x0_property, _, grnd, x0_datatype = (
-                                    self._pick_modifier_property(res["x0"], node.modifier)
-                                )
-                                ntg_grounded = ntg_grounded and grnd
-                                graph.nodes[0].datatype = x0_datatype
-                                node.attribute = x0_property
-
-                        # If needs to return property choose it here. Property must not be the same as grounded attribute
-                        if t_r_a:
-                            to_exclude = []
-                            if graph_tg.nodes[0].attribute is not None:
-                                if graph_tg.nodes[0].modifier not in (
-                                    "count",
-                                    "max",
-                                    "min",
-                                ):
-                                    to_exclude = [graph_tg.nodes[0].attribute]
-                            if len(res["x0"].keys()) > len(to_exclude):
-                                x0_property, _ = self._pick_random_property(
-                                    res["x0"], exclude=to_exclude
-                                )
-                                graph_tg.return_property = x0_property
-                            else:
-                                ntg_grounded = False
-
-                        if ntg_grounded:
-                            grounded = True
-                            grounded_graphs.append(graph_tg)
-                    except:
+                        estimates = yield "explain", cypher_query, parameters
+                    except QueryError as e:
+                        estimates = None
+                    if (
+                        estimates is not None
+                        and estimates["cost"] > self.max_query_cost
+                    ):
+                        # Over the budget, the iteration goes to another assignment
+                        self.num_rejected_queries += 1
                         continue
 
+                candidates.append((graph, cypher_query, parameters, subpatterns))
+
+            if len(candidates) == 0:
+                continue
+            try:
+                candidates_results = yield from self._query_candidates(
+                    candidates, original_graph, projections
+                )
+                if self.negative_cache is not None:
+                    for (_, cypher_query, _, subpatterns), results in zip(
+                        candidates, candidates_results
+                    ):
+                        yield from self._update_negative_cache(
+                            cypher_query, results, subpatterns
+                        )
+            except QueryError as e:
+                # Only the query failed, the backend errors stop the grounding
+                continue
+
+            # The first candidate with groundings ends the grounding, as with a
+            # query per candidate
+            for (graph, _, _, _), results in zip(candidates, candidates_results):
+                if len(results) > 0:
+                    candidate_graphs = self._get_grounded_graphs(
+                        graph, results, projections
+                    )
+                    if candidate_graphs:
+                        grounded = True
+                        grounded_graphs += candidate_graphs
+                        break
+
         return grounded_graphs, grounded
+
+    def _query_candidates(self, candidates, original_graph, projections):
+        # Generator, yields the grounding query of the candidates like
+        # _ground_graph_steps and returns the results of every candidate
+        shape = self._get_pattern_shape(original_graph)
+        if len(candidates) == 1:
+            _, cypher_query, parameters, _ = candidates[0]
+            results = yield "query", cypher_query, parameters, shape, self.sample_size
+            return [results]
+
+        graphs = [graph for graph, _, _, _ in candidates]
+        if self.sample_size is not None and self.server_side_sampling:
+            batched_query = write_batched_grounding_query(
+                graphs, projections, self.sample_size
+            )
+            # Every candidate has its own sample in the query, the sample size of
+            # the batch keeps all of them and only keeps it out of the query cache
+            sample_size = self.sample_size * len(candidates)
+        else:
+            # A sample of the whole batch could miss the few matches of a candidate,
+            # the records are all fetched and every candidate is sampled after
+            batched_query = write_batched_grounding_query(graphs, projections)
+            sample_size = None
+        # The batches get their own timeouts, they run several queries
+        results = (
+            yield "query",
+            batched_query,
+            None,
+            (shape, len(candidates)),
+            sample_size,
+        )
+
+        candidates_results = [[] for _ in candidates]
+        for record in results:
+            candidates_results[record["candidate"]].append(record)
+        if self.sample_size is not None and not self.server_side_sampling:
+            candidates_results = [
+                reservoir_sample(i, self.sample_size) for i in candidates_results
+            ]
+        return candidates_results
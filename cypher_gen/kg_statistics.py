@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+from grounder import CypherGraphGrounder
+from utils import add_backend_arguments, configure_backend
+
+CLASS_COUNT_QUERY = """MATCH (n)
+UNWIND labels(n) AS label
+RETURN label, count(*) AS count"""
+
+RELATION_COUNT_QUERY = """MATCH ()-[r]->()
+RETURN type(r) AS rel_type, count(*) AS count"""
+
+
+def get_statistics_path(schema_path):
+    return os.path.splitext(schema_path)[0] + ".stats.json"
+
+
+def collect_statistics(grounder):
+    classes = {i: 0 for i in grounder.classes}
+    for record in grounder._execute_query(CLASS_COUNT_QUERY):
+        if record["label"] in classes:
+            classes[record["label"]] = record["count"]
+
+    relations = {i: 0 for i in grounder.relations}
+    for record in grounder._execute_query(RELATION_COUNT_QUERY):
+        if record["rel_type"] in relations:
+            relations[record["rel_type"]] = record["count"]
+
+    return {"classes": classes, "relations": relations}
+
+
+def load_statistics(statistics_path, temperature=1.0):
+    # Sampling weights are the instance counts raised to the temperature, so 1 keeps
+    # the counts as they are and 0 gives the same weight to everything with instances
+    with open(statistics_path, "r") as file:
+        statistics = json.load(file)
+    class_weights = {
+        k: v**temperature if v > 0 else 0 for k, v in statistics["classes"].items()
+    }
+    relation_weights = {
+        k: v**temperature if v > 0 else 0 for k, v in statistics["relations"].items()
+    }
+    return class_weights, relation_weights
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json-schema", type=str, help="kg json schema path", required=True
+    )
+    parser.add_argument(
+        "--output-file",
+        type=str,
+        help="statistics file, defaults to the schema path with a .stats.json extension",
+    )
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    grounder = CypherGraphGrounder(args.json_schema)
+    configure_backend(grounder, args)
+    statistics = collect_statistics(grounder)
+
+    output_file = args.output_file or get_statistics_path(args.json_schema)
+    with open(output_file, "w") as json_file:
+        json.dump(statistics, json_file, indent=4)
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
+
+    print(
+        f"Classes with instances: {sum(1 for i in statistics['classes'].values() if i > 0)}"
+    )
+    print(
+        f"Relations with instances: {sum(1 for i in statistics['relations'].values() if i > 0)}"
+    )
@@ -1,7 +1,6 @@
 import random
 from graph import Graph
-import itertools
-import copy
+from math import comb
 
 
 class PatternGenerator:
@@ -11,54 +10,28 @@ class PatternGenerator:
         self.add_modifiers = True
         self.max_pattern_trials = 100000
         self.remove_modifiers = []
-
-    def matrix_to_string(self, m):
-        m = [str(item) for row in m for item in row]
-        m = ".".join(m)
-        return m
+        self._trees_cache = {}
+        self.rng = random
 
     def _is_pattern_unique(self, pattern, pattern_set):
-        # Note: This does not work correctly for graph with modifiers
-        matrix = pattern.get_matrix_representation()
-
-        numbers = list(range(1, len(matrix)))
-        permutations = list(itertools.permutations(numbers))
-        permutations = [(0,) + perm for perm in permutations]
-        matrixes = []
-        for permutation in permutations:
-            m = [[0 for _ in matrix] for _ in matrix]
-            for i in range(len(matrix)):
-                for j in range(len(matrix)):
-                    m[i][j] = matrix[permutation[i]][permutation[j]]
-                    if (i > j and permutation[i] < permutation[j]) or (
-                        i < j and permutation[i] > permutation[j]
-                    ):
-                        m[i][j] = m[i][j][::-1]
-            m = self.matrix_to_string(m)
-            matrixes.append(m)
-
-        matrix_string = self.matrix_to_string(matrix)
-        is_unique = True
-        for i in matrixes:
-            if i in pattern_set:
-                is_unique = False
-        return is_unique, matrix_string
+        encoding = pattern.get_canonical_encoding()
+        return encoding not in pattern_set, encoding
 
     def _generate_pattern(self):
         graph = Graph()
 
-        num_nodes = random.randint(2, self.max_nodes)
+        num_nodes = self.rng.randint(2, self.max_nodes)
         node_ids_to_explore = [0]
 
         while len(node_ids_to_explore) > 0 and len(graph.nodes) < num_nodes:
-            target_node = random.choice(node_ids_to_explore)
+            target_node = self.rng.choice(node_ids_to_explore)
             node_ids_to_explore.remove(target_node)
             max_new_edges = min(self.max_new_edges, num_nodes - len(graph.nodes))
-            num_new_edges = random.randint(0, max_new_edges)
+            num_new_edges = self.rng.randint(0, max_new_edges)
             if num_new_edges == 0 and target_node == 0:
                 num_new_edges = 1
             for _ in range(num_new_edges):
-                if random.randint(0, 1) == 0:
+                if self.rng.randint(0, 1) == 0:
                     node_id = graph.add_in_relation(target_node)
                 else:
                     node_id = graph.add_out_relation(target_node)
@@ -78,41 +51,141 @@ class PatternGenerator:
 
             return modifiers
 
-    def generate_patterns(self, num_patterns, unique=False):
-        patterns = []
-        patterns_mod = []
+    def iter_patterns(self, num_patterns, unique=False):
+        # Produces the same sequence as generate_patterns, but base patterns are
+        # yielded as soon as they are sampled and the modifier variants are only
+        # copied when they are reached
+        variants = []
         pattern_encodings = set()
+        num_generated = 0
         trial_counts = 0
-        while len(patterns) < num_patterns and trial_counts < self.max_pattern_trials:
+        while num_generated < num_patterns and trial_counts < self.max_pattern_trials:
             trial_counts += 1
             pattern = self._generate_pattern()
 
             if unique:
-                is_pattern_unique, matrix_encoding = self._is_pattern_unique(
+                is_pattern_unique, encoding = self._is_pattern_unique(
                     pattern, pattern_encodings
                 )
-                if is_pattern_unique:
-                    pattern_encodings.add(matrix_encoding)
-                    patterns.append(pattern)
+                if not is_pattern_unique:
+                    continue
+                pattern_encodings.add(encoding)
+
+            num_generated += 1
+            yield pattern
 
-                    if self.add_modifiers:
-                        for node in pattern.nodes:
-                            for mod in self._get_modifiers(node.is_answer_node):
-                                graph = copy.deepcopy(pattern)
-                                graph.set_modifier(node.id, mod)
-                                patterns_mod.append(graph)
+            if self.add_modifiers:
+                for node in pattern.nodes:
+                    for mod in self._get_modifiers(node.is_answer_node):
+                        variants.append((pattern, node.id, mod))
 
-            else:
-                patterns.append(pattern)
+        self.rng.shuffle(variants)
+        for pattern, node_id, mod in variants:
+            graph = pattern.clone()
+            graph.set_modifier(node_id, mod)
+            yield graph
+
+    def generate_patterns(self, num_patterns, unique=False):
+        return list(self.iter_patterns(num_patterns, unique=unique))
+
+    def _get_trees(self, num_nodes):
+        # A tree is the sorted tuple of its branches, a branch is (direction, subtree)
+        # with direction 0 for an in relation and 1 for an out relation
+        key = (num_nodes, self.max_new_edges)
+        if key not in self._trees_cache:
+            self._trees_cache[key] = list(self._iter_trees(num_nodes))
+        return self._trees_cache[key]
+
+    def _iter_trees(self, num_nodes):
+        if num_nodes == 1:
+            yield ()
+            return
+        branches = []
+        for size in range(1, num_nodes):
+            for tree in self._get_trees(size):
+                for direction in (0, 1):
+                    branches.append((size, (direction, tree)))
+        yield from self._iter_branch_multisets(branches, 0, num_nodes - 1, ())
+
+    def _iter_branch_multisets(self, branches, start, remaining, chosen):
+        # Branches are taken in non decreasing order so each multiset is produced once
+        if remaining == 0:
+            yield chosen
+            return
+        if len(chosen) == self.max_new_edges:
+            return
+        for i in range(start, len(branches)):
+            size, branch = branches[i]
+            if size > remaining:
+                break
+            yield from self._iter_branch_multisets(
+                branches, i, remaining - size, chosen + (branch,)
+            )
+
+    def _build_pattern(self, tree):
+        graph = Graph()
+        to_expand = [(0, tree)]
+        while len(to_expand) > 0:
+            node_id, subtree = to_expand.pop(0)
+            for direction, child in subtree:
+                if direction == 0:
+                    child_id = graph.add_in_relation(node_id)
+                else:
+                    child_id = graph.add_out_relation(node_id)
+                to_expand.append((child_id, child))
+        return graph
 
+    def _get_num_variants(self, num_nodes):
+        if not self.add_modifiers:
+            return 1
+        return (
+            1
+            + len(self._get_modifiers(True))
+            + (num_nodes - 1) * len(self._get_modifiers(False))
+        )
+
+    def count_trees(self, num_nodes):
+        # Number of distinct directed rooted trees with num_nodes nodes, where each
+        # node has at most max_new_edges children, computed without enumerating them
+        counts = {1: 1}
+        max_children = self.max_new_edges
+        for n in range(2, num_nodes + 1):
+            # ways[s][j]: multisets of branches with s nodes in total and j branches
+            ways = [[0] * (max_children + 1) for _ in range(n)]
+            ways[0][0] = 1
+            for size in range(1, n):
+                branch_types = 2 * counts[size]
+                new_ways = [[0] * (max_children + 1) for _ in range(n)]
+                for s in range(n):
+                    for j in range(max_children + 1):
+                        if not ways[s][j]:
+                            continue
+                        m = 0
+                        while s + m * size < n and j + m <= max_children:
+                            new_ways[s + m * size][j + m] += ways[s][j] * comb(
+                                branch_types + m - 1, m
+                            )
+                            m += 1
+                ways = new_ways
+            counts[n] = sum(ways[n - 1])
+        return counts[num_nodes]
+
+    def count_patterns(self):
+        total = 0
+        for num_nodes in range(2, self.max_nodes + 1):
+            total += self.count_trees(num_nodes) * self._get_num_variants(num_nodes)
+        return total
+
+    def enumerate_patterns(self):
+        # Deterministically yields every distinct pattern with up to max_nodes nodes,
+        # each one followed by its modifier variants
+        for num_nodes in range(2, self.max_nodes + 1):
+            for tree in self._iter_trees(num_nodes):
+                pattern = self._build_pattern(tree)
+                yield pattern
                 if self.add_modifiers:
                     for node in pattern.nodes:
                         for mod in self._get_modifiers(node.is_answer_node):
-                            graph = copy.deepcopy(pattern)
+                            graph = self._build_pattern(tree)
                             graph.set_modifier(node.id, mod)
-                            patterns_mod.append(graph)
-
-        random.shuffle(patterns_mod)
-        patterns = patterns + patterns_mod
-
-        return patterns
+                            yield graph
@@ -0,0 +1,1091 @@
+import heapq
+import itertools
+import json
+import math
+import random
+import re
+from datetime import date, datetime, time
+from functools import lru_cache
+
+from resilience import QueryError, SYNTAX
+from reservoir import reservoir_sample
+
+# In process alternative to the neo4j server. A PropertyGraph holds a graph export
+# in memory, with the nodes indexed by label and the relationships by node and
+# type, and evaluates the subset of Cypher that the grounder and CypherQueryWriter
+# write: MATCH of chains of undirected or directed relationships with inline node
+# WHERE, WHERE, UNWIND, WITH and RETURN with aggregations, ORDER BY, SKIP and LIMIT,
+# and CALL subqueries of a query or a UNION of queries
+
+TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    |(?P<number>\d+\.\d+|\d+)
+    |(?P<parameter>\$\w+)
+    |(?P<name>[A-Za-z_]\w*|`[^`]+`)
+    |(?P<symbol><=|>=|<>|->|<-|[-=<>()\[\]{}:,.*+/%|])
+    )""",
+    re.VERBOSE,
+)
+
+AGGREGATE_FUNCTIONS = ("count", "sum", "avg", "min", "max", "collect")
+
+COMPARISON_OPERATORS = ("=", "<>", "<", ">", "<=", ">=")
+
+
+class PropertyGraphNode(dict):
+    # The properties of the node, like the nodes returned by the neo4j driver
+    def __init__(self, index, element_id, labels, properties):
+        super().__init__(properties)
+        self.index = index
+        self.element_id = element_id
+        self.labels = frozenset(labels)
+
+    __hash__ = object.__hash__
+
+    def __eq__(self, other):
+        return self is other
+
+
+class PropertyGraphRelationship(dict):
+    def __init__(self, index, element_id, rel_type, start, end, properties):
+        super().__init__(properties)
+        self.index = index
+        self.element_id = element_id
+        self.type = rel_type
+        self.start = start
+        self.end = end
+
+    __hash__ = object.__hash__
+
+    def __eq__(self, other):
+        return self is other
+
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        match = TOKEN_PATTERN.match(query, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"Invalid input at position {pos}: {query[pos:pos + 20]}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.startswith("`"):
+            value = value[1:-1]
+        tokens.append((kind, value, match.start(kind), match.end(kind)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, query):
+        self.query = query
+        self.tokens = _tokenize(query)
+        self.pos = 0
+
+    def _peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None, len(self.query), len(self.query))
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of query")
+        self.pos += 1
+        return token
+
+    def _is_keyword(self, keyword, offset=0):
+        kind, value, _, _ = self._peek(offset)
+        return kind == "name" and value.upper() == keyword
+
+    def _accept_keyword(self, keyword):
+        if self._is_keyword(keyword):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect_keyword(self, keyword):
+        if not self._accept_keyword(keyword):
+            raise ValueError(f"Expected {keyword} at: {self._peek()[1]}")
+
+    def _is_symbol(self, symbol):
+        kind, value, _, _ = self._peek()
+        return kind == "symbol" and value == symbol
+
+    def _accept_symbol(self, symbol):
+        if self._is_symbol(symbol):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect_symbol(self, symbol):
+        if not self._accept_symbol(symbol):
+            raise ValueError(f"Expected {symbol} at: {self._peek()[1]}")
+
+    def _name(self):
+        kind, value, _, _ = self._next()
+        if kind != "name":
+            raise ValueError(f"Expected a name at: {value}")
+        return value
+
+    def parse(self):
+        clauses = self._query()
+        if self._peek()[0] is not None:
+            raise ValueError(f"Unexpected input after RETURN: {self._peek()[1]}")
+        return clauses
+
+    def _query(self):
+        # Clauses up to the RETURN ending the query or a part of a CALL subquery
+        clauses = []
+        while self._peek()[0] is not None:
+            if self._accept_keyword("MATCH"):
+                patterns = [self._pattern()]
+                while self._accept_symbol(","):
+                    patterns.append(self._pattern())
+                clauses.append(("match", patterns))
+                if self._accept_keyword("WHERE"):
+                    clauses.append(("where", self._expression()))
+            elif self._accept_keyword("WHERE"):
+                clauses.append(("where", self._expression()))
+            elif self._accept_keyword("UNWIND"):
+                expr = self._expression()
+                self._expect_keyword("AS")
+                clauses.append(("unwind", expr, self._name()))
+            elif self._accept_keyword("WITH"):
+                clauses.append(self._projection("with"))
+                if self._accept_keyword("WHERE"):
+                    clauses.append(("where", self._expression()))
+            elif self._accept_keyword("CALL"):
+                clauses.append(self._subquery())
+            elif self._accept_keyword("RETURN"):
+                clauses.append(self._projection("return"))
+                break
+            else:
+                raise ValueError(f"Unsupported clause: {self._peek()[1]}")
+        if not clauses or clauses[-1][0] != "return":
+            raise ValueError("Query must end with a RETURN clause")
+        return clauses
+
+    def _subquery(self):
+        # CALL { ... } of one query or of the UNION of several. The subquery does
+        # not import variables, its records are joined to every incoming row
+        self._expect_symbol("{")
+        parts = [self._query()]
+        distinct = None
+        while self._accept_keyword("UNION"):
+            union_distinct = not self._accept_keyword("ALL")
+            if distinct is not None and distinct != union_distinct:
+                raise ValueError("Mixed UNION and UNION ALL")
+            distinct = union_distinct
+            parts.append(self._query())
+        self._expect_symbol("}")
+        columns = [name for name, _ in parts[0][-1][1]]
+        for part in parts[1:]:
+            if [name for name, _ in part[-1][1]] != columns:
+                raise ValueError("The parts of a UNION must return the same columns")
+        return ("subquery", parts, bool(distinct))
+
+    def _pattern(self):
+        nodes = [self._node_pattern()]
+        rels = []
+        while self._is_symbol("-") or self._is_symbol("<-"):
+            rels.append(self._relationship_pattern())
+            nodes.append(self._node_pattern())
+        return nodes, rels
+
+    def _node_pattern(self):
+        self._expect_symbol("(")
+        var = None
+        labels = []
+        where = None
+        if self._peek()[0] == "name" and not self._is_keyword("WHERE"):
+            var = self._name()
+        while self._accept_symbol(":"):
+            labels.append(self._name())
+        if self._accept_keyword("WHERE"):
+            where = self._expression()
+        self._expect_symbol(")")
+        return var, tuple(labels), where
+
+    def _relationship_pattern(self):
+        left_arrow = self._accept_symbol("<-")
+        if not left_arrow:
+            self._expect_symbol("-")
+        var = None
+        types = []
+        if self._accept_symbol("["):
+            if self._peek()[0] == "name":
+                var = self._name()
+            if self._accept_symbol(":"):
+                types.append(self._name())
+                while self._accept_symbol("|"):
+                    self._accept_symbol(":")
+                    types.append(self._name())
+            self._expect_symbol("]")
+        right_arrow = self._accept_symbol("->")
+        if not right_arrow:
+            self._expect_symbol("-")
+        if left_arrow and right_arrow:
+            raise ValueError("Relationship with two directions")
+        direction = "in" if left_arrow else "out" if right_arrow else "both"
+        return var, tuple(types), direction
+
+    def _projection(self, kind):
+        distinct = self._accept_keyword("DISTINCT")
+        items = [self._projection_item()]
+        while self._accept_symbol(","):
+            items.append(self._projection_item())
+        order = []
+        skip = None
+        limit = None
+        if self._is_keyword("ORDER"):
+            self.pos += 1
+            self._expect_keyword("BY")
+            while True:
+                expr = self._expression()
+                descending = False
+                if self._accept_keyword("DESC") or self._accept_keyword("DESCENDING"):
+                    descending = True
+                elif self._accept_keyword("ASC") or self._accept_keyword("ASCENDING"):
+                    pass
+                order.append((expr, descending))
+                if not self._accept_symbol(","):
+                    break
+        if self._accept_keyword("SKIP"):
+            skip = self._expression()
+        if self._accept_keyword("LIMIT"):
+            limit = self._expression()
+        return (kind, items, distinct, order, skip, limit)
+
+    def _projection_item(self):
+        start = self._peek()[2]
+        expr = self._expression()
+        end = self.tokens[self.pos - 1][3]
+        name = self.query[start:end]
+        if self._accept_keyword("AS"):
+            name = self._name()
+        return name, expr
+
+    def _expression(self):
+        expr = self._and_expression()
+        while True:
+            if self._accept_keyword("OR"):
+                expr = ("or", expr, self._and_expression())
+            elif self._accept_keyword("XOR"):
+                expr = ("xor", expr, self._and_expression())
+            else:
+                return expr
+
+    def _and_expression(self):
+        expr = self._not_expression()
+        while self._accept_keyword("AND"):
+            expr = ("and", expr, self._not_expression())
+        return expr
+
+    def _not_expression(self):
+        if self._accept_keyword("NOT"):
+            return ("not", self._not_expression())
+        return self._comparison()
+
+    def _comparison(self):
+        expr = self._additive()
+        while True:
+            kind, value, _, _ = self._peek()
+            if kind == "symbol" and value in COMPARISON_OPERATORS:
+                self.pos += 1
+                expr = ("compare", value, expr, self._additive())
+            elif self._is_keyword("IS"):
+                self.pos += 1
+                negate = self._accept_keyword("NOT")
+                self._expect_keyword("NULL")
+                expr = ("is_null", expr, negate)
+            else:
+                return expr
+
+    def _additive(self):
+        expr = self._multiplicative()
+        while self._is_symbol("+") or self._is_symbol("-"):
+            op = self._next()[1]
+            expr = ("arithmetic", op, expr, self._multiplicative())
+        return expr
+
+    def _multiplicative(self):
+        expr = self._unary()
+        while self._is_symbol("*") or self._is_symbol("/") or self._is_symbol("%"):
+            op = self._next()[1]
+            expr = ("arithmetic", op, expr, self._unary())
+        return expr
+
+    def _unary(self):
+        if self._accept_symbol("-"):
+            return ("negate", self._unary())
+        if self._accept_symbol("+"):
+            return self._unary()
+        expr = self._atom()
+        while self._accept_symbol("."):
+            expr = ("property", expr, self._name())
+        return expr
+
+    def _atom(self):
+        kind, value, _, _ = self._next()
+        if kind == "string":
+            return ("literal", _unescape(value[1:-1]))
+        if kind == "number":
+            return ("literal", float(value) if "." in value else int(value))
+        if kind == "parameter":
+            return ("parameter", value[1:])
+        if kind == "symbol" and value == "(":
+            expr = self._expression()
+            self._expect_symbol(")")
+            return expr
+        if kind == "symbol" and value == "[":
+            items = []
+            if not self._accept_symbol("]"):
+                items.append(self._expression())
+                while self._accept_symbol(","):
+                    items.append(self._expression())
+                self._expect_symbol("]")
+            return ("list", items)
+        if kind == "name":
+            upper = value.upper()
+            if upper == "TRUE":
+                return ("literal", True)
+            if upper == "FALSE":
+                return ("literal", False)
+            if upper == "NULL":
+                return ("literal", None)
+            if self._accept_symbol("("):
+                return self._call(value.lower())
+            return ("variable", value)
+        raise ValueError(f"Unexpected token: {value}")
+
+    def _call(self, name):
+        if name == "count" and self._accept_symbol("*"):
+            self._expect_symbol(")")
+            return ("call", name, False, "*")
+        distinct = self._accept_keyword("DISTINCT")
+        args = []
+        if not self._accept_symbol(")"):
+            args.append(self._expression())
+            while self._accept_symbol(","):
+                args.append(self._expression())
+            self._expect_symbol(")")
+        return ("call", name, distinct, args)
+
+
+def _unescape(value):
+    return re.sub(r"\\(.)", lambda m: {"n": "\n", "t": "\t"}.get(m[1], m[1]), value)
+
+
+@lru_cache(maxsize=4096)
+def parse_query(query):
+    # Queries that only differ in their parameters share the parsed clauses
+    return _Parser(query).parse()
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _get_key(value):
+    # Hashable value for DISTINCT and grouping, booleans apart from 0 and 1
+    if isinstance(value, bool):
+        return ("bool", value)
+    if isinstance(value, list):
+        return tuple(_get_key(i) for i in value)
+    return value
+
+
+def _order_key(value):
+    # Null is sorted after everything, values of different types by type
+    if value is None:
+        return (1, 0, 0)
+    if isinstance(value, bool):
+        return (0, 3, value)
+    if _is_number(value):
+        return (0, 4, value)
+    if isinstance(value, str):
+        return (0, 2, value)
+    if isinstance(value, datetime):
+        return (0, 5, value)
+    if isinstance(value, date):
+        return (0, 6, value)
+    if isinstance(value, time):
+        return (0, 7, value)
+    if isinstance(value, list):
+        return (0, 1, [_order_key(i) for i in value])
+    return (0, 0, getattr(value, "element_id", str(value)))
+
+
+def _compare(op, a, b):
+    if a is None or b is None:
+        return None
+    if not (_is_number(a) and _is_number(b)) and type(a) is not type(b):
+        if op == "=":
+            return False
+        if op == "<>":
+            return True
+        return None
+    if op == "=":
+        return a == b
+    if op == "<>":
+        return a != b
+    try:
+        if op == "<":
+            return a < b
+        if op == ">":
+            return a > b
+        if op == "<=":
+            return a <= b
+        return a >= b
+    except TypeError:
+        return None
+
+
+def _arithmetic(op, a, b):
+    if a is None or b is None:
+        return None
+    if op == "+" and (isinstance(a, str) or isinstance(b, str)):
+        return f"{_to_string(a)}{_to_string(b)}"
+    if not (_is_number(a) and _is_number(b)):
+        raise TypeError(f"Cannot apply {op} to {a!r} and {b!r}")
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    if isinstance(a, int) and isinstance(b, int):
+        if b == 0:
+            raise ZeroDivisionError("/ by zero")
+        if op == "/":
+            return int(a / b)
+        return int(math.fmod(a, b))
+    if op == "/":
+        return a / b if b else math.copysign(math.inf, a) if a else math.nan
+    return math.fmod(a, b)
+
+
+def _to_integer(value):
+    if value is None or isinstance(value, int):
+        return None if value is None else int(value)
+    if isinstance(value, float):
+        return int(value) if math.isfinite(value) else None
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return int(float(value))
+            except (ValueError, OverflowError):
+                return None
+    raise TypeError(f"Cannot convert {value!r} to an integer")
+
+
+def _to_float(value):
+    if value is None or isinstance(value, bool):
+        return None
+    if _is_number(value):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    raise TypeError(f"Cannot convert {value!r} to a float")
+
+
+def _to_boolean(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, int):
+        return value != 0
+    if isinstance(value, str):
+        return {"true": True, "false": False}.get(value.strip().lower())
+    raise TypeError(f"Cannot convert {value!r} to a boolean")
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _parse_temporal(parse):
+    def convert(value):
+        if value is None:
+            return None
+        if not isinstance(value, str):
+            value = _to_string(value)
+        try:
+            return parse(value)
+        except ValueError:
+            return None
+
+    return convert
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return _parse_temporal(lambda v: date.fromisoformat(v[:10]))(value)
+
+
+def _to_local_datetime(value):
+    value = _parse_temporal(datetime.fromisoformat)(value)
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+def _size(value):
+    if value is None:
+        return None
+    return len(value)
+
+
+FUNCTIONS = {
+    "tointeger": _to_integer,
+    "tofloat": _to_float,
+    "toboolean": _to_boolean,
+    "tostring": _to_string,
+    "todate": _to_date,
+    "todatetime": _parse_temporal(datetime.fromisoformat),
+    "tolocaldatetime": _to_local_datetime,
+    "totime": _parse_temporal(time.fromisoformat),
+    "tolower": lambda v: None if v is None else v.lower(),
+    "toupper": lambda v: None if v is None else v.upper(),
+    "size": _size,
+    "labels": lambda v: None if v is None else sorted(v.labels),
+    "type": lambda v: None if v is None else v.type,
+    "elementid": lambda v: None if v is None else v.element_id,
+    "id": lambda v: None if v is None else v.index,
+    "coalesce": lambda *v: next((i for i in v if i is not None), None),
+    "rand": random.random,
+}
+
+
+def _evaluate(expr, row, parameters):
+    kind = expr[0]
+    if kind == "literal":
+        return expr[1]
+    if kind == "variable":
+        if expr[1] not in row:
+            raise ValueError(f"Variable `{expr[1]}` not defined")
+        return row[expr[1]]
+    if kind == "property":
+        value = _evaluate(expr[1], row, parameters)
+        if value is None:
+            return None
+        if not isinstance(value, dict):
+            raise TypeError(f"Cannot read property {expr[2]} of {value!r}")
+        return value.get(expr[2])
+    if kind == "parameter":
+        if expr[1] not in parameters:
+            raise ValueError(f"Expected parameter ${expr[1]}")
+        return parameters[expr[1]]
+    if kind == "compare":
+        return _compare(
+            expr[1],
+            _evaluate(expr[2], row, parameters),
+            _evaluate(expr[3], row, parameters),
+        )
+    if kind == "and":
+        a = _evaluate(expr[1], row, parameters)
+        if a is False:
+            return False
+        b = _evaluate(expr[2], row, parameters)
+        if b is False:
+            return False
+        return None if a is None or b is None else True
+    if kind == "or":
+        a = _evaluate(expr[1], row, parameters)
+        if a is True:
+            return True
+        b = _evaluate(expr[2], row, parameters)
+        if b is True:
+            return True
+        return None if a is None or b is None else False
+    if kind == "xor":
+        a = _evaluate(expr[1], row, parameters)
+        b = _evaluate(expr[2], row, parameters)
+        return None if a is None or b is None else a != b
+    if kind == "not":
+        value = _evaluate(expr[1], row, parameters)
+        return None if value is None else not value
+    if kind == "is_null":
+        is_null = _evaluate(expr[1], row, parameters) is None
+        return not is_null if expr[2] else is_null
+    if kind == "arithmetic":
+        return _arithmetic(
+            expr[1],
+            _evaluate(expr[2], row, parameters),
+            _evaluate(expr[3], row, parameters),
+        )
+    if kind == "negate":
+        value = _evaluate(expr[1], row, parameters)
+        return None if value is None else _arithmetic("-", 0, value)
+    if kind == "list":
+        return [_evaluate(i, row, parameters) for i in expr[1]]
+    if kind == "call":
+        name = expr[1]
+        if name in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"Aggregation {name} used outside of WITH or RETURN")
+        if name not in FUNCTIONS:
+            raise ValueError(f"Unknown function {name}")
+        return FUNCTIONS[name](*[_evaluate(i, row, parameters) for i in expr[3]])
+    raise ValueError(f"Unknown expression {kind}")
+
+
+def _map_children(expr, fn):
+    if expr[0] == "call":
+        args = expr[3] if expr[3] == "*" else [fn(i) for i in expr[3]]
+        return ("call", expr[1], expr[2], args)
+    if expr[0] == "list":
+        return ("list", [fn(i) for i in expr[1]])
+    if expr[0] == "literal":
+        return expr
+    return tuple(fn(i) if isinstance(i, tuple) else i for i in expr)
+
+
+def _has_aggregate(expr):
+    if expr[0] == "call" and expr[1] in AGGREGATE_FUNCTIONS:
+        return True
+    found = []
+    _map_children(expr, lambda i: found.append(_has_aggregate(i)) or i)
+    return any(found)
+
+
+def _aggregate(name, values):
+    if name == "count":
+        return len(values)
+    if name == "collect":
+        return values
+    if name == "min":
+        return min(values, key=_order_key) if values else None
+    if name == "max":
+        return max(values, key=_order_key) if values else None
+    if not all(_is_number(i) for i in values):
+        raise TypeError(f"{name.upper()} of a non numeric value")
+    if name == "sum":
+        return sum(values)
+    return sum(values) / len(values) if values else None
+
+
+def _evaluate_aggregates(expr, rows, parameters):
+    # The aggregations of the expression are computed over the rows of the group,
+    # then the rest of it is evaluated on the first row
+    if expr[0] == "call" and expr[1] in AGGREGATE_FUNCTIONS:
+        if expr[3] == "*":
+            return ("literal", len(rows))
+        values = [_evaluate(expr[3][0], row, parameters) for row in rows]
+        values = [i for i in values if i is not None]
+        if expr[2]:
+            seen = set()
+            values = [
+                i
+                for i in values
+                if _get_key(i) not in seen and not seen.add(_get_key(i))
+            ]
+        return ("literal", _aggregate(expr[1], values))
+    return _map_children(expr, lambda i: _evaluate_aggregates(i, rows, parameters))
+
+
+class PropertyGraph:
+    def __init__(self):
+        self.nodes = []
+        self.relationships = []
+        self.label_index = {}
+        # For every node, its relationships by type as (relationship, other node)
+        self.out_edges = []
+        self.in_edges = []
+        # (label, property) -> value -> nodes, built on the first lookup
+        self.property_index = {}
+
+    def add_node(self, element_id, labels, properties):
+        node = PropertyGraphNode(len(self.nodes), element_id, labels, properties)
+        self.nodes.append(node)
+        self.out_edges.append({})
+        self.in_edges.append({})
+        for label in node.labels:
+            self.label_index.setdefault(label, []).append(node)
+        self.property_index = {}
+        return node
+
+    def add_relationship(self, element_id, rel_type, start, end, properties):
+        relationship = PropertyGraphRelationship(
+            len(self.relationships), element_id, rel_type, start, end, properties
+        )
+        self.relationships.append(relationship)
+        self.out_edges[start.index].setdefault(rel_type, []).append((relationship, end))
+        self.in_edges[end.index].setdefault(rel_type, []).append((relationship, start))
+        return relationship
+
+    @classmethod
+    def load(cls, path, properties_info=None):
+        # Export of apoc.export.json, as JSON lines or as a JSON array. With the
+        # schema properties, the temporal properties exported as strings are parsed
+        # so they compare like on the server
+        with open(path, "r") as file:
+            content = file.read()
+        if content.lstrip().startswith("["):
+            items = json.loads(content)
+        else:
+            items = [json.loads(i) for i in content.splitlines() if i.strip()]
+
+        graph = cls()
+        nodes = {}
+        for item in items:
+            if item["type"] == "node":
+                properties = item.get("properties", {})
+                if properties_info:
+                    properties = {
+                        k: _parse_property(v, properties_info.get(k, {}).get("type"))
+                        for k, v in properties.items()
+                    }
+                nodes[str(item["id"])] = graph.add_node(
+                    str(item["id"]), item.get("labels", []), properties
+                )
+        for item in items:
+            if item["type"] == "relationship":
+                graph.add_relationship(
+                    str(item["id"]),
+                    item["label"],
+                    nodes[str(item["start"]["id"])],
+                    nodes[str(item["end"]["id"])],
+                    item.get("properties", {}),
+                )
+        return graph
+
+    def _get_edges(self, node, types, direction):
+        if direction != "in":
+            edges = self.out_edges[node.index]
+            for rel_type in types or edges:
+                yield from edges.get(rel_type, ())
+        if direction != "out":
+            edges = self.in_edges[node.index]
+            for rel_type in types or edges:
+                for relationship, other in edges.get(rel_type, ()):
+                    # A self loop was already matched as an out relationship
+                    if direction == "in" or other is not node:
+                        yield relationship, other
+
+    def _get_property_index(self, label, key):
+        if (label, key) not in self.property_index:
+            index = {}
+            for node in self.label_index.get(label, ()):
+                value = node.get(key)
+                if value is not None:
+                    index.setdefault(_get_key(value), []).append(node)
+            self.property_index[(label, key)] = index
+        return self.property_index[(label, key)]
+
+    def _get_lookup(self, node_pattern, parameters):
+        # The value of an inline WHERE var.key = value, which can use the index
+        var, labels, where = node_pattern
+        if where is None or where[0] != "compare" or where[1] != "=":
+            return None
+        for prop, value in ((where[2], where[3]), (where[3], where[2])):
+            if (
+                prop[0] == "property"
+                and prop[1] == ("variable", var)
+                and value[0] in ("literal", "parameter")
+            ):
+                return prop[2], _evaluate(value, {}, parameters)
+        return None
+
+    def _get_candidates(self, node_pattern, row, parameters):
+        var, labels, where = node_pattern
+        if var is not None and var in row:
+            return (row[var],)
+        if labels:
+            candidates = min((self.label_index.get(i, ()) for i in labels), key=len)
+            lookup = self._get_lookup(node_pattern, parameters)
+            if lookup is not None:
+                key, value = lookup
+                if value is None:
+                    return ()
+                index = self._get_property_index(labels[0], key)
+                return index.get(_get_key(value), ())
+            return candidates
+        return self.nodes
+
+    def _estimate_candidates(self, node_pattern, row):
+        var, labels, where = node_pattern
+        if var is not None and var in row:
+            return 0
+        if labels:
+            return min(len(self.label_index.get(i, ())) for i in labels)
+        return len(self.nodes)
+
+    def _bind_node(self, node_pattern, node, row, parameters):
+        var, labels, where = node_pattern
+        if not isinstance(node, PropertyGraphNode):
+            return None
+        if var is not None and var in row:
+            if row[var] is not node:
+                return None
+        elif var is not None:
+            row = dict(row)
+            row[var] = node
+        if not node.labels.issuperset(labels):
+            return None
+        if where is not None and _evaluate(where, row, parameters) is not True:
+            return None
+        return row
+
+    def _match_chain(self, pattern, row, used, parameters):
+        nodes, rels = pattern
+        # Start from the cheaper end of the chain
+        if self._estimate_candidates(nodes[-1], row) < self._estimate_candidates(
+            nodes[0], row
+        ):
+            flip = {"in": "out", "out": "in", "both": "both"}
+            nodes = nodes[::-1]
+            rels = [(var, types, flip[d]) for var, types, d in rels[::-1]]
+        for node in self._get_candidates(nodes[0], row, parameters):
+            start_row = self._bind_node(nodes[0], node, row, parameters)
+            if start_row is not None:
+                yield from self._expand(
+                    nodes, rels, 0, node, start_row, used, parameters
+                )
+
+    def _expand(self, nodes, rels, i, node, row, used, parameters):
+        if i == len(rels):
+            yield row, used
+            return
+        var, types, direction = rels[i]
+        for relationship, other in self._get_edges(node, types, direction):
+            # Relationship uniqueness within a MATCH
+            if relationship.index in used:
+                continue
+            next_row = row
+            if var is not None:
+                if var in row:
+                    if row[var] is not relationship:
+                        continue
+                else:
+                    next_row = dict(row)
+                    next_row[var] = relationship
+            next_row = self._bind_node(nodes[i + 1], other, next_row, parameters)
+            if next_row is None:
+                continue
+            yield from self._expand(
+                nodes,
+                rels,
+                i + 1,
+                other,
+                next_row,
+                used | {relationship.index},
+                parameters,
+            )
+
+    def _match_patterns(self, patterns, row, used, parameters):
+        if not patterns:
+            yield row
+            return
+        for next_row, next_used in self._match_chain(
+            patterns[0], row, used, parameters
+        ):
+            yield from self._match_patterns(
+                patterns[1:], next_row, next_used, parameters
+            )
+
+    def _project(self, clause, rows, parameters):
+        kind, items, distinct, order, skip, limit = clause
+        if any(_has_aggregate(expr) for _, expr in items):
+            keys = [(name, expr) for name, expr in items if not _has_aggregate(expr)]
+            groups = {}
+            for row in rows:
+                values = [_evaluate(expr, row, parameters) for _, expr in keys]
+                group_key = tuple(_get_key(i) for i in values)
+                if group_key not in groups:
+                    groups[group_key] = (values, [])
+                groups[group_key][1].append(row)
+            if not groups and not keys:
+                groups[()] = ([], [])
+            projected = []
+            for values, group_rows in groups.values():
+                record = dict(zip([name for name, _ in keys], values))
+                for name, expr in items:
+                    if name not in record:
+                        expr = _evaluate_aggregates(expr, group_rows, parameters)
+                        record[name] = _evaluate(
+                            expr, group_rows[0] if group_rows else {}, parameters
+                        )
+                projected.append((record, record))
+            # Put the records back in the order of the items
+            projected = [
+                ({name: record[name] for name, _ in items}, scope)
+                for record, scope in projected
+            ]
+        else:
+            projected = (
+                ({name: _evaluate(expr, row, parameters) for name, expr in items}, row)
+                for row in rows
+            )
+            if order:
+                # ORDER BY can still use the variables that were not projected
+                projected = (
+                    (record, {**scope, **record}) for record, scope in projected
+                )
+        if distinct:
+            projected = self._distinct(projected)
+
+        skip = _evaluate(skip, {}, parameters) if skip is not None else 0
+        limit = _evaluate(limit, {}, parameters) if limit is not None else None
+        if order:
+            projected = self._sort(projected, order, parameters, skip, limit)
+        if skip or limit is not None:
+            projected = itertools.islice(
+                projected, skip, None if limit is None else skip + limit
+            )
+        return (record for record, _ in projected)
+
+    def _distinct(self, projected):
+        seen = set()
+        for record, scope in projected:
+            key = tuple(_get_key(i) for i in record.values())
+            if key not in seen:
+                seen.add(key)
+                yield record, scope
+
+    def _sort(self, projected, order, parameters, skip, limit):
+        if len(order) == 1 and limit is not None:
+            # Top k, e.g. the argmax of ORDER BY ... LIMIT 1
+            expr, descending = order[0]
+            select = heapq.nlargest if descending else heapq.nsmallest
+            return select(
+                skip + limit,
+                projected,
+                key=lambda i: _order_key(_evaluate(expr, i[1], parameters)),
+            )
+        projected = list(projected)
+        for expr, descending in reversed(order):
+            projected.sort(
+                key=lambda i: _order_key(_evaluate(expr, i[1], parameters)),
+                reverse=descending,
+            )
+        return projected
+
+    def run(self, query, parameters=None):
+        return list(self.stream(query, parameters))
+
+    def stream(self, query, parameters=None):
+        # The records of the query as they are computed
+        parameters = parameters or {}
+        return self._run_clauses(parse_query(query), iter([{}]), parameters)
+
+    def _run_clauses(self, clauses, rows, parameters):
+        for clause in clauses:
+            kind = clause[0]
+            if kind == "match":
+                rows = self._run_match(clause[1], rows, parameters)
+            elif kind == "where":
+                rows = self._run_where(clause[1], rows, parameters)
+            elif kind == "unwind":
+                rows = self._run_unwind(clause[1], clause[2], rows, parameters)
+            elif kind == "subquery":
+                rows = self._run_subquery(clause[1], clause[2], rows, parameters)
+            else:
+                rows = self._project(clause, rows, parameters)
+        return rows
+
+    def _run_match(self, patterns, rows, parameters):
+        for row in rows:
+            yield from self._match_patterns(patterns, row, frozenset(), parameters)
+
+    def _run_where(self, expr, rows, parameters):
+        return (row for row in rows if _evaluate(expr, row, parameters) is True)
+
+    def _run_subquery(self, parts, distinct, rows, parameters):
+        for row in rows:
+            records = itertools.chain.from_iterable(
+                self._run_clauses(part, iter([{}]), parameters) for part in parts
+            )
+            if distinct:
+                records = (i for i, _ in self._distinct((i, i) for i in records))
+            for record in records:
+                yield {**row, **record}
+
+    def _run_unwind(self, expr, var, rows, parameters):
+        for row in rows:
+            values = _evaluate(expr, row, parameters)
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                next_row = dict(row)
+                next_row[var] = value
+                yield next_row
+
+
+def _parse_property(value, property_type):
+    if not isinstance(value, str):
+        return value
+    if property_type == "DATE":
+        return _to_date(value) or value
+    if property_type == "DATETIME":
+        return _parse_temporal(datetime.fromisoformat)(value) or value
+    if property_type == "LOCALDATETIME":
+        return _to_local_datetime(value) or value
+    if property_type == "TIME":
+        return _parse_temporal(time.fromisoformat)(value) or value
+    return value
+
+
+class PropertyGraphConnection:
+    # Same interface as Neo4jConnection, the graph is loaded on the first query
+    def __init__(self, path, properties_info=None):
+        self.uri = path
+        self.properties_info = properties_info
+        self.graph = None
+
+    def _get_graph(self):
+        if self.graph is None:
+            self.graph = PropertyGraph.load(self.uri, self.properties_info)
+        return self.graph
+
+    def is_healthy(self):
+        return self._get_graph() is not None
+
+    def close(self):
+        pass
+
+    def query(self, query, parameters=None, shape=None, sample_size=None):
+        # The queries run in process, without timeout, any error is of the query
+        graph = self._get_graph()
+        try:
+            records = graph.stream(query, parameters)
+            if sample_size is not None:
+                return reservoir_sample(records, sample_size)
+            return list(records)
+        except Exception as e:
+            raise QueryError(SYNTAX, e) from e
+
+    def explain(self, query, parameters=None):
+        # No planner estimates, every query is admitted
+        return None
+
+
+class AsyncPropertyGraphConnection:
+    # For the async grounding, the queries run in memory so they do not yield
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def close(self):
+        pass
+
+    async def query(self, query, parameters=None, shape=None, sample_size=None):
+        return self.connection.query(query, parameters, shape, sample_size)
+
+    async def explain(self, query, parameters=None):
+        return None
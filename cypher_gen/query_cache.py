@@ -0,0 +1,116 @@
+import hashlib
+import pickle
+import re
+import sqlite3
+import threading
+
+# Quoted strings are kept as they are, any other run of whitespace is one space
+NORMALIZE_PATTERN = re.compile(r"(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')|\s+")
+
+
+def normalize_query(query):
+    return NORMALIZE_PATTERN.sub(lambda m: m.group(1) or " ", query).strip()
+
+
+class QueryCache:
+    # Results of the queries in a SQLite file, keyed by a hash of the normalized
+    # query, its parameters and a tag of the backend and KG version, so the results
+    # of a KG are never served for another one. Holds at most max_size results, the
+    # least recently used are evicted first. Safe to share between threads
+    def __init__(self, path, tag="", max_size=1000000):
+        self.path = path
+        self.tag = tag
+        self.max_size = max_size
+        # Writes are committed in batches of this size and on close
+        self.commit_interval = 100
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key BLOB PRIMARY KEY, value BLOB, last_used INTEGER) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self.size, last_used = self.db.execute(
+            "SELECT COUNT(*), MAX(last_used) FROM results"
+        ).fetchone()
+        # Logical clock for the recency of the entries
+        self.clock = last_used or 0
+        self.pending_writes = 0
+
+    def __len__(self):
+        return self.size
+
+    def get_key(self, query, parameters=None):
+        key = f"{self.tag}\0{normalize_query(query)}"
+        if parameters:
+            key += f"\0{sorted(parameters.items())!r}"
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def _add_pending_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_interval:
+            self.db.commit()
+            self.pending_writes = 0
+
+    def get(self, key):
+        # The cached results, None on a miss
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.db.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (self.clock, key)
+            )
+            self._add_pending_write()
+        return pickle.loads(row[0])
+
+    def put(self, key, results):
+        value = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.clock += 1
+            # Two threads missing on the same query both put its results
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO results VALUES (?, ?, ?)",
+                (key, value, self.clock),
+            )
+            self.size += cursor.rowcount
+            if self.size > self.max_size:
+                self._evict()
+            self._add_pending_write()
+
+    def _evict(self):
+        # Down to 90% of max_size, so eviction does not run on every insert
+        self.size = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = self.size - int(self.max_size * 0.9)
+        if excess > 0:
+            self.db.execute(
+                "DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self.size -= excess
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0
+        return (
+            f"Query cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1f}% hit rate), {self.size} cached results"
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,51 @@
+import threading
+from collections import deque
+
+
+class AdaptiveTimeouts:
+    # Timeout of the grounding queries of every pattern shape, from the latencies
+    # observed so far for that shape: a high quantile of the recent latencies times
+    # a margin, within [min_timeout, max_timeout]. Until min_samples latencies are
+    # observed the shape gets default_timeout. A timed out query counts with the
+    # timeout as its latency, so shapes that keep timing out get longer timeouts
+    # up to max_timeout
+    def __init__(self, default_timeout=10, min_timeout=1, max_timeout=60):
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.quantile = 0.95
+        self.margin = 2.0
+        self.min_samples = 20
+        self.window = 200
+        self.latencies = {}
+        self.timeouts = {}
+        self.num_timeouts = 0
+        self.lock = threading.Lock()
+
+    def get_timeout(self, shape):
+        return self.timeouts.get(shape, self.default_timeout)
+
+    def observe(self, shape, latency, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.num_timeouts += 1
+            if shape not in self.latencies:
+                self.latencies[shape] = deque(maxlen=self.window)
+            latencies = self.latencies[shape]
+            latencies.append(latency)
+            if len(latencies) >= self.min_samples:
+                ordered = sorted(latencies)
+                value = ordered[int(self.quantile * (len(ordered) - 1))]
+                self.timeouts[shape] = min(
+                    self.max_timeout, max(self.min_timeout, self.margin * value)
+                )
+
+    def report(self):
+        if not self.timeouts:
+            return f"Adaptive timeouts: {self.num_timeouts} timed out queries"
+        timeouts = sorted(self.timeouts.values())
+        return (
+            f"Adaptive timeouts: {self.num_timeouts} timed out queries, "
+            f"{len(timeouts)} shapes with timeouts from {timeouts[0]:.2f}s "
+            f"to {timeouts[-1]:.2f}s"
+        )
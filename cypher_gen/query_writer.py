@@ -1,3 +1,4 @@
+import re
 from graph import Graph
 from utils import CYPHER_DATATYPES
 
@@ -10,6 +11,10 @@ class CypherQueryWriter:
         self.cast_modifiers = False
         self.use_target_subreference = True
         self.use_domain_for_nl_rel_direction = False
+        # Write the grounded values as $p parameters instead of literals, so queries
+        # with the same structure share their text and their cached plan
+        self.parameterize = False
+        self.parameters = {}
 
     def set_nl_provider(self, provider):
         self.nl_provider = provider
@@ -45,8 +50,25 @@ class CypherQueryWriter:
 
         return [line]
 
+    def _get_literal(self, value, quoted=False):
+        if not self.parameterize:
+            return f'"{value}"' if quoted else f"{value}"
+        if quoted:
+            parameter = str(value)
+        elif re.fullmatch(r"-?\d+", str(value)):
+            parameter = int(value)
+        elif re.fullmatch(r"-?\d+\.\d+", str(value)):
+            parameter = float(value)
+        else:
+            # Not a number, keep the literal so the query means the same thing
+            return f"{value}"
+        name = f"p{len(self.parameters)}"
+        self.parameters[name] = parameter
+        return f"${name}"
+
     def _get_entity_ground_clause(self, node):
-        return f'WHERE x{node.id}.{node.attribute} = "{node.grounded_entity}"'
+        value = self._get_literal(node.grounded_entity, quoted=True)
+        return f"WHERE x{node.id}.{node.attribute} = {value}"
 
     def _get_triplet_chain_lines_recursive(self, chain_line, node, relation):
         query_lines = []
@@ -119,31 +141,27 @@ class CypherQueryWriter:
         lines = []
         if node.modifier.startswith("count") and node.modifier != "count":
             line1 = f"WITH x{self.graph.answer_node.id}, COUNT(x{node.id}.{node.attribute}) as z{node.id}"
-            line2 = f"WHERE z{node.id} {node.modifier[len('count'):]} {node.grounded_entity}"
+            line2 = f"WHERE z{node.id} {node.modifier[len('count'):]} {self._get_literal(node.grounded_entity)}"
             lines += [line1, line2]
         elif node.modifier.startswith("sum") and node.modifier != "sum":
             if self.cast_modifiers:
                 line1 = f"WITH x{self.graph.answer_node.id}, SUM({CYPHER_DATATYPES[node.datatype]}(x{node.id}.{node.attribute})) as z{node.id}"
             else:
                 line1 = f"WITH x{self.graph.answer_node.id}, SUM(x{node.id}.{node.attribute}) as z{node.id}"
-            line2 = (
-                f"WHERE z{node.id} {node.modifier[len('sum'):]} {node.grounded_entity}"
-            )
+            line2 = f"WHERE z{node.id} {node.modifier[len('sum'):]} {self._get_literal(node.grounded_entity)}"
             lines += [line1, line2]
         elif node.modifier.startswith("avg") and node.modifier != "avg":
             if self.cast_modifiers:
                 line1 = f"WITH x{self.graph.answer_node.id}, AVG({CYPHER_DATATYPES[node.datatype]}(x{node.id}.{node.attribute})) as z{node.id}"
             else:
                 line1 = f"WITH x{self.graph.answer_node.id}, AVG(x{node.id}.{node.attribute}) as z{node.id}"
-            line2 = (
-                f"WHERE z{node.id} {node.modifier[len('avg'):]} {node.grounded_entity}"
-            )
+            line2 = f"WHERE z{node.id} {node.modifier[len('avg'):]} {self._get_literal(node.grounded_entity)}"
             lines += [line1, line2]
         elif node.modifier in ("<", ">", "=", "<=", ">="):
             if self.cast_modifiers:
-                line1 = f"WHERE {CYPHER_DATATYPES[node.datatype]}(x{node.id}.{node.attribute}) {node.modifier} {node.grounded_entity}"
+                line1 = f"WHERE {CYPHER_DATATYPES[node.datatype]}(x{node.id}.{node.attribute}) {node.modifier} {self._get_literal(node.grounded_entity)}"
             else:
-                line1 = f'WHERE x{node.id}.{node.attribute} {node.modifier} "{node.grounded_entity}"'
+                line1 = f"WHERE x{node.id}.{node.attribute} {node.modifier} {self._get_literal(node.grounded_entity, quoted=True)}"
             lines += [line1]
 
         return lines
@@ -164,6 +182,39 @@ class CypherQueryWriter:
 
         return lines
 
+    def write_parameterized_query(self):
+        self.parameterize = True
+        self.parameters = {}
+        query = self.write_query()
+        self.parameterize = False
+        return query, self.parameters
+
+    def write_grounding_query(self, projections=None, sample_size=None, candidate=None):
+        # Query of the matches of the pattern the grounder picks the entities from,
+        # the MATCH lines of the pattern without the modifiers and every node
+        # returned. projections maps the node ids to the properties returned as a
+        # list of their values instead of the whole node. With a sample_size a
+        # random sample of the matches is returned, with a candidate number it is
+        # also returned in the candidate column. Returns the query and its
+        # parameters
+        self.parameters = {}
+        query_lines = self._get_triplet_chain_lines()
+
+        returns = []
+        if candidate is not None:
+            returns.append(f"{candidate} AS candidate")
+        for node in self.graph.nodes:
+            if projections is None:
+                returns.append(f"x{node.id}")
+            else:
+                values = ", ".join(f"x{node.id}.{i}" for i in projections[node.id])
+                returns.append(f"[{values}] AS x{node.id}")
+        query_lines.append("RETURN " + ", ".join(returns))
+
+        if sample_size is not None:
+            query_lines += ["ORDER BY rand()", f"LIMIT {sample_size}"]
+        return "\n".join(query_lines), self.parameters
+
     def write_query(self):
         query_lines = []
 
@@ -417,3 +468,21 @@ class CypherQueryWriter:
 
         proto_nl = self._proto_nl_to_str(proto_nl)
         return proto_nl
+
+
+def write_batched_grounding_query(graphs, projections=None, sample_size=None):
+    # Grounding query of several candidate groundings of the same pattern, which only
+    # differ in their classes and relations. The query of every candidate is a
+    # UNION ALL branch of a CALL subquery, with its own sample, and the candidate
+    # column of the records is the index of its graph. The grounding queries of
+    # graphs without grounded entities have no parameters
+    branches = []
+    for candidate, graph in enumerate(graphs):
+        query, _ = CypherQueryWriter(graph).write_grounding_query(
+            projections, sample_size, candidate
+        )
+        branches.append(query)
+    columns = ["candidate"] + [f"x{node.id}" for node in graphs[0].nodes]
+    query_lines = ["CALL {", "\nUNION ALL\n".join(branches), "}"]
+    query_lines.append("RETURN " + ", ".join(columns))
+    return "\n".join(query_lines)
@@ -0,0 +1,31 @@
+import random
+
+
+def reservoir_sample(records, sample_size):
+    # Uniform random sample of at most sample_size of the records, read once from
+    # an iterable such as a streamed cursor, so at most sample_size of them are kept
+    # in memory. Fewer records than sample_size are all kept, in their order
+    sample = []
+    for i, record in enumerate(records):
+        if i < sample_size:
+            sample.append(record)
+            continue
+        j = random.randint(0, i)
+        if j < sample_size:
+            sample[j] = record
+    return sample
+
+
+async def reservoir_sample_async(records, sample_size):
+    # Same as reservoir_sample, over an async iterable
+    sample = []
+    i = 0
+    async for record in records:
+        if i < sample_size:
+            sample.append(record)
+        else:
+            j = random.randint(0, i)
+            if j < sample_size:
+                sample[j] = record
+        i += 1
+    return sample
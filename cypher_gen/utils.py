@@ -1,6 +1,36 @@
-from neo4j import GraphDatabase
-from neo4j.exceptions import SessionError
-from graph import Node, Relation, Graph
+import time
+from neo4j import (
+    GraphDatabase,
+    AsyncGraphDatabase,
+    READ_ACCESS,
+    WRITE_ACCESS,
+    unit_of_work,
+)
+from neo4j.exceptions import (
+    Neo4jError,
+    SessionError,
+    ServiceUnavailable,
+    SessionExpired,
+    TransientError,
+)
+import neo4j.graph
+from graph import Node, Graph
+from property_graph import (
+    PropertyGraphConnection,
+    AsyncPropertyGraphConnection,
+    PropertyGraphNode,
+    PropertyGraphRelationship,
+)
+from query_cache import QueryCache
+from reservoir import reservoir_sample, reservoir_sample_async
+from resilience import (
+    RetryPolicy,
+    CircuitBreaker,
+    QueryError,
+    TRANSIENT,
+    TIMEOUT,
+    SYNTAX,
+)
 
 CYPHER_DATATYPES = {
     "INTEGER": "toInteger",
@@ -29,27 +59,416 @@ CYPHER_MODIFIER_DATE_TYPES = {
 }
 
 
+def _read_records(tx, query, parameters, sample_size=None):
+    # The records are streamed in batches of fetch_size, with a sample_size only a
+    # sample of them is kept
+    result = tx.run(query, parameters)
+    if sample_size is not None:
+        return reservoir_sample(result, sample_size)
+    return [record for record in result]
+
+
+def _to_cacheable(value):
+    # Driver records and graph objects cannot be pickled, they are stored as dicts
+    # and the nodes and relationships of the in-process graph, which have the same
+    # interface
+    if isinstance(value, neo4j.graph.Node):
+        return PropertyGraphNode(None, value.element_id, value.labels, dict(value))
+    if isinstance(value, neo4j.graph.Relationship):
+        return PropertyGraphRelationship(
+            None,
+            value.element_id,
+            value.type,
+            _to_cacheable(value.start_node),
+            _to_cacheable(value.end_node),
+            dict(value),
+        )
+    if isinstance(value, neo4j.graph.Path):
+        return [_to_cacheable(i) for i in value]
+    if isinstance(value, list):
+        return [_to_cacheable(i) for i in value]
+    if isinstance(value, dict):
+        return {k: _to_cacheable(v) for k, v in value.items()}
+    return value
+
+
+def _to_cacheable_records(records):
+    return [{k: _to_cacheable(v) for k, v in i.items()} for i in records]
+
+
+def _get_timeout(connection, shape):
+    if shape is None or connection.adaptive_timeouts is None:
+        return connection.timeout
+    return connection.adaptive_timeouts.get_timeout(shape)
+
+
+def _observe_latency(connection, shape, latency, error=None):
+    # Only the successful and the timed out queries tell about the latency
+    if shape is None or connection.adaptive_timeouts is None:
+        return
+    if error is None:
+        connection.adaptive_timeouts.observe(shape, latency)
+    elif error.kind == TIMEOUT:
+        connection.adaptive_timeouts.observe(shape, latency, timed_out=True)
+
+
+def classify_neo4j_error(error):
+    if isinstance(error, Neo4jError) and error.code and "TimedOut" in error.code:
+        return TIMEOUT
+    if isinstance(error, (ServiceUnavailable, SessionExpired, TransientError)):
+        return TRANSIENT
+    if isinstance(error, OSError):
+        return TRANSIENT
+    return SYNTAX
+
+
+def _get_plan_estimates(plan):
+    # Estimated rows of the result, and as the cost of the query the estimated rows
+    # summed over all the operators of the plan
+    cost = 0
+    operators = [plan]
+    while operators:
+        operator = operators.pop()
+        cost += operator["args"].get("EstimatedRows", 0)
+        operators.extend(operator.get("children", []))
+    return {"rows": plan["args"].get("EstimatedRows", 0), "cost": cost}
+
+
 class Neo4jConnection:
     def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        self.uri = uri
+        self.auth = (user, password)
+        self.timeout = 10
 
-    def close(self):
-        self.driver.close()
+        # The driver is created on the first query, so these can be set before
+        self.max_connection_pool_size = 100
+        self.fetch_size = 1000
+        self.read_only = False
+        # Run the queries as transaction functions on one long lived session
+        # instead of opening a session and a transaction per query
+        self.reuse_session = False
+        # Retries of the transient errors, and a circuit breaker pausing the
+        # queries while the server is unreachable
+        self.retry_policy = RetryPolicy(
+            classify_neo4j_error, CircuitBreaker(self.is_healthy)
+        )
+        # QueryCache of the results, they are then returned as dicts
+        self.cache = None
+        # AdaptiveTimeouts of the queries given a shape
+        self.adaptive_timeouts = None
+
+        self.driver = None
+        self.session = None
+
+    def _get_driver(self):
+        if self.driver is None:
+            self.driver = GraphDatabase.driver(
+                self.uri,
+                auth=self.auth,
+                max_connection_pool_size=self.max_connection_pool_size,
+            )
+        return self.driver
+
+    def _open_session(self):
+        return self._get_driver().session(
+            default_access_mode=READ_ACCESS if self.read_only else WRITE_ACCESS,
+            fetch_size=self.fetch_size,
+        )
 
-    def query(self, query, parameters=None):
-        with self.driver.session() as session:
+    def _close_session(self):
+        if self.session is not None:
             try:
-                with session.begin_transaction(timeout=10) as tx:
-                    result = tx.run(query, parameters)
-                    return [record for record in result]
-            except SessionError as e:
-                return []
+                self.session.close()
+            except Exception as e:
+                pass
+            self.session = None
+
+    def close(self):
+        self._close_session()
+        if self.driver is not None:
+            self.driver.close()
+            self.driver = None
+
+    def is_healthy(self):
+        try:
+            self._get_driver().verify_connectivity()
+            return True
+        except (ServiceUnavailable, SessionExpired) as e:
+            return False
+
+    def reconnect(self):
+        # New driver and session, raises if the server is still unreachable
+        try:
+            self.close()
+        except Exception as e:
+            self.driver = None
+        self._get_driver().verify_connectivity()
+
+    def _run_query(self, query, parameters, timeout, sample_size):
+        if self.reuse_session:
+            if self.session is None or self.session.closed():
+                self.session = self._open_session()
+            work = unit_of_work(timeout=timeout)(_read_records)
+            if self.read_only:
+                return self.session.execute_read(work, query, parameters, sample_size)
+            return self.session.execute_write(work, query, parameters, sample_size)
+        with self._open_session() as session:
+            with session.begin_transaction(timeout=timeout) as tx:
+                return _read_records(tx, query, parameters, sample_size)
+
+    def query(self, query, parameters=None, shape=None, sample_size=None):
+        # shape names the kind of query for the adaptive timeouts, if any. With a
+        # sample_size the results are a random sample of at most that many records,
+        # which is not cached so a rerun draws another one
+        cached = self.cache is not None and sample_size is None
+        if cached:
+            key = self.cache.get_key(query, parameters)
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        timeout = _get_timeout(self, shape)
+        start = time.monotonic()
+        try:
+            results = self.retry_policy.call(
+                self._attempt_query, query, parameters, timeout, sample_size
+            )
+        except QueryError as e:
+            _observe_latency(self, shape, timeout, e)
+            raise e
+        _observe_latency(self, shape, time.monotonic() - start)
+        if cached:
+            results = _to_cacheable_records(results)
+            self.cache.put(key, results)
+        return results
+
+    def _explain(self, query, parameters):
+        with self._open_session() as session:
+            summary = session.run(f"EXPLAIN {query}", parameters).consume()
+        return _get_plan_estimates(summary.plan)
+
+    def explain(self, query, parameters=None):
+        # Planner estimates of the query, which is not run
+        return self.retry_policy.call(self._explain, query, parameters)
+
+    def _attempt_query(self, query, parameters, timeout, sample_size):
+        try:
+            return self._run_query(query, parameters, timeout, sample_size)
+        except SessionError as e:
+            return []
+        except (ServiceUnavailable, SessionExpired) as e:
+            # Dropped connection, not an empty result. The next attempt runs on a
+            # new driver, reconnect raises as well if the server is unreachable
+            self.reconnect()
+            raise e
+
+
+class AsyncNeo4jConnection:
+    # Neo4jConnection on the async driver. Every query gets a session from the
+    # pool, so many of them can be in flight on the same event loop
+    def __init__(self, uri, user, password):
+        self.uri = uri
+        self.auth = (user, password)
+        self.timeout = 10
+
+        # The driver is created on the first query, so these can be set before
+        self.max_connection_pool_size = 100
+        self.fetch_size = 1000
+        self.read_only = False
+        # Shared with the blocking connection by configure_backend, so they pause
+        # together and the health check can block
+        self.retry_policy = RetryPolicy(classify_neo4j_error)
+        self.cache = None
+        self.adaptive_timeouts = None
+
+        self.driver = None
+
+    def _get_driver(self):
+        if self.driver is None:
+            self.driver = AsyncGraphDatabase.driver(
+                self.uri,
+                auth=self.auth,
+                max_connection_pool_size=self.max_connection_pool_size,
+            )
+        return self.driver
+
+    async def close(self):
+        if self.driver is not None:
+            await self.driver.close()
+            self.driver = None
+
+    async def reconnect(self):
+        try:
+            await self.close()
+        except Exception as e:
+            self.driver = None
+        await self._get_driver().verify_connectivity()
+
+    def _open_session(self):
+        return self._get_driver().session(
+            default_access_mode=READ_ACCESS if self.read_only else WRITE_ACCESS,
+            fetch_size=self.fetch_size,
+        )
+
+    async def _run_query(self, query, parameters, timeout, sample_size):
+        async with self._open_session() as session:
+            async with await session.begin_transaction(timeout=timeout) as tx:
+                result = await tx.run(query, parameters)
+                if sample_size is not None:
+                    return await reservoir_sample_async(result, sample_size)
+                return [record async for record in result]
+
+    async def query(self, query, parameters=None, shape=None, sample_size=None):
+        cached = self.cache is not None and sample_size is None
+        if cached:
+            key = self.cache.get_key(query, parameters)
+            results = self.cache.get(key)
+            if results is not None:
+                return results
+        timeout = _get_timeout(self, shape)
+        start = time.monotonic()
+        try:
+            results = await self.retry_policy.call_async(
+                self._attempt_query, query, parameters, timeout, sample_size
+            )
+        except QueryError as e:
+            _observe_latency(self, shape, timeout, e)
+            raise e
+        # Wall time, it includes the other tasks running on the event loop
+        _observe_latency(self, shape, time.monotonic() - start)
+        if cached:
+            results = _to_cacheable_records(results)
+            self.cache.put(key, results)
+        return results
+
+    async def _explain(self, query, parameters):
+        async with self._open_session() as session:
+            result = await session.run(f"EXPLAIN {query}", parameters)
+            summary = await result.consume()
+        return _get_plan_estimates(summary.plan)
+
+    async def explain(self, query, parameters=None):
+        return await self.retry_policy.call_async(self._explain, query, parameters)
+
+    async def _attempt_query(self, query, parameters, timeout, sample_size):
+        try:
+            return await self._run_query(query, parameters, timeout, sample_size)
+        except SessionError as e:
+            return []
+        except (ServiceUnavailable, SessionExpired) as e:
+            await self.reconnect()
+            raise e
+
+
+def add_neo4j_arguments(parser):
+    parser.add_argument(
+        "--neo4j-reuse-session",
+        action="store_true",
+        help="Run all the queries on one long lived session instead of a session per query",
+    )
+    parser.add_argument(
+        "--neo4j-read-only",
+        action="store_true",
+        help="Open the neo4j sessions in read access mode",
+    )
+    parser.add_argument(
+        "--neo4j-pool-size",
+        type=int,
+        default=100,
+        help="Max number of connections in the neo4j driver pool",
+    )
+    parser.add_argument(
+        "--neo4j-fetch-size",
+        type=int,
+        default=1000,
+        help="Number of records fetched from neo4j per batch",
+    )
+    parser.add_argument(
+        "--max-query-retries",
+        type=int,
+        default=3,
+        help="Retries of a query failing on a transient neo4j error, with exponential backoff",
+    )
+    parser.add_argument(
+        "--max-backend-pause",
+        type=int,
+        default=600,
+        help="Seconds to wait for an unreachable neo4j server before stopping the run",
+    )
+
+
+def configure_neo4j(connection, args):
+    # Also used for AsyncNeo4jConnection, which ignores reuse_session
+    connection.reuse_session = args.neo4j_reuse_session
+    connection.read_only = args.neo4j_read_only
+    connection.max_connection_pool_size = args.neo4j_pool_size
+    connection.fetch_size = args.neo4j_fetch_size
+    connection.retry_policy.max_retries = args.max_query_retries
+    if connection.retry_policy.circuit_breaker is not None:
+        connection.retry_policy.circuit_breaker.max_pause = args.max_backend_pause
+
+
+def add_backend_arguments(parser):
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["neo4j", "memory"],
+        default="neo4j",
+        help="Run the queries on the neo4j server or in process on the --graph-file export",
+    )
+    parser.add_argument(
+        "--graph-file",
+        type=str,
+        help="apoc.export.json file of the graph for --backend memory",
+    )
+    parser.add_argument(
+        "--query-cache",
+        type=str,
+        help="SQLite file caching the results of the neo4j queries across runs",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=1000000,
+        help="Max number of cached query results, the least recently used are evicted",
+    )
+    parser.add_argument(
+        "--query-cache-tag",
+        type=str,
+        default="",
+        help="Version of the KG, change it to invalidate the cache after updating the graph",
+    )
+    add_neo4j_arguments(parser)
+
+
+def configure_backend(grounder, args):
+    if args.backend == "memory":
+        if not args.graph_file:
+            raise ValueError("--backend memory needs a --graph-file")
+        connection = PropertyGraphConnection(args.graph_file, grounder.properties_info)
+        grounder.backend = connection
+        grounder.async_backend = AsyncPropertyGraphConnection(connection)
+    else:
+        configure_neo4j(grounder.backend, args)
+        grounder.async_backend.retry_policy = grounder.backend.retry_policy
+        configure_neo4j(grounder.async_backend, args)
+    if not grounder.backend.is_healthy():
+        raise ConnectionError(f"Unable to reach the graph at {grounder.backend.uri}")
+    if args.query_cache and args.backend == "neo4j":
+        grounder.query_cache = QueryCache(
+            args.query_cache,
+            get_neo4j_cache_tag(grounder.backend, args.query_cache_tag),
+            args.query_cache_size,
+        )
+        grounder.backend.cache = grounder.query_cache
+        grounder.async_backend.cache = grounder.query_cache
 
 
-def get_node(nodes, id):
-    for n in nodes:
-        if n.id == id:
-            return n
+def get_neo4j_cache_tag(connection, tag):
+    # The node and relationship counts come from the count store, so they are cheap
+    # and most updates of the KG change them
+    num_nodes = connection.query("MATCH (n) RETURN count(n) AS count")[0]["count"]
+    num_rels = connection.query("MATCH ()-[r]->() RETURN count(r) AS count")[0]["count"]
+    return f"neo4j|{connection.uri}|{num_nodes}|{num_rels}|{tag}"
 
 
 def build_cypher_graph(graph, entity_mapping):
@@ -72,14 +491,7 @@ def build_cypher_graph(graph, entity_mapping):
         gr.nodes.append(n)
     gr.answer_node = gr.nodes[0]
     for relation in graph["relations"]:
-        in_node = get_node(gr.nodes, relation["in_node_id"])
-        out_node = get_node(gr.nodes, relation["out_node_id"])
-        rel = Relation(
-            in_node,
-            out_node,
+        gr.add_relation(
+            relation["in_node_id"], relation["out_node_id"], relation["rel_type"]
         )
-        rel.rel_type = relation["rel_type"]
-        gr.relations.append(rel)
-        in_node.out_relations.append(rel)
-        out_node.in_relations.append(rel)
     return gr
@@ -0,0 +1,56 @@
+import os
+import struct
+from array import array
+from collections import OrderedDict
+
+CACHE_MAGIC = b"SPOTACHE"
+CACHE_VERSION = 1
+# magic, version, number of fingerprints
+CACHE_HEADER = struct.Struct("<8sHQ")
+
+
+class AssignmentCache:
+    # Fingerprints of the assignments the grounder already tried, bounded to
+    # max_size entries with the least recently seen evicted first
+    def __init__(self, max_size=500000):
+        self.max_size = max_size
+        self.fingerprints = OrderedDict()
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self.fingerprints
+
+    def check_and_add(self, fingerprint):
+        # True if the fingerprint was already in the cache
+        if fingerprint in self.fingerprints:
+            self.fingerprints.move_to_end(fingerprint)
+            return True
+        self.fingerprints[fingerprint] = None
+        if len(self.fingerprints) > self.max_size:
+            self.fingerprints.popitem(last=False)
+        return False
+
+    def save(self, path):
+        # Oldest first, so loading keeps the eviction order
+        fingerprints = array("Q", self.fingerprints)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(fingerprints)))
+            file.write(fingerprints.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_size=500000):
+        with open(path, "rb") as file:
+            data = file.read()
+        magic, version, count = CACHE_HEADER.unpack_from(data, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError(f"Not an assignment cache: {path}")
+        fingerprints = array("Q")
+        fingerprints.frombytes(data[CACHE_HEADER.size : CACHE_HEADER.size + 8 * count])
+        cache = cls(max_size)
+        for fingerprint in fingerprints[-max_size:]:
+            cache.fingerprints[fingerprint] = None
+        return cache
@@ -0,0 +1,130 @@
+class RelationAssignmentSampler:
+    # Counts, for every (class, subtree shape), how many schema valid relation and
+    # class assignments the subtree has. The grounder samples relations
+    # proportionally to those counts, which given the class of a node draws uniformly
+    # among the valid assignments of its subtree, so schema dead ends never happen.
+    #
+    # A shape is the sorted tuple of the branches of a node, a branch being
+    # (direction, modifier, shape id of the child) with direction 0 for an in
+    # relation and 1 for an out relation. Shapes are interned to ids so they can be
+    # shared by all the patterns.
+    def __init__(
+        self,
+        relation_index,
+        relations_info,
+        inverse_relations,
+        classes,
+        get_modifier_suitable_relations,
+    ):
+        self.relation_index = relation_index
+        self.relations_info = relations_info
+        self.inverse_relations = inverse_relations
+        self.classes = classes
+        self.get_modifier_suitable_relations = get_modifier_suitable_relations
+        self.shape_ids = {}
+        self.shapes = []
+        self.counts = {}
+        self.branches = {}
+        self.valid_classes = {}
+        self.node_shapes = []
+        self.relation_weights = None
+
+    def set_relation_weights(self, relation_weights):
+        # Every assignment is weighted by the product of the weights of its
+        # relations, the memoized counts depend on them so they are dropped
+        self.relation_weights = relation_weights
+        self.counts = {}
+        self.branches = {}
+        self.valid_classes = {}
+
+    def _get_relation_weight(self, relation):
+        if self.relation_weights is None:
+            return 1
+        return self.relation_weights.get(relation, 0)
+
+    def _intern_shape(self, shape):
+        if shape not in self.shape_ids:
+            self.shape_ids[shape] = len(self.shapes)
+            self.shapes.append(shape)
+        return self.shape_ids[shape]
+
+    def _get_subtree_shape(self, node, relation=None):
+        branches = []
+        for rel in node.in_relations:
+            if rel is not relation:
+                child_shape_id = self._get_subtree_shape(rel.in_node, rel)
+                branches.append((0, rel.in_node.modifier or "", child_shape_id))
+        for rel in node.out_relations:
+            if rel is not relation:
+                child_shape_id = self._get_subtree_shape(rel.out_node, rel)
+                branches.append((1, rel.out_node.modifier or "", child_shape_id))
+        shape_id = self._intern_shape(tuple(sorted(branches)))
+        self.node_shapes[node.id] = shape_id
+        return shape_id
+
+    def set_graph(self, graph):
+        self.node_shapes = [None for _ in graph.nodes]
+        return self._get_subtree_shape(graph.answer_node)
+
+    def _get_target_attribute(self, relation, attribute, in_rel):
+        # Same resolution as SPARQLGraphGrounder._ground_rel, None when the relation
+        # would need an inverse that the schema does not have
+        is_domain = self.relations_info[relation]["domain"].startswith(attribute)
+        if (is_domain and in_rel) or (not is_domain and not in_rel):
+            if relation not in self.inverse_relations:
+                return None
+        if is_domain:
+            return self.relations_info[relation]["range"]
+        return self.relations_info[relation]["domain"]
+
+    def _get_branch(self, attribute, direction, modifier, shape_id):
+        key = (attribute, direction, modifier, shape_id)
+        if key not in self.branches:
+            candidates = self.relation_index.get_relations(attribute)
+            if modifier:
+                candidates = self.get_modifier_suitable_relations(
+                    attribute, candidates, modifier
+                )
+            relations = []
+            weights = []
+            for relation in candidates:
+                target = self._get_target_attribute(relation, attribute, direction == 0)
+                if target is None:
+                    continue
+                weight = self._get_relation_weight(relation) * self.count(
+                    target, shape_id
+                )
+                if weight > 0:
+                    relations.append(relation)
+                    weights.append(weight)
+            self.branches[key] = (relations, weights)
+        return self.branches[key]
+
+    def count(self, attribute, shape_id):
+        key = (attribute, shape_id)
+        if key not in self.counts:
+            total = 1
+            for direction, modifier, child_shape_id in self.shapes[shape_id]:
+                _, weights = self._get_branch(
+                    attribute, direction, modifier, child_shape_id
+                )
+                total *= sum(weights)
+                if total == 0:
+                    break
+            self.counts[key] = total
+        return self.counts[key]
+
+    def get_valid_classes(self, shape_id):
+        if shape_id not in self.valid_classes:
+            self.valid_classes[shape_id] = {
+                i for i in self.classes if self.count(i, shape_id) > 0
+            }
+        return self.valid_classes[shape_id]
+
+    def get_relation_weights(self, attribute, target_node, in_rel=False):
+        return self._get_branch(
+            attribute,
+            0 if in_rel else 1,
+            target_node.modifier or "",
+            self.node_shapes[target_node.id],
+        )
@@ -1,16 +1,17 @@
 import argparse
 import pandas as pd
 from ast import literal_eval
-from graph import Node, Relation, Graph
+from graph import Node, Graph
 from query_writer import SPARQLQueryWriter
 from nl_provider import JsonSchemaSPARQLNLProvider
 from generate_batch import get_graph_string
 from grounder import SPARQLGraphGrounder
+from sparql_client import add_sparql_arguments, configure_sparql
+from resilience import QueryError, BackendUnavailableError
 import random
 import csv
 from tqdm import tqdm
 import itertools
-import copy
 
 
 def compose_sample_to_save(graph, nl_provider, id):
@@ -33,12 +34,6 @@ def compose_sample_to_save(graph, nl_provider, id):
     return sample
 
 
-def get_node(nodes, id):
-    for n in nodes:
-        if n.id == id:
-            return n
-
-
 def build_graph(graph, entity_mapping):
     gr = Graph()
     gr.entity_mapping = entity_mapping
@@ -54,16 +49,9 @@ def build_graph(graph, entity_mapping):
         gr.nodes.append(n)
     gr.answer_node = gr.nodes[0]
     for relation in graph["relations"]:
-        in_node = get_node(gr.nodes, relation["in_node_id"])
-        out_node = get_node(gr.nodes, relation["out_node_id"])
-        rel = Relation(
-            in_node,
-            out_node,
+        gr.add_relation(
+            relation["in_node_id"], relation["out_node_id"], relation["rel_type"]
         )
-        rel.rel_type = relation["rel_type"]
-        gr.relations.append(rel)
-        in_node.out_relations.append(rel)
-        out_node.in_relations.append(rel)
     return gr
 
 
@@ -111,6 +99,14 @@ def get_all_inside_nodes_comb_sparql(gr, node_id):
     return all_combinations
 
 
+def copy_graph_info_sparql(graph):
+    # The graph dicts only hold scalars, so a two level copy is enough
+    new_graph = dict(graph)
+    new_graph["nodes"] = [dict(node) for node in graph["nodes"]]
+    new_graph["relations"] = [dict(rel) for rel in graph["relations"]]
+    return new_graph
+
+
 def remove_nodes_from_graph_sparql(graph, nodes):
     graph["nodes"] = [i for i in graph["nodes"] if i["id"] in nodes]
     graph["relations"] = [
@@ -153,7 +149,7 @@ def get_decomposed_graphs_sparql(gr, graph, ent_map):
     trimmed_graphs = []
     new_ent_maps = []
     for comb in combs:
-        new_graph = copy.deepcopy(graph)
+        new_graph = copy_graph_info_sparql(graph)
         new_graph = remove_nodes_from_graph_sparql(new_graph, comb)
         new_graph = remap_nodes_numbers_sparql(new_graph)
         new_ent_map = get_new_ent_map_sparql(new_graph, ent_map)
@@ -193,18 +189,30 @@ def ground_new_graph(graph, graph_info, grounder):
     query = "\n".join(query)
     try:
         res = grounder._execute_query(query)
-    except:
+    except QueryError as e:
         return graph, graph_info, False
     if len(res) == 0:
         return graph, graph_info, False
     res = random.choice(res)
 
+    # The label and datatype queries of all the nodes run concurrently
+    node_queries = {}
+    for node in nodes_to_ground:
+        if not node.attribute.startswith("type"):
+            node_queries[node.id] = grounder.sparql.submit(
+                grounder._query_label, res[f"x{node.id}"]
+            )
+        else:
+            node_queries[node.id] = grounder.sparql.submit(
+                grounder._query_node_datatype, node
+            )
+
     is_grounded = True
     for node in nodes_to_ground:
         entity = res[f"x{node.id}"]
 
         if not node.attribute.startswith("type"):
-            entity_label = grounder._query_label(entity)
+            entity_label = node_queries[node.id].result()
             if entity_label is None:
                 is_grounded = False
             else:
@@ -218,11 +226,13 @@ def ground_new_graph(graph, graph_info, grounder):
 
         else:
             try:
-                datatype = grounder._query_datatype(node.in_relations[0].rel_type)
+                datatype = node_queries[node.id].result()
                 node.grounded_entity = entity
                 node.datatype = datatype
 
                 update_graph_info_node(graph_info, node.id, entity, datatype=datatype)
+            except BackendUnavailableError as e:
+                raise e
             except:
                 is_grounded = False
 
@@ -235,6 +245,7 @@ def sparql_decomposition(args):
     entity_mappings = df["entity_mapping"].tolist()
 
     grounder = SPARQLGraphGrounder(args.json_schema)
+    configure_sparql(grounder, args)
     sparql_provider = JsonSchemaSPARQLNLProvider(args.json_schema)
 
     samples = []
@@ -255,6 +266,9 @@ def sparql_decomposition(args):
                 sample = compose_sample_to_save(gr, sparql_provider, graph_id)
                 samples.append(sample)
 
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
     return samples
 
 
@@ -320,6 +334,7 @@ if __name__ == "__main__":
         "--json-schema", type=str, help="kg json schema path", required=True
     )
     parser.add_argument("--output-file", type=str, help="output file", required=True)
+    add_sparql_arguments(parser)
     args = parser.parse_args()
 
     samples = sparql_decomposition(args)
@@ -1,13 +1,21 @@
 import argparse
 from pattern_generator import PatternGenerator
+from pattern_catalog import PatternCatalog
+from kg_statistics import load_statistics
+from bloom_filter import BloomFilter
+from assignment_cache import AssignmentCache
+from query_timeouts import AdaptiveTimeouts
+from resilience import BackendUnavailableError
 from grounder import SPARQLGraphGrounder
+from sparql_client import add_sparql_arguments, configure_sparql
 from query_writer import SPARQLQueryWriter
 from nl_provider import JsonSchemaSPARQLNLProvider
 import csv
 from tqdm import tqdm
 import random
-import copy
+import itertools
 import json
+import os
 
 
 def get_graph_string(graph):
@@ -108,6 +116,16 @@ if __name__ == "__main__":
         nargs="+",
         help="List of modifiers to remove that will not be instantiated.",
     )
+    parser.add_argument(
+        "--exhaustive-patterns",
+        action="store_true",
+        help="Enumerate every distinct pattern up to --max-nodes instead of sampling them",
+    )
+    parser.add_argument(
+        "--pattern-catalog",
+        type=str,
+        help="Pattern catalog file built with pattern_catalog.py, --resume-from then refers to catalog pattern ids",
+    )
     parser.add_argument(
         "--diverse-sampling", action="store_true", help="Sample diverse relations"
     )
@@ -116,6 +134,67 @@ if __name__ == "__main__":
         action="store_true",
         help="Sample diverse relations for parallel edges",
     )
+    parser.add_argument(
+        "--schema-aware-sampling",
+        action="store_true",
+        help="Sample only relation assignments that are valid for the schema",
+    )
+    parser.add_argument(
+        "--kg-statistics",
+        type=str,
+        help="Statistics file built with kg_statistics.py to weight the sampling of classes and relations by their number of instances",
+    )
+    parser.add_argument(
+        "--statistics-temperature",
+        type=float,
+        default=1.0,
+        help="Exponent applied to the instance counts, 0 samples uniformly among the classes and relations with instances",
+    )
+    parser.add_argument(
+        "--negative-cache",
+        type=str,
+        help="Filepath of the bloom filter of sub-patterns known to have no matches, loaded if it exists and saved with the samples",
+    )
+    parser.add_argument(
+        "--assignment-cache",
+        type=str,
+        help="Filepath of the fingerprints of the assignments already tried, loaded if it exists and saved with the samples",
+    )
+    parser.add_argument(
+        "--assignment-cache-size",
+        type=int,
+        default=500000,
+        help="Max number of tried assignments to remember, the least recently seen are evicted",
+    )
+    parser.add_argument(
+        "--adaptive-timeouts",
+        action="store_true",
+        help="Set the timeout of the grounding queries of every pattern shape from their observed latencies",
+    )
+    parser.add_argument(
+        "--max-query-timeout",
+        type=float,
+        default=60,
+        help="Upper bound in seconds of the adaptive timeouts",
+    )
+    parser.add_argument(
+        "--grounding-sample-size",
+        type=int,
+        help="Keep a random sample of at most this many solutions of every grounding query instead of all of them",
+    )
+    parser.add_argument(
+        "--grounding-sampling",
+        type=str,
+        choices=["server", "reservoir"],
+        default="server",
+        help="Draw the sample with ORDER BY RAND() LIMIT in the query, or with reservoir sampling over the solutions of the response",
+    )
+    parser.add_argument(
+        "--grounding-batch-size",
+        type=int,
+        default=1,
+        help="Number of candidate groundings of a pattern whose grounding queries are sent to the SPARQL endpoint as one query, in the branches of a UNION",
+    )
     parser.add_argument(
         "--save-diverse-sampling",
         type=str,
@@ -126,6 +205,7 @@ if __name__ == "__main__":
         type=str,
         help="Filepath to load the classes and relation sampled for diverse sampling",
     )
+    add_sparql_arguments(parser)
     args = parser.parse_args()
 
     if args.seed:
@@ -137,12 +217,24 @@ if __name__ == "__main__":
     if args.remove_modifiers:
         pattern_generator.remove_modifiers = args.remove_modifiers
 
-    graphs = pattern_generator.generate_patterns(num_patterns, unique=True)
+    if args.pattern_catalog:
+        pattern_catalog = PatternCatalog(args.pattern_catalog)
+        graphs = pattern_catalog.iter_patterns(start=args.resume_from)
+    else:
+        if args.exhaustive_patterns:
+            print(f"Enumerating {pattern_generator.count_patterns()} patterns")
+            graphs = pattern_generator.enumerate_patterns()
+        else:
+            # Patterns are sampled lazily while grounding, so they get their own RNG to
+            # keep the pattern sequence (and --resume-from) independent of the grounder
+            pattern_generator.rng = random.Random(args.seed)
+            graphs = pattern_generator.iter_patterns(num_patterns, unique=True)
 
-    if args.resume_from:
-        graphs = graphs[args.resume_from :]
+        if args.resume_from:
+            graphs = itertools.islice(graphs, args.resume_from, None)
 
     grounder = SPARQLGraphGrounder(args.json_schema)
+    configure_sparql(grounder, args)
     sparql_provider = JsonSchemaSPARQLNLProvider(args.json_schema)
 
     if args.diverse_sampling:
@@ -157,20 +249,49 @@ if __name__ == "__main__":
 
     if args.diverse_parallel_relations:
         grounder.diverse_parallel_relations = True
+    if args.schema_aware_sampling:
+        grounder.schema_aware_sampling = True
+    if args.kg_statistics:
+        class_weights, relation_weights = load_statistics(
+            args.kg_statistics, args.statistics_temperature
+        )
+        grounder.set_statistics(class_weights, relation_weights)
+
+    if args.assignment_cache:
+        if os.path.exists(args.assignment_cache):
+            grounder.assignment_cache = AssignmentCache.load(
+                args.assignment_cache, args.assignment_cache_size
+            )
+        else:
+            grounder.assignment_cache = AssignmentCache(args.assignment_cache_size)
+    if args.negative_cache:
+        if os.path.exists(args.negative_cache):
+            grounder.negative_cache = BloomFilter.load(args.negative_cache)
+        else:
+            grounder.negative_cache = BloomFilter()
 
     grounder.max_iterations = args.max_grounder_iterations
+    grounder.sample_size = args.grounding_sample_size
+    grounder.server_side_sampling = args.grounding_sampling == "server"
+    grounder.candidates_per_query = args.grounding_batch_size
+    if args.adaptive_timeouts:
+        grounder.adaptive_timeouts = AdaptiveTimeouts(
+            max_timeout=args.max_query_timeout
+        )
 
     samples = []
 
-    for ittr, graph_orig in tqdm(enumerate(graphs), total=len(graphs)):
+    for ittr, graph_orig in tqdm(enumerate(graphs)):
         external_retries = 0
         for _ in range(args.grounding_per_pattern):
-            graph = copy.deepcopy(graph_orig)
+            graph = graph_orig.clone()
             is_grounded = False
             while not is_grounded and external_retries < args.max_pattern_retries:
                 external_retries += 1
                 try:
                     grounded_graph, is_grounded = grounder.ground_graph(graph)
+                except BackendUnavailableError as e:
+                    raise e
                 except:
                     is_grounded = False
 
@@ -222,4 +343,21 @@ if __name__ == "__main__":
                     with open(args.save_diverse_sampling, "w") as json_file:
                         json.dump(div_dict, json_file, indent=4)
 
+            if args.negative_cache:
+                grounder.negative_cache.save(args.negative_cache)
+            if args.assignment_cache:
+                grounder.assignment_cache.save(args.assignment_cache)
+
+    if args.assignment_cache:
+        grounder.assignment_cache.save(args.assignment_cache)
+    if args.negative_cache:
+        grounder.negative_cache.save(args.negative_cache)
+        print(f"Known empty sub-patterns: {len(grounder.negative_cache)}")
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
+    if grounder.adaptive_timeouts is not None:
+        print(grounder.adaptive_timeouts.report())
+    if args.backend == "endpoint":
+        print(grounder.retry_policy.report())
     print(f"Total produced samples: {len(samples)}")
@@ -1,3 +1,5 @@
+import hashlib
+
 MODIFIER_MAPPINGS = {
     "max": "A",
     "min": "B",
@@ -28,6 +30,31 @@ MODIFIER_MAPPINGS = {
 
 
 class Node:
+    __slots__ = (
+        "id",
+        "type",
+        "is_answer_node",
+        "grounded_entity",
+        "attribute",
+        "modifier_edge",
+        "modifier",
+        "datatype",
+        "in_relations",
+        "out_relations",
+    )
+
+    # Everything but the relations, which are rebuilt when a graph is cloned
+    VALUE_FIELDS = (
+        "id",
+        "type",
+        "is_answer_node",
+        "grounded_entity",
+        "attribute",
+        "modifier_edge",
+        "modifier",
+        "datatype",
+    )
+
     def __init__(self, id, is_answer_node=False):
         self.id = id
         self.type = None
@@ -40,8 +67,18 @@ class Node:
         self.modifier = None
         self.datatype = None
 
+    def clone(self):
+        node = Node.__new__(Node)
+        for field in Node.VALUE_FIELDS:
+            setattr(node, field, getattr(self, field))
+        node.in_relations = []
+        node.out_relations = []
+        return node
+
 
 class Relation:
+    __slots__ = ("in_node", "out_node", "rel_type")
+
     def __init__(self, in_node, out_node):
         self.in_node = in_node
         self.out_node = out_node
@@ -49,38 +86,74 @@ class Relation:
 
 
 class Graph:
+    # Node ids are their position in self.nodes. The relation endpoints are also kept
+    # as node ids in two arrays parallel to self.relations, which is what clone() uses
+    __slots__ = (
+        "answer_node",
+        "nodes",
+        "relations",
+        "rel_in_ids",
+        "rel_out_ids",
+        "entity_mapping",
+    )
+
     def __init__(self):
         node = Node(0, is_answer_node=True)
         self.answer_node = node
         self.nodes = []
         self.nodes.append(self.answer_node)
         self.relations = []
+        self.rel_in_ids = []
+        self.rel_out_ids = []
         self.entity_mapping = {}
 
-    def add_in_relation(self, node_id, rel_type=None):
-        in_node = Node(len(self.nodes))
-        self.nodes.append(in_node)
-        out_node = [node for node in self.nodes if node.id == node_id][0]
+    def add_relation(self, in_node_id, out_node_id, rel_type=None):
+        in_node = self.nodes[in_node_id]
+        out_node = self.nodes[out_node_id]
         relation = Relation(in_node, out_node)
         if rel_type:
             relation.rel_type = rel_type
         self.relations.append(relation)
+        self.rel_in_ids.append(in_node_id)
+        self.rel_out_ids.append(out_node_id)
         in_node.out_relations.append(relation)
         out_node.in_relations.append(relation)
+        return relation
+
+    def add_in_relation(self, node_id, rel_type=None):
+        in_node = Node(len(self.nodes))
+        self.nodes.append(in_node)
+        self.add_relation(in_node.id, node_id, rel_type)
         return in_node.id
 
     def add_out_relation(self, node_id, rel_type=None):
         out_node = Node(len(self.nodes))
         self.nodes.append(out_node)
-        in_node = [node for node in self.nodes if node.id == node_id][0]
-        relation = Relation(in_node, out_node)
-        if rel_type:
-            relation.rel_type = rel_type
-        self.relations.append(relation)
-        in_node.out_relations.append(relation)
-        out_node.in_relations.append(relation)
+        self.add_relation(node_id, out_node.id, rel_type)
         return out_node.id
 
+    def clone(self):
+        # Structural copy, much cheaper than copy.deepcopy of the object graph
+        graph = Graph.__new__(Graph)
+        nodes = [node.clone() for node in self.nodes]
+        graph.nodes = nodes
+        graph.answer_node = nodes[self.answer_node.id]
+        graph.relations = []
+        graph.rel_in_ids = self.rel_in_ids[:]
+        graph.rel_out_ids = self.rel_out_ids[:]
+        for relation, in_node_id, out_node_id in zip(
+            self.relations, self.rel_in_ids, self.rel_out_ids
+        ):
+            in_node = nodes[in_node_id]
+            out_node = nodes[out_node_id]
+            rel = Relation(in_node, out_node)
+            rel.rel_type = relation.rel_type
+            graph.relations.append(rel)
+            in_node.out_relations.append(rel)
+            out_node.in_relations.append(rel)
+        graph.entity_mapping = dict(self.entity_mapping)
+        return graph
+
     def set_attribute(self, node_id, attribute):
         self.nodes[node_id].attribute = attribute
 
@@ -129,3 +202,41 @@ class Graph:
             matrix[relation.in_node.id][relation.out_node.id] = m_entry
 
         return matrix
+
+    def _get_canonical_subtree(self, node, relation=None):
+        children = []
+        for rel in node.in_relations:
+            if rel is not relation:
+                children.append("<" + self._get_canonical_subtree(rel.in_node, rel))
+        for rel in node.out_relations:
+            if rel is not relation:
+                children.append(">" + self._get_canonical_subtree(rel.out_node, rel))
+        children.sort()
+        label = MODIFIER_MAPPINGS[node.modifier] if node.modifier else ""
+        return label + "(" + "".join(children) + ")"
+
+    def get_canonical_encoding(self):
+        # AHU encoding of the tree rooted at the answer node: two patterns get the
+        # same string iff they are isomorphic, edge directions and modifiers included
+        return self._get_canonical_subtree(self.answer_node)
+
+    def _get_assignment_subtree(self, node, relation=None):
+        children = []
+        for rel in node.in_relations:
+            if rel is not relation:
+                subtree = self._get_assignment_subtree(rel.in_node, rel)
+                children.append(f"<{rel.rel_type}|{subtree}")
+        for rel in node.out_relations:
+            if rel is not relation:
+                subtree = self._get_assignment_subtree(rel.out_node, rel)
+                children.append(f">{rel.rel_type}|{subtree}")
+        children.sort()
+        label = f"{node.modifier}|{node.attribute}"
+        return label + "(" + "".join(children) + ")"
+
+    def get_assignment_fingerprint(self):
+        # 64 bit hash of the canonical encoding with the classes and relations the
+        # grounder assigned, equal for isomorphic assignments
+        encoding = self._get_assignment_subtree(self.answer_node)
+        digest = hashlib.blake2b(encoding.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
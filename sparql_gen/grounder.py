@@ -1,10 +1,19 @@
 import random
-import copy
 import json
-import re
-from query_writer import SPARQLQueryWriter
-from SPARQLWrapper import SPARQLWrapper, JSON
-import urllib
+import time
+from itertools import combinations
+from query_writer import SPARQLQueryWriter, write_batched_grounding_query
+from relation_index import RelationIndex
+from assignment_sampler import RelationAssignmentSampler
+from sparql_client import SPARQLClient, classify_sparql_error
+from reservoir import reservoir_sample
+from resilience import (
+    RetryPolicy,
+    CircuitBreaker,
+    QueryError,
+    BackendUnavailableError,
+    TIMEOUT,
+)
 from utils import (
     SPARQL_DATATYPES,
     SPARQL_MODIFIER_NUMBER_TYPES,
@@ -22,6 +31,9 @@ class SPARQLGraphGrounder:
         self.inverse_relations = data["inverse_relations"]
 
         self._build_inv_rel()
+        self.relation_index = RelationIndex(
+            self.relations, self.relations_info, self.classes
+        )
 
         self.max_iterations = 100
 
@@ -29,6 +41,16 @@ class SPARQLGraphGrounder:
 
         self.diverse_parallel_relations = False
 
+        # Sample relations proportionally to the number of schema valid completions
+        self.schema_aware_sampling = False
+        self.assignment_sampler = RelationAssignmentSampler(
+            self.relation_index,
+            self.relations_info,
+            self.inverse_relations,
+            self.classes,
+            self._get_modifier_suitable_relations,
+        )
+
         self.diverse_sampling = False
         self.diverse_sampling_mode = False
         self.diverse_sampling_mode_classes = False
@@ -37,8 +59,39 @@ class SPARQLGraphGrounder:
         self.sampled_classes = set()
         self.sampled_rel = set()
 
-        self.sparql = SPARQLWrapper("http://127.0.0.1:3001/sparql")
-        self.sparql.setReturnFormat(JSON)
+        # Instance counts of the KG, None samples classes and relations uniformly
+        self.class_weights = None
+        self.relation_weights = None
+
+        # Fingerprints of the patterns with instantiated rels that we have tried to
+        # ground already, None to allow retrying them
+        self.assignment_cache = None
+
+        # Bloom filter of sub-patterns and queries known to have no matches
+        self.negative_cache = None
+        self.nonempty_subpatterns = set()
+
+        self.sparql = SPARQLClient("http://127.0.0.1:3001/sparql")
+        # Retries of the transient errors, and a circuit breaker pausing the
+        # queries while the endpoint is unreachable
+        self.retry_policy = RetryPolicy(
+            classify_sparql_error, CircuitBreaker(self.sparql.is_healthy)
+        )
+        # QueryCache of the results of _execute_query, if any
+        self.query_cache = None
+        # AdaptiveTimeouts of the grounding queries, if any
+        self.adaptive_timeouts = None
+
+        # Keep a random sample of at most sample_size solutions of every grounding
+        # query instead of all of them, None keeps all. The sample is drawn by the
+        # endpoint with ORDER BY RAND() LIMIT, or if server_side_sampling is False
+        # with reservoir sampling over the solutions of the response
+        self.sample_size = None
+        self.server_side_sampling = True
+
+        # Number of candidate groundings of a pattern whose grounding queries run as
+        # one, in the branches of a UNION, to save round trips to the endpoint
+        self.candidates_per_query = 1
 
         # self.prefix = "PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#> PREFIX : <>"
         self.prefix = "PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#> PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#> PREFIX : <http://rdf.freebase.com/ns/>"
@@ -62,16 +115,35 @@ class SPARQLGraphGrounder:
         self.relations_info.update(new_rel_info)
         self.inverse_relations.update(new_inv_rel)
 
-    def _execute_query(self, query: str):
+    def _execute_query(self, query: str, shape=None, sample_size=None):
+        # shape names the kind of query for the adaptive timeouts, if any. With a
+        # sample_size the results are a random sample of at most that many
+        # solutions, which is not cached so a rerun draws another one
         query = f"{self.prefix} {query}"
-
-        self.sparql.setQuery(query)
-        try:
-            results = self.sparql.query().convert()
-        except urllib.error.URLError as e:
-            raise e
+        cached = self.query_cache is not None and sample_size is None
+        if cached:
+            key = self.query_cache.get_key(query)
+            rtn = self.query_cache.get(key)
+            if rtn is not None:
+                return rtn
+
+        if shape is None or self.adaptive_timeouts is None:
+            results = self.retry_policy.call(self.sparql.query, query)
+        else:
+            timeout = self.adaptive_timeouts.get_timeout(shape)
+            start = time.monotonic()
+            try:
+                results = self.retry_policy.call(self.sparql.query, query, timeout)
+            except QueryError as e:
+                if e.kind == TIMEOUT:
+                    self.adaptive_timeouts.observe(shape, timeout, timed_out=True)
+                raise e
+            self.adaptive_timeouts.observe(shape, time.monotonic() - start)
+        bindings = results["results"]["bindings"]
+        if sample_size is not None:
+            bindings = reservoir_sample(bindings, sample_size)
         rtn = []
-        for result in results["results"]["bindings"]:
+        for result in bindings:
             for var in result:
                 result[var] = (
                     result[var]["value"]
@@ -79,6 +151,8 @@ class SPARQLGraphGrounder:
                     .replace("-08:00", "")
                 )
             rtn.append(result)
+        if cached:
+            self.query_cache.put(key, rtn)
         return rtn
 
     def _query_label(self, entity):
@@ -103,6 +177,9 @@ WHERE {{
             raise ValueError(f"Unknown Sparql Datatype: {datatype}")
         return SPARQL_DATATYPES[datatype]
 
+    def _query_node_datatype(self, node):
+        return self._query_datatype(node.in_relations[0].rel_type)
+
     def _ground_rel(self, relation, rel_type, node_attribute, in_rel=False):
         is_domain = False
         target_attribute = self.relations_info[rel_type]["domain"]
@@ -126,24 +203,74 @@ WHERE {{
             self.sampled_rel.add(rel.rel_type)
         self.sampled_classes.add(graph.answer_node.attribute)
 
+    def set_statistics(self, class_weights, relation_weights):
+        self.class_weights = class_weights
+        self.relation_weights = relation_weights
+        self.assignment_sampler.set_relation_weights(relation_weights)
+
+    def _get_weights(self, items, item_weights):
+        # None when no statistics are loaded or none of the items has instances, in
+        # which case the items are sampled uniformly
+        if item_weights is None:
+            return None
+        weights = [item_weights.get(i, 0) for i in items]
+        if sum(weights) == 0:
+            return None
+        return weights
+
+    def _weighted_choice(self, items, item_weights, k=None):
+        weights = self._get_weights(items, item_weights)
+        if k:
+            return random.choices(items, weights=weights, k=k)
+        if weights is None:
+            return random.choice(items)
+        return random.choices(items, weights=weights)[0]
+
     def _sample_class(self, classes):
         if self.diverse_sampling_mode_classes:
             cl = [i for i in classes if i not in self.sampled_classes]
             if len(cl) > 0:
-                return random.choice(cl)
-        return random.choice(classes)
+                return self._weighted_choice(cl, self.class_weights)
+        return self._weighted_choice(classes, self.class_weights)
 
     def _sample_relation(self, relations, k=None):
         if self.diverse_sampling_mode:
             rel = [i for i in relations if i not in self.sampled_rel]
             if len(rel) > 0:
-                if k:
-                    return random.choices(rel, k=k)
-                else:
-                    return random.choice(rel)
-        if k:
-            return random.choices(relations, k=k)
-        return random.choice(relations)
+                return self._weighted_choice(rel, self.relation_weights, k=k)
+        return self._weighted_choice(relations, self.relation_weights, k=k)
+
+    def _sample_weighted_relation(self, relations, weights):
+        # The weights of the assignment sampler already include the statistics
+        if len(relations) == 0:
+            raise ValueError("Grounder: Unable to find a valid relation.")
+        if self.diverse_sampling_mode:
+            unsampled = [
+                (i, w) for i, w in zip(relations, weights) if i not in self.sampled_rel
+            ]
+            if len(unsampled) > 0:
+                relations, weights = zip(*unsampled)
+        return random.choices(relations, weights=weights)[0]
+
+    def _sample_schema_aware_relations(self, node):
+        sampled_relations = []
+        for relation in node.in_relations:
+            if not relation.rel_type and not relation.in_node.modifier:
+                relations, weights = self.assignment_sampler.get_relation_weights(
+                    node.attribute, relation.in_node, in_rel=True
+                )
+                sampled_relations.append(
+                    self._sample_weighted_relation(relations, weights)
+                )
+        for relation in node.out_relations:
+            if not relation.rel_type and not relation.out_node.modifier:
+                relations, weights = self.assignment_sampler.get_relation_weights(
+                    node.attribute, relation.out_node, in_rel=False
+                )
+                sampled_relations.append(
+                    self._sample_weighted_relation(relations, weights)
+                )
+        return sampled_relations
 
     def _get_modifier_suitable_relations(self, attribute, possible_relations, modifier):
         if modifier.startswith("count"):
@@ -216,18 +343,19 @@ WHERE {{
             return True
 
         attribute = node.attribute
-        possible_relations = [
-            i
-            for i in self.relations
-            if self.relations_info[i]["domain"].startswith(attribute)
-            or self.relations_info[i]["range"].startswith(attribute)
-        ]
-        sampled_relations = self._sample_relation(possible_relations, k=num_rel - 1)
+        possible_relations = self.relation_index.get_relations(attribute)
+        if self.schema_aware_sampling:
+            sampled_relations = self._sample_schema_aware_relations(node)
+            if self.diverse_parallel_relations:
+                if len(set(sampled_relations)) < len(sampled_relations):
+                    return False
+        else:
+            sampled_relations = self._sample_relation(possible_relations, k=num_rel - 1)
 
-        if self.diverse_parallel_relations:
-            sampled_relations = list(set(sampled_relations))
-            if len(sampled_relations) < (num_rel - 1):
-                return False
+            if self.diverse_parallel_relations:
+                sampled_relations = list(set(sampled_relations))
+                if len(sampled_relations) < (num_rel - 1):
+                    return False
 
         modifier_nodes = self._ground_modifier_node_rel(
             node, attribute, possible_relations
@@ -253,154 +381,278 @@ WHERE {{
             target_node = self._ground_rel(relation, rel_type, attribute, in_rel=False)
             self._recursive_ground(target_node, modifier_edge=modifier_edge)
 
-    def edit_query(self, query, edge_nodes, modifier_nodes):
-        for i in range(len(edge_nodes)):
-            query = query.replace(f":?y{i}", f"?y{i}")
-        for node in modifier_nodes:
-            query = query.replace(f"?x{node.id}", f"?z{node.id}")
-        query_first_line = " ".join(
-            [i.grounded_entity for i in edge_nodes]
-            + [f"({i.grounded_entity} as ?z{i.id})" for i in modifier_nodes]
-        )
-
-        query_first_line = "SELECT DISTINCT " + "?x0 " + query_first_line
-        query = query.replace("SELECT COUNT DISTINCT", "SELECT DISTINCT")
-        query = query.replace("SUM(?x0)", "?x0")
-        query = query.replace("AVG(?x0)", "?x0")
-        query = query.replace("SELECT DISTINCT ?x0", query_first_line)
-        if self.filter_english:
-            filter_lines = [
-                "FILTER (!isLiteral(?x0) OR lang(?x0) = '' OR langMatches(lang(?x0), 'en'))"
-            ]
-            for i in edge_nodes:
-                gr_e = i.grounded_entity
-                filter_lines.append(
-                    f"FILTER (!isLiteral({gr_e}) OR lang({gr_e}) = '' OR langMatches(lang({gr_e}), 'en'))"
-                )
-            for i in modifier_nodes:
-                filter_lines.append(
-                    f"FILTER (!isLiteral(?z{i.id}) OR lang(?z{i.id}) = '' OR langMatches(lang(?z{i.id}), 'en'))"
+    def _get_subpatterns(self, graph):
+        # Triples and pairs of triples joined at a node, with their probe query. The
+        # relation fixes the types of its nodes, and without filters an empty probe
+        # means that every pattern containing the sub-pattern is empty too
+        subpatterns = {}
+        for relation in graph.relations:
+            subpatterns[f"E|{relation.rel_type}"] = (
+                f"SELECT ?s WHERE {{\n?s :{relation.rel_type} ?o .\n}}\nLIMIT 1"
+            )
+        for node in graph.nodes:
+            branches = []
+            for relation in node.in_relations + node.out_relations:
+                if relation.in_node is node:
+                    branches.append(("s", relation.rel_type))
+                else:
+                    branches.append(("o", relation.rel_type))
+            for branch_a, branch_b in combinations(sorted(branches), 2):
+                lines = []
+                for i, (role, rel_type) in enumerate((branch_a, branch_b)):
+                    if role == "s":
+                        lines.append(f"?c :{rel_type} ?x{i} .")
+                    else:
+                        lines.append(f"?x{i} :{rel_type} ?c .")
+                key = f"P|{branch_a[0]}:{branch_a[1]}|{branch_b[0]}:{branch_b[1]}"
+                subpatterns[key] = (
+                    "SELECT ?c WHERE {\n" + "\n".join(lines) + "\n}\nLIMIT 1"
                 )
-            filter_line = "WHERE {\n" + "\n".join(filter_lines)
-            query = query.replace("WHERE {", filter_line)
-        query = query.replace("LIMIT 1", "")
-
-        group_by_pos = query.upper().find("GROUP BY")
-        if group_by_pos != -1:
-            query = query[:group_by_pos]
-
-        pattern = (
-            r'\s*FILTER\s*\(\?[\w\d_]+\s*(>=|<=|<|>|=)\s*[\?\w\d_:"\^\^<>\s]+\)\s*?'
+        return subpatterns
+
+    def _has_empty_subpattern(self, subpatterns):
+        return any(key in self.negative_cache for key in subpatterns)
+
+    def _update_negative_cache(self, query, results, subpatterns):
+        if len(results) > 0:
+            self.nonempty_subpatterns.update(subpatterns)
+            return
+        self.negative_cache.add(f"Q|{query}")
+        # Look for the sub-pattern without matches, triples before pairs
+        for key in sorted(subpatterns):
+            if key in self.nonempty_subpatterns:
+                continue
+            try:
+                probe_results = self._execute_query(subpatterns[key])
+            except QueryError as e:
+                continue
+            if len(probe_results) == 0:
+                self.negative_cache.add(key)
+                return
+            self.nonempty_subpatterns.add(key)
+
+    def _get_pattern_shape(self, graph):
+        return (
+            tuple((i.in_node.id, i.out_node.id) for i in graph.relations),
+            tuple(i.modifier for i in graph.nodes),
         )
-        query = re.sub(pattern, "", query)
-
-        return query
 
     def ground_graph(self, original_graph):
 
         iter = 0
         grounded = False
-        while not grounded and iter < self.max_iterations:
-            if self.diverse_sampling:
-                self.diverse_sampling_mode = True
-                if iter > self.diverse_sampling_threshold * self.max_iterations:
-                    self.diverse_sampling_mode = False
-                self.diverse_sampling_mode_classes = True
-                if iter > self.diverse_sampling_threshold_classes * self.max_iterations:
-                    self.diverse_sampling_mode_classes = False
-
-            iter += 1
-            graph = copy.deepcopy(original_graph)
-            answer_node = graph.answer_node
-            if answer_node.modifier and answer_node.modifier != "count":
-                answer_node.modifier_edge = random.choice([True, False])
-                possible_classes = [
-                    i for i in self.classes if i in SPARQL_MODIFIER_NUMBER_TYPES
-                ]
-                if answer_node.modifier not in ("sum", "avg"):
-                    possible_classes += [
-                        i for i in self.classes if i in SPARQL_MODIFIER_DATE_TYPES
+        exhausted = False
+        if self.schema_aware_sampling:
+            root_shape = self.assignment_sampler.set_graph(original_graph)
+            valid_classes = self.assignment_sampler.get_valid_classes(root_shape)
+        while not grounded and not exhausted and iter < self.max_iterations:
+            # Up to candidates_per_query candidate groundings, each one an
+            # iteration, whose queries run as one
+            candidates = []
+            while (
+                len(candidates) < self.candidates_per_query
+                and iter < self.max_iterations
+            ):
+                if self.diverse_sampling:
+                    self.diverse_sampling_mode = True
+                    if iter > self.diverse_sampling_threshold * self.max_iterations:
+                        self.diverse_sampling_mode = False
+                    self.diverse_sampling_mode_classes = True
+                    if (
+                        iter
+                        > self.diverse_sampling_threshold_classes * self.max_iterations
+                    ):
+                        self.diverse_sampling_mode_classes = False
+
+                iter += 1
+                graph = original_graph.clone()
+                answer_node = graph.answer_node
+                if answer_node.modifier and answer_node.modifier != "count":
+                    answer_node.modifier_edge = random.choice([True, False])
+                    possible_classes = [
+                        i for i in self.classes if i in SPARQL_MODIFIER_NUMBER_TYPES
+                    ]
+                    if answer_node.modifier not in ("sum", "avg"):
+                        possible_classes += [
+                            i for i in self.classes if i in SPARQL_MODIFIER_DATE_TYPES
+                        ]
+                else:
+                    possible_classes = self.classes
+                if self.schema_aware_sampling:
+                    possible_classes = [
+                        i for i in possible_classes if i in valid_classes
                     ]
+                    if len(possible_classes) == 0:
+                        exhausted = True
+                        break
                 answer_node_class = self._sample_class(possible_classes)
-            else:
-                answer_node_class = self._sample_class(self.classes)
-            answer_node.attribute = answer_node_class
-
-            try:
-                self._recursive_ground(
-                    answer_node, modifier_edge=answer_node.modifier_edge
+                answer_node.attribute = answer_node_class
+
+                try:
+                    self._recursive_ground(
+                        answer_node, modifier_edge=answer_node.modifier_edge
+                    )
+                except Exception as e:
+                    continue
+
+                if self.assignment_cache is not None:
+                    if self.assignment_cache.check_and_add(
+                        graph.get_assignment_fingerprint()
+                    ):
+                        continue
+
+                subpatterns = None
+                if self.negative_cache is not None:
+                    subpatterns = self._get_subpatterns(graph)
+                    if self._has_empty_subpattern(subpatterns):
+                        continue
+
+                edge_nodes = []
+                for node in graph.nodes:
+                    if (
+                        (not node.is_answer_node)
+                        and (len(node.in_relations) + len(node.out_relations) == 1)
+                        and (not node.modifier)
+                    ):
+                        edge_nodes.append(node)
+                modifier_nodes = []
+                for node in graph.nodes:
+                    if (
+                        (not node.is_answer_node)
+                        and node.modifier
+                        and any(mod in node.modifier for mod in ("=", "<", ">"))
+                    ):
+                        modifier_nodes.append(node)
+
+                sparql_writer = SPARQLQueryWriter(graph)
+                sparql_query = sparql_writer.write_grounding_query(
+                    edge_nodes,
+                    modifier_nodes,
+                    self.filter_english,
+                    self.sample_size if self.server_side_sampling else None,
                 )
-            except Exception as e:
-                continue
-
-            edge_nodes = []
-            for node in graph.nodes:
-                if (
-                    (not node.is_answer_node)
-                    and (len(node.in_relations) + len(node.out_relations) == 1)
-                    and (not node.modifier)
-                ):
-                    node.grounded_entity = f"?y{len(edge_nodes)}"
-                    edge_nodes.append(node)
-            modifier_nodes = []
-            for node in graph.nodes:
                 if (
-                    (not node.is_answer_node)
-                    and node.modifier
-                    and any(mod in node.modifier for mod in ("=", "<", ">"))
+                    self.negative_cache is not None
+                    and f"Q|{sparql_query}" in self.negative_cache
                 ):
-                    if node.modifier.startswith("avg"):
-                        node.grounded_entity = f"AVG(?z{node.id})"
-                    elif node.modifier.startswith("sum"):
-                        node.grounded_entity = f"SUM(?z{node.id})"
-                    elif node.modifier.startswith("count"):
-                        node.grounded_entity = f"COUNT(?z{node.id})"
-                    else:
-                        node.grounded_entity = f"?z{node.id}"
-                    modifier_nodes.append(node)
+                    continue
+                candidates.append(
+                    (graph, edge_nodes, modifier_nodes, sparql_query, subpatterns)
+                )
 
-            sparql_writer = SPARQLQueryWriter(graph)
-            sparql_query = sparql_writer.write_query()
-            sparql_query = self.edit_query(sparql_query, edge_nodes, modifier_nodes)
+            if len(candidates) == 0:
+                continue
             try:
-                results = self._execute_query(sparql_query)
-            except Exception as e:
-                results = []
-            if len(results) > 0:
-                grounded = True
-                res = random.choice(results)
-                for i, node in enumerate(edge_nodes):
-                    entity = res[f"y{i}"]
-                    if node.modifier_edge:
-                        node.grounded_entity = None
-                    elif not node.attribute.startswith("type"):
-                        entity_label = self._query_label(entity)
-                        if entity_label is None:
-                            grounded = False
-                        else:
-                            graph.entity_mapping[entity_label] = entity
-                            node.grounded_entity = entity_label
-                    else:
-                        datatype = self._query_datatype(node.in_relations[0].rel_type)
-                        node.grounded_entity = entity
-                        node.datatype = datatype
-                for node in modifier_nodes:
-                    entity = res[f"z{node.id}"]
-                    if node.modifier[-1] == "<" or node.modifier[-1] == ">":
-                        try:
-                            entity = int(entity)
-                            if node.modifier[-1] == "<":
-                                entity = entity + 1
-                            else:
-                                entity = entity - 1
-                            entity = str(entity)
-                        except:
-                            pass
-                    node.grounded_entity = entity
-                    try:
-                        datatype = self._query_datatype(node.in_relations[0].rel_type)
-                    except:
-                        datatype = None
-                    node.datatype = datatype
+                candidates_results = self._query_candidates(candidates, original_graph)
+                if self.negative_cache is not None:
+                    for candidate, results in zip(candidates, candidates_results):
+                        _, _, _, sparql_query, subpatterns = candidate
+                        self._update_negative_cache(sparql_query, results, subpatterns)
+            except QueryError as e:
+                # Only the query failed, the backend errors stop the grounding
+                continue
+
+            # The first grounded candidate ends the grounding, as with a query per
+            # candidate
+            for candidate, results in zip(candidates, candidates_results):
+                graph, edge_nodes, modifier_nodes, _, _ = candidate
+                if len(results) > 0:
+                    grounded = self._ground_nodes(
+                        graph, edge_nodes, modifier_nodes, results
+                    )
+                    if grounded:
+                        break
 
         return graph, grounded
+
+    def _query_candidates(self, candidates, original_graph):
+        # Results of the grounding query of every candidate
+        shape = self._get_pattern_shape(original_graph)
+        if len(candidates) == 1:
+            sparql_query = candidates[0][3]
+            return [self._execute_query(sparql_query, shape, self.sample_size)]
+
+        nodes = [i[:3] for i in candidates]
+        if self.sample_size is not None and self.server_side_sampling:
+            batched_query = write_batched_grounding_query(
+                nodes, self.filter_english, self.sample_size
+            )
+            # Every candidate has its own sample in the query, the sample size of
+            # the batch keeps all of them and only keeps it out of the query cache
+            sample_size = self.sample_size * len(candidates)
+        else:
+            # A sample of the whole batch could miss the few solutions of a
+            # candidate, they are all fetched and every candidate is sampled after
+            batched_query = write_batched_grounding_query(nodes, self.filter_english)
+            sample_size = None
+        # The batches get their own timeouts, they run several queries
+        results = self._execute_query(
+            batched_query, (shape, len(candidates)), sample_size
+        )
+
+        candidates_results = [[] for _ in candidates]
+        for result in results:
+            candidates_results[int(result["candidate"])].append(result)
+        if self.sample_size is not None and not self.server_side_sampling:
+            candidates_results = [
+                reservoir_sample(i, self.sample_size) for i in candidates_results
+            ]
+        return candidates_results
+
+    def _ground_nodes(self, graph, edge_nodes, modifier_nodes, results):
+        # Grounds the nodes of the candidate graph from a random solution of its
+        # query, False if an entity has no label
+        grounded = True
+        res = random.choice(results)
+        # The label and datatype queries of all the nodes run concurrently
+        node_queries = {}
+        for i, node in enumerate(edge_nodes):
+            if node.modifier_edge:
+                continue
+            elif not node.attribute.startswith("type"):
+                node_queries[node.id] = self.sparql.submit(
+                    self._query_label, res[f"y{i}"]
+                )
+            else:
+                node_queries[node.id] = self.sparql.submit(
+                    self._query_node_datatype, node
+                )
+        for node in modifier_nodes:
+            node_queries[node.id] = self.sparql.submit(self._query_node_datatype, node)
+
+        for i, node in enumerate(edge_nodes):
+            entity = res[f"y{i}"]
+            if node.modifier_edge:
+                node.grounded_entity = None
+            elif not node.attribute.startswith("type"):
+                entity_label = node_queries[node.id].result()
+                if entity_label is None:
+                    grounded = False
+                else:
+                    graph.entity_mapping[entity_label] = entity
+                    node.grounded_entity = entity_label
+            else:
+                datatype = node_queries[node.id].result()
+                node.grounded_entity = entity
+                node.datatype = datatype
+        for node in modifier_nodes:
+            entity = res[f"z{node.id}"]
+            if node.modifier[-1] == "<" or node.modifier[-1] == ">":
+                try:
+                    entity = int(entity)
+                    if node.modifier[-1] == "<":
+                        entity = entity + 1
+                    else:
+                        entity = entity - 1
+                    entity = str(entity)
+                except:
+                    pass
+            node.grounded_entity = entity
+            try:
+                datatype = node_queries[node.id].result()
+            except BackendUnavailableError as e:
+                raise e
+            except:
+                datatype = None
+            node.datatype = datatype
+        return grounded
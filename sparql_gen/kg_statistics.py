@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+from grounder import SPARQLGraphGrounder
+from sparql_client import add_sparql_arguments, configure_sparql
+
+CLASS_COUNT_QUERY = """SELECT ?class (COUNT(?x) AS ?count)
+WHERE {
+  ?x a ?class .
+}
+GROUP BY ?class"""
+
+RELATION_COUNT_QUERY = """SELECT ?relation (COUNT(?x) AS ?count)
+WHERE {
+  ?x ?relation ?y .
+}
+GROUP BY ?relation"""
+
+
+def get_statistics_path(schema_path):
+    return os.path.splitext(schema_path)[0] + ".stats.json"
+
+
+def collect_statistics(grounder):
+    classes = {i: 0 for i in grounder.classes}
+    for record in grounder._execute_query(CLASS_COUNT_QUERY):
+        if record["class"] in classes:
+            classes[record["class"]] = int(record["count"])
+
+    relations = {i: 0 for i in grounder.relations}
+    for record in grounder._execute_query(RELATION_COUNT_QUERY):
+        if record["relation"] in relations:
+            relations[record["relation"]] = int(record["count"])
+
+    for relation in grounder.relations:
+        # Inverse relations added by the grounder may not be stored in the KG
+        reverse = grounder.relations_info[relation].get("reverse")
+        if relations[relation] == 0 and reverse in relations:
+            relations[relation] = relations[reverse]
+
+    for class_type in classes:
+        # Literal types have no instances of their own, count their values instead
+        if class_type.startswith("type."):
+            classes[class_type] = sum(
+                relations[i]
+                for i in grounder.relations
+                if grounder.relations_info[i]["range"] == class_type
+            )
+
+    return {"classes": classes, "relations": relations}
+
+
+def load_statistics(statistics_path, temperature=1.0):
+    # Sampling weights are the instance counts raised to the temperature, so 1 keeps
+    # the counts as they are and 0 gives the same weight to everything with instances
+    with open(statistics_path, "r") as file:
+        statistics = json.load(file)
+    class_weights = {
+        k: v**temperature if v > 0 else 0 for k, v in statistics["classes"].items()
+    }
+    relation_weights = {
+        k: v**temperature if v > 0 else 0 for k, v in statistics["relations"].items()
+    }
+    return class_weights, relation_weights
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--json-schema", type=str, help="kg json schema path", required=True
+    )
+    parser.add_argument(
+        "--output-file",
+        type=str,
+        help="statistics file, defaults to the schema path with a .stats.json extension",
+    )
+    add_sparql_arguments(parser)
+    args = parser.parse_args()
+
+    grounder = SPARQLGraphGrounder(args.json_schema)
+    configure_sparql(grounder, args)
+    statistics = collect_statistics(grounder)
+
+    output_file = args.output_file or get_statistics_path(args.json_schema)
+    with open(output_file, "w") as json_file:
+        json.dump(statistics, json_file, indent=4)
+    if grounder.query_cache is not None:
+        grounder.query_cache.close()
+        print(grounder.query_cache.report())
+
+    print(
+        f"Classes with instances: {sum(1 for i in statistics['classes'].values() if i > 0)}"
+    )
+    print(
+        f"Relations with instances: {sum(1 for i in statistics['relations'].values() if i > 0)}"
+    )
@@ -0,0 +1,150 @@
+import argparse
+import json
+import mmap
+import struct
+from graph import Graph, MODIFIER_MAPPINGS
+from pattern_generator import PatternGenerator
+
+CATALOG_MAGIC = b"SPOTPCAT"
+CATALOG_VERSION = 1
+# magic, version, max nodes, record size, number of patterns, modifier table size
+CATALOG_HEADER = struct.Struct("<8sHHHIH")
+NO_MODIFIER = 0xFF
+
+# Each pattern is a fixed size record, so a pattern id is just its record index:
+#   byte 0: number of nodes
+#   byte 1: id of the node with a modifier (NO_MODIFIER if there is none)
+#   byte 2: index of the modifier in the modifier table
+#   then for every node id from 1 to max_nodes - 1 the id of its parent and the
+#   direction of the relation to it (0 for an in relation, 1 for an out relation)
+
+
+def get_record_size(max_nodes):
+    return 3 + 2 * (max_nodes - 1)
+
+
+def encode_pattern(graph, max_nodes, modifiers):
+    record = bytearray(get_record_size(max_nodes))
+    record[0] = len(graph.nodes)
+    record[1] = NO_MODIFIER
+    for node in graph.nodes:
+        if node.modifier:
+            record[1] = node.id
+            record[2] = modifiers.index(node.modifier)
+    for relation in graph.relations:
+        in_node_id = relation.in_node.id
+        out_node_id = relation.out_node.id
+        if in_node_id > out_node_id:
+            record[1 + 2 * in_node_id] = out_node_id
+            record[2 + 2 * in_node_id] = 0
+        else:
+            record[1 + 2 * out_node_id] = in_node_id
+            record[2 + 2 * out_node_id] = 1
+    return bytes(record)
+
+
+def build_catalog(pattern_generator, output_file):
+    modifiers = list(MODIFIER_MAPPINGS.keys())
+    modifier_table = json.dumps(modifiers).encode("utf-8")
+    max_nodes = pattern_generator.max_nodes
+    count = 0
+    with open(output_file, "wb") as file:
+        file.write(b"\0" * (CATALOG_HEADER.size + len(modifier_table)))
+        for pattern in pattern_generator.enumerate_patterns():
+            file.write(encode_pattern(pattern, max_nodes, modifiers))
+            count += 1
+        file.seek(0)
+        file.write(
+            CATALOG_HEADER.pack(
+                CATALOG_MAGIC,
+                CATALOG_VERSION,
+                max_nodes,
+                get_record_size(max_nodes),
+                count,
+                len(modifier_table),
+            )
+        )
+        file.write(modifier_table)
+    return count
+
+
+class PatternCatalog:
+    def __init__(self, catalog_path):
+        self.file = open(catalog_path, "rb")
+        # Read only mapping, processes loading the same catalog share its pages
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic,
+            version,
+            self.max_nodes,
+            self.record_size,
+            self.num_patterns,
+            table_size,
+        ) = CATALOG_HEADER.unpack_from(self.data, 0)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            raise ValueError(f"Not a pattern catalog: {catalog_path}")
+        table_start = CATALOG_HEADER.size
+        self.modifiers = json.loads(
+            self.data[table_start : table_start + table_size].decode("utf-8")
+        )
+        self.records_start = table_start + table_size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.num_patterns
+
+    def _get_record_offset(self, pattern_id):
+        if pattern_id < 0 or pattern_id >= self.num_patterns:
+            raise IndexError(f"Pattern id {pattern_id} out of range")
+        return self.records_start + pattern_id * self.record_size
+
+    def get_num_nodes(self, pattern_id):
+        return self.data[self._get_record_offset(pattern_id)]
+
+    def __getitem__(self, pattern_id):
+        offset = self._get_record_offset(pattern_id)
+        record = self.data[offset : offset + self.record_size]
+        graph = Graph()
+        for node_id in range(1, record[0]):
+            parent_id = record[1 + 2 * node_id]
+            if record[2 + 2 * node_id] == 0:
+                graph.add_in_relation(parent_id)
+            else:
+                graph.add_out_relation(parent_id)
+        if record[1] != NO_MODIFIER:
+            graph.set_modifier(record[1], self.modifiers[record[2]])
+        return graph
+
+    def iter_patterns(self, start=0, num_nodes=None):
+        for pattern_id in range(start, self.num_patterns):
+            if num_nodes and self.get_num_nodes(pattern_id) != num_nodes:
+                continue
+            yield self[pattern_id]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-file", type=str, help="catalog file", required=True)
+    parser.add_argument(
+        "--max-nodes",
+        type=int,
+        default=7,
+        help="Max number of nodes to include in the patterns",
+    )
+    parser.add_argument(
+        "--remove-modifiers",
+        nargs="+",
+        help="List of modifiers to remove that will not be instantiated.",
+    )
+    args = parser.parse_args()
+
+    pattern_generator = PatternGenerator()
+    pattern_generator.max_nodes = args.max_nodes
+    if args.remove_modifiers:
+        pattern_generator.remove_modifiers = args.remove_modifiers
+
+    count = build_catalog(pattern_generator, args.output_file)
+    print(f"Total catalog patterns: {count}")
@@ -114,6 +114,69 @@ class SPARQLQueryWriter:
             )
         return lines
 
+    def _get_english_filter_line(self, variable):
+        return f"FILTER (!isLiteral({variable}) OR lang({variable}) = '' OR langMatches(lang({variable}), 'en'))"
+
+    def write_grounding_query(
+        self,
+        edge_nodes,
+        modifier_nodes,
+        filter_english=True,
+        sample_size=None,
+        candidate=None,
+    ):
+        # Query of the solutions the grounder picks the entities from, the triple
+        # patterns of the graph without the modifiers. The answer node is ?x0, the
+        # edge nodes ?y0, ?y1... in their order and the modifier nodes ?z with
+        # their id, aggregated for the count, sum and avg modifiers. With a
+        # sample_size a random sample of the solutions is returned, with a
+        # candidate number it is also returned as ?candidate
+        variables = {node.id: f"?y{i}" for i, node in enumerate(edge_nodes)}
+        variables.update({node.id: f"?z{node.id}" for node in modifier_nodes})
+        answer_node = self.graph.answer_node
+
+        select_items = []
+        if candidate is not None:
+            select_items.append(f"({candidate} AS ?candidate)")
+        select_items.append(f"?x{answer_node.id}")
+        select_items += [f"?y{i}" for i in range(len(edge_nodes))]
+        for node in modifier_nodes:
+            for aggregate in ("avg", "sum", "count"):
+                if node.modifier.startswith(aggregate):
+                    select_items.append(
+                        f"({aggregate.upper()}(?z{node.id}) as ?z{node.id})"
+                    )
+                    break
+            else:
+                select_items.append(f"?z{node.id}")
+        query_lines = ["SELECT DISTINCT " + " ".join(select_items), "WHERE {"]
+
+        if filter_english:
+            query_lines += [
+                self._get_english_filter_line(i)
+                for i in [f"?x{answer_node.id}"] + list(variables.values())
+            ]
+
+        for relation in self.graph.relations:
+            obj = variables.get(relation.in_node.id)
+            if obj is None:
+                obj, _ = self._get_node_variable_or_entity(relation.in_node)
+            subj = variables.get(relation.out_node.id)
+            if subj is None:
+                subj, _ = self._get_node_variable_or_entity(relation.out_node)
+            query_lines.append(f"{obj} :{relation.rel_type} {subj} .")
+
+        if (
+            answer_node.attribute not in SPARQL_MODIFIER_NUMBER_TYPES
+            and answer_node.attribute not in SPARQL_MODIFIER_DATE_TYPES
+        ):
+            query_lines += self._get_attribute_line(answer_node)
+        query_lines.append("}")
+
+        if sample_size is not None:
+            query_lines += ["ORDER BY RAND()", f"LIMIT {sample_size}"]
+        return "\n".join(query_lines)
+
     def write_query(self, map_entities=True):
         query_lines = []
 
@@ -323,3 +386,23 @@ class SPARQLQueryWriter:
 
         proto_nl = self._proto_nl_to_str(proto_nl)
         return proto_nl
+
+
+def write_batched_grounding_query(candidates, filter_english=True, sample_size=None):
+    # Grounding query of several candidate groundings of the same pattern, given as
+    # (graph, edge_nodes, modifier_nodes), which only differ in their classes and
+    # relations. The query of every candidate is a UNION branch with its own
+    # sample, and the ?candidate of the solutions is the index of its graph
+    branches = []
+    for i, (graph, edge_nodes, modifier_nodes) in enumerate(candidates):
+        query = SPARQLQueryWriter(graph).write_grounding_query(
+            edge_nodes, modifier_nodes, filter_english, sample_size, i
+        )
+        branches.append("{\n" + query + "\n}")
+    graph, edge_nodes, modifier_nodes = candidates[0]
+    variables = ["?candidate", f"?x{graph.answer_node.id}"]
+    variables += [f"?y{i}" for i in range(len(edge_nodes))]
+    variables += [f"?z{node.id}" for node in modifier_nodes]
+    query_lines = ["SELECT " + " ".join(variables), "WHERE {"]
+    query_lines += ["\nUNION\n".join(branches), "}"]
+    return "\n".join(query_lines)
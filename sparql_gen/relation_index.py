@@ -0,0 +1,54 @@
+class RelationIndex:
+    # For every class, the relations whose domain or range starts with it, i.e. what
+    # the grounders would get by running str.startswith over the whole schema. The
+    # candidate lists are tuples shared by all the lookups, so they must not be edited
+    def __init__(self, relations, relations_info, classes):
+        self.relations = relations
+        self.relations_info = relations_info
+
+        self.keys = set(classes)
+        for relation in relations:
+            self.keys.add(relations_info[relation]["domain"])
+            self.keys.add(relations_info[relation]["range"])
+
+        domain_index = {}
+        range_index = {}
+        any_index = {}
+        for relation in relations:
+            domain_keys = self._get_prefix_keys(relations_info[relation]["domain"])
+            range_keys = self._get_prefix_keys(relations_info[relation]["range"])
+            for key in domain_keys:
+                domain_index.setdefault(key, []).append(relation)
+            for key in range_keys:
+                range_index.setdefault(key, []).append(relation)
+            for key in domain_keys | range_keys:
+                any_index.setdefault(key, []).append(relation)
+
+        self.domain_index = {k: tuple(v) for k, v in domain_index.items()}
+        self.range_index = {k: tuple(v) for k, v in range_index.items()}
+        self.any_index = {k: tuple(v) for k, v in any_index.items()}
+
+    def _get_prefix_keys(self, value):
+        return {value[:i] for i in range(1, len(value) + 1) if value[:i] in self.keys}
+
+    def _lookup(self, index, class_type, fields):
+        if class_type in index:
+            return index[class_type]
+        if class_type in self.keys:
+            return ()
+        # Not a class of the schema, fall back to a scan and remember the answer
+        index[class_type] = tuple(
+            i
+            for i in self.relations
+            if any(self.relations_info[i][f].startswith(class_type) for f in fields)
+        )
+        return index[class_type]
+
+    def get_domain_relations(self, class_type):
+        return self._lookup(self.domain_index, class_type, ("domain",))
+
+    def get_range_relations(self, class_type):
+        return self._lookup(self.range_index, class_type, ("range",))
+
+    def get_relations(self, class_type):
+        return self._lookup(self.any_index, class_type, ("domain", "range"))
@@ -0,0 +1,16 @@
+import random
+
+
+def reservoir_sample(records, sample_size):
+    # Uniform random sample of at most sample_size of the records, read once from
+    # an iterable such as a streamed cursor, so at most sample_size of them are kept
+    # in memory. Fewer records than sample_size are all kept, in their order
+    sample = []
+    for i, record in enumerate(records):
+        if i < sample_size:
+            sample.append(record)
+            continue
+        j = random.randint(0, i)
+        if j < sample_size:
+            sample[j] = record
+    return sample
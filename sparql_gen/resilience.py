@@ -0,0 +1,180 @@
+import asyncio
+import random
+import threading
+import time
+
+# Kinds of query errors. A transient error comes from the backend being
+# unreachable or overloaded and is worth retrying, a timeout or a syntax error
+# (any error of the query itself) would fail the same way again
+TRANSIENT = "transient"
+TIMEOUT = "timeout"
+SYNTAX = "syntax"
+
+
+class QueryError(Exception):
+    # The query failed but the backend works, the query has no results
+    def __init__(self, kind, error):
+        super().__init__(f"{kind} error: {error}")
+        self.kind = kind
+        self.error = error
+
+
+class BackendUnavailableError(Exception):
+    # The backend kept failing through the retries and the pause of the circuit
+    # breaker, the run cannot go on
+    pass
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold transient failures in a row. While it is open
+    # the queries wait, pausing the pipeline, and every reset_timeout seconds the
+    # backend is checked with health_check until it answers again. After max_pause
+    # seconds without recovering BackendUnavailableError is raised
+    def __init__(self, health_check=None, failure_threshold=3):
+        self.health_check = health_check
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = 10
+        self.max_pause = 600
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.num_openings = 0
+        self.paused_time = 0
+        self.lock = threading.Lock()
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if (
+                self.opened_at is None
+                and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.opened_at = time.monotonic()
+                self.num_openings += 1
+                print(
+                    f"Backend unhealthy after {self.consecutive_failures} failures, "
+                    "pausing the queries"
+                )
+
+    def _is_healthy(self):
+        if self.health_check is None:
+            return True
+        try:
+            return self.health_check()
+        except Exception as e:
+            return False
+
+    def _check(self):
+        # Seconds to wait before checking again, 0 once the circuit is closed
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            opened_at = self.opened_at
+        if time.monotonic() - opened_at > self.max_pause:
+            raise BackendUnavailableError(
+                f"Backend unhealthy for more than {self.max_pause}s"
+            )
+        if self._is_healthy():
+            with self.lock:
+                if self.opened_at is not None:
+                    self.paused_time += time.monotonic() - self.opened_at
+                # Half open, the next failure opens it again
+                self.opened_at = None
+                self.consecutive_failures = self.failure_threshold - 1
+            return 0
+        return self.reset_timeout
+
+    def wait(self):
+        delay = self._check()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self._check()
+
+    async def wait_async(self):
+        # The health check blocks the event loop, the pipeline is paused anyway
+        delay = self._check()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._check()
+
+    def report(self):
+        return (
+            f"Circuit breaker: opened {self.num_openings} times, "
+            f"{self.paused_time:.1f}s paused"
+        )
+
+
+class RetryPolicy:
+    # Runs a query, retrying the transient errors up to max_retries times with
+    # exponential backoff and full jitter. The errors of the query itself are
+    # raised as QueryError and the transient errors left after the retries as
+    # BackendUnavailableError
+    def __init__(self, classify_error, circuit_breaker=None, max_retries=3):
+        self.classify_error = classify_error
+        self.circuit_breaker = circuit_breaker
+        self.max_retries = max_retries
+        self.base_delay = 0.5
+        self.max_delay = 30
+        self.num_retries = 0
+        # Own generator so the retries do not change the seeded sampling
+        self.random = random.Random()
+
+    def _get_delay(self, attempt):
+        return self.random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _handle_error(self, error, attempt):
+        # Delay before the next attempt, raises if there is none
+        kind = self.classify_error(error)
+        if kind != TRANSIENT:
+            # The backend answered
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+            raise QueryError(kind, error) from error
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record_failure()
+        if attempt >= self.max_retries:
+            raise BackendUnavailableError(
+                f"Query failed after {attempt + 1} attempts: {error}"
+            ) from error
+        self.num_retries += 1
+        return self._get_delay(attempt)
+
+    def call(self, fn, *args):
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.wait()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                time.sleep(self._handle_error(e, attempt))
+                attempt += 1
+                continue
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+            return result
+
+    async def call_async(self, fn, *args):
+        attempt = 0
+        while True:
+            if self.circuit_breaker is not None:
+                await self.circuit_breaker.wait_async()
+            try:
+                result = await fn(*args)
+            except Exception as e:
+                await asyncio.sleep(self._handle_error(e, attempt))
+                attempt += 1
+                continue
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record_success()
+            return result
+
+    def report(self):
+        report = f"Retried queries: {self.num_retries}"
+        if self.circuit_breaker is not None:
+            report += f", {self.circuit_breaker.report()}"
+        return report
@@ -0,0 +1,193 @@
+import http.client
+import json
+import os
+import queue
+import urllib.error
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from triple_store import TripleStore
+from query_cache import QueryCache
+from resilience import RetryPolicy, CircuitBreaker, TRANSIENT, TIMEOUT, SYNTAX
+
+# Statuses of an overloaded or restarting endpoint
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+
+
+class SPARQLClient:
+    # Client for a SPARQL endpoint that keeps its HTTP connections alive between
+    # queries. Up to max_connections queries can run at the same time, either
+    # from several threads or through submit(), which uses a pool of that size
+    def __init__(self, endpoint, max_connections=8, timeout=60):
+        self.endpoint = endpoint
+        self.timeout = timeout
+        url = urllib.parse.urlsplit(endpoint)
+        if url.scheme == "https":
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+        self.path = url.path or "/"
+        self.connections = queue.Queue()
+        for _ in range(max_connections):
+            self.connections.put(connection_class(url.netloc, timeout=timeout))
+        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.connections.empty():
+            self.connections.get().close()
+
+    def _post(self, connection, body, headers):
+        # A kept alive connection may have been closed by the server in the
+        # meantime, in that case the request is sent again on a new one
+        for attempt in range(2):
+            try:
+                connection.request("POST", self.path, body, headers)
+                response = connection.getresponse()
+                return response.status, response.reason, response.read(), response
+            except (http.client.RemoteDisconnected, ConnectionResetError) as e:
+                connection.close()
+                if attempt == 1:
+                    raise e
+            except Exception as e:
+                connection.close()
+                raise e
+
+    def query(self, query, timeout=None):
+        # With a timeout in seconds Virtuoso stops the query at that time, and the
+        # socket gives it one more second to answer
+        form = {"query": query}
+        if timeout is not None:
+            form["timeout"] = int(timeout * 1000)
+        body = urllib.parse.urlencode(form).encode("utf-8")
+        headers = {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/sparql-results+json",
+        }
+        connection = self.connections.get()
+        try:
+            connection.timeout = self.timeout if timeout is None else timeout + 1
+            if connection.sock is not None:
+                connection.sock.settimeout(connection.timeout)
+            status, reason, data, response = self._post(connection, body, headers)
+        finally:
+            self.connections.put(connection)
+        if status != 200:
+            raise urllib.error.HTTPError(self.endpoint, status, reason, None, None)
+        if response.getheader("X-SQL-State") == "S1TAT":
+            # Virtuoso returns what it found before the timeout, not all the results
+            raise TimeoutError(f"Query timed out after {timeout}s")
+        return json.loads(data)
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def is_healthy(self):
+        try:
+            self.query("SELECT ?s WHERE { ?s ?p ?o } LIMIT 1", self.timeout)
+        except Exception as e:
+            return False
+        return True
+
+
+def classify_sparql_error(error):
+    # HTTPError and TimeoutError are OSError subclasses, checked first
+    if isinstance(error, TimeoutError):
+        return TIMEOUT
+    if isinstance(error, urllib.error.HTTPError):
+        if error.code in TRANSIENT_STATUSES:
+            return TRANSIENT
+        return SYNTAX
+    if isinstance(error, (OSError, http.client.HTTPException)):
+        return TRANSIENT
+    return SYNTAX
+
+
+def add_sparql_arguments(parser):
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="endpoint",
+        choices=["endpoint", "memory"],
+        help="Run the queries on the SPARQL endpoint or on an in-process triple store loaded from --graph-file",
+    )
+    parser.add_argument(
+        "--graph-file",
+        type=str,
+        default=None,
+        help="N-Triples file, possibly gzipped, for the memory backend",
+    )
+    parser.add_argument(
+        "--sparql-endpoint",
+        type=str,
+        default="http://127.0.0.1:3001/sparql",
+        help="URL of the SPARQL endpoint",
+    )
+    parser.add_argument(
+        "--max-concurrent-queries",
+        type=int,
+        default=8,
+        help="Max number of SPARQL queries running at the same time, also the number of kept alive connections",
+    )
+    parser.add_argument(
+        "--query-cache",
+        type=str,
+        help="SQLite file caching the results of the SPARQL queries across runs",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=1000000,
+        help="Max number of cached query results, the least recently used are evicted",
+    )
+    parser.add_argument(
+        "--query-cache-tag",
+        type=str,
+        default="",
+        help="Version of the KG, change it to invalidate the cache after updating the endpoint",
+    )
+    parser.add_argument(
+        "--max-query-retries",
+        type=int,
+        default=3,
+        help="Retries of a query failing on a transient endpoint error, with exponential backoff",
+    )
+    parser.add_argument(
+        "--max-backend-pause",
+        type=int,
+        default=600,
+        help="Seconds to wait for an unreachable endpoint before stopping the run",
+    )
+
+
+def configure_sparql(grounder, args):
+    grounder.sparql.close()
+    if args.backend == "memory":
+        if args.graph_file is None:
+            raise ValueError("The memory backend needs a --graph-file")
+        grounder.sparql = TripleStore.load(args.graph_file)
+        # The queries run in process, there is no endpoint to wait for
+        grounder.retry_policy = RetryPolicy(classify_sparql_error)
+    else:
+        grounder.sparql = SPARQLClient(
+            args.sparql_endpoint, args.max_concurrent_queries
+        )
+        grounder.retry_policy = RetryPolicy(
+            classify_sparql_error, CircuitBreaker(grounder.sparql.is_healthy)
+        )
+        grounder.retry_policy.circuit_breaker.max_pause = args.max_backend_pause
+    grounder.retry_policy.max_retries = args.max_query_retries
+    if args.query_cache:
+        grounder.query_cache = QueryCache(
+            args.query_cache, get_sparql_cache_tag(args), args.query_cache_size
+        )
+
+
+def get_sparql_cache_tag(args):
+    # A graph file is identified by its size and modification time, an endpoint
+    # only by its URL and the user given tag
+    if args.backend == "memory":
+        stat = os.stat(args.graph_file)
+        source = f"{os.path.abspath(args.graph_file)}|{stat.st_size}|{stat.st_mtime_ns}"
+    else:
+        source = args.sparql_endpoint
+    return f"{args.backend}|{source}|{args.query_cache_tag}"
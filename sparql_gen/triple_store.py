@@ -0,0 +1,1133 @@
+import gzip
+import random
+import re
+from concurrent.futures import Future
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+
+# In process alternative to the SPARQL endpoint. A TripleStore loads an N-Triples
+# file, encodes its terms as integers and keeps the triples sorted in SPO, POS and
+# OSP order, so every triple pattern is a range of one of the three indexes. It
+# evaluates the SPARQL that the grounder and SPARQLQueryWriter write: basic graph
+# patterns with FILTER, GROUP BY and HAVING, aggregations, ORDER BY and LIMIT, and
+# the UNION of subqueries, and answers in the SPARQL JSON results format like
+# SPARQLClient.
+#
+# Terms are tuples: ("uri", iri), ("bnode", label) and
+# ("literal", lexical form, datatype or None, language or None)
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+DEFAULT_PREFIXES = {
+    "rdf": RDF,
+    "rdfs": RDFS,
+    "xsd": XSD,
+    "owl": "http://www.w3.org/2002/07/owl#",
+}
+
+RDF_TYPE = ("uri", RDF + "type")
+
+INTEGER_TYPES = {
+    XSD + i
+    for i in (
+        "integer",
+        "int",
+        "long",
+        "short",
+        "byte",
+        "nonNegativeInteger",
+        "nonPositiveInteger",
+        "positiveInteger",
+        "negativeInteger",
+        "unsignedInt",
+        "unsignedLong",
+        "unsignedShort",
+        "unsignedByte",
+    )
+}
+NUMERIC_TYPES = INTEGER_TYPES | {XSD + "decimal", XSD + "float", XSD + "double"}
+TEMPORAL_TYPES = {XSD + "dateTime", XSD + "date"}
+
+TRUE = ("literal", "true", XSD + "boolean", None)
+FALSE = ("literal", "false", XSD + "boolean", None)
+
+AGGREGATES = ("count", "sum", "avg", "min", "max", "sample")
+
+NTRIPLES_TERM = r'<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[\w-]+|\^\^<[^>]*>)?'
+NTRIPLES_LINE = re.compile(
+    rf"\s*({NTRIPLES_TERM})\s+({NTRIPLES_TERM})\s+({NTRIPLES_TERM})\s*\.\s*$"
+)
+NTRIPLES_LITERAL = re.compile(r'"((?:[^"\\]|\\.)*)"(?:@([\w-]+)|\^\^<([^>]*)>)?$')
+
+TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+    (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    |(?P<iri><[^<>"{}|^`\\\s]*>)
+    |(?P<var>[?$]\w+)
+    |(?P<pname>(?:[A-Za-z][\w-]*)?:(?:[\w-](?:[\w.-]*[\w-])?)?)
+    |(?P<number>\d+\.\d+(?:[eE][+-]?\d+)?|\d+[eE][+-]?\d+|\d+)
+    |(?P<name>[A-Za-z_]\w*)
+    |(?P<langtag>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+    |(?P<symbol>&&|\|\||!=|<=|>=|\^\^|[{}().;,*=<>!+\-/])
+    )""",
+    re.VERBOSE,
+)
+
+ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f"}
+
+
+def _unescape(value):
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in "uU":
+            return chr(int(escape[1:], 16))
+        return ESCAPES.get(escape, escape)
+
+    return re.sub(r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)", replace, value)
+
+
+def _typed_literal(lexical, datatype, lang):
+    # A simple literal is an xsd:string, both are stored without datatype so they
+    # are the same term
+    if datatype == XSD + "string":
+        datatype = None
+    return ("literal", lexical, datatype, lang)
+
+
+def _parse_ntriples_term(value):
+    if value.startswith("<"):
+        return ("uri", value[1:-1])
+    if value.startswith("_:"):
+        return ("bnode", value[2:])
+    match = NTRIPLES_LITERAL.match(value)
+    lexical, lang, datatype = match.groups()
+    return _typed_literal(_unescape(lexical), datatype, lang)
+
+
+class _ExpressionError(Exception):
+    # An expression without a value, e.g. lang() of an IRI or an unbound variable
+    pass
+
+
+def _literal(value):
+    if isinstance(value, bool):
+        return TRUE if value else FALSE
+    if isinstance(value, int):
+        return ("literal", str(value), XSD + "integer", None)
+    if isinstance(value, float):
+        return ("literal", repr(value), XSD + "decimal", None)
+    return ("literal", value, None, None)
+
+
+def _get_value(term):
+    # Python value of a literal for comparisons and arithmetic
+    if term[0] != "literal":
+        return term
+    lexical, datatype = term[1], term[2]
+    if datatype in NUMERIC_TYPES:
+        try:
+            if datatype in INTEGER_TYPES:
+                return int(lexical)
+            return float(lexical)
+        except ValueError:
+            raise _ExpressionError(f"Invalid {datatype}: {lexical}")
+    if datatype == XSD + "boolean":
+        return lexical in ("true", "1")
+    if datatype in TEMPORAL_TYPES:
+        try:
+            return datetime.fromisoformat(lexical)
+        except ValueError:
+            return lexical
+    return lexical
+
+
+def _is_number(term):
+    return term[0] == "literal" and term[2] in NUMERIC_TYPES
+
+
+def _is_string(term):
+    return term[0] == "literal" and term[2] in (None, XSD + "string")
+
+
+def _effective_boolean_value(term):
+    if term[0] != "literal":
+        raise _ExpressionError("No boolean value for a non literal")
+    if term[2] == XSD + "boolean":
+        return term[1] in ("true", "1")
+    if term[2] in NUMERIC_TYPES:
+        return _get_value(term) != 0
+    if _is_string(term):
+        return term[1] != ""
+    raise _ExpressionError(f"No boolean value for {term[2]}")
+
+
+def _compare(op, a, b):
+    if _is_number(a) and _is_number(b):
+        a, b = _get_value(a), _get_value(b)
+    elif (
+        a[0] == "literal"
+        and b[0] == "literal"
+        and (a[2] == b[2] or (_is_string(a) and _is_string(b)))
+        and a[3] == b[3]
+    ):
+        a, b = _get_value(a), _get_value(b)
+    elif op in ("=", "!="):
+        return (a == b) == (op == "=")
+    else:
+        raise _ExpressionError(f"Cannot compare {a} and {b}")
+    try:
+        if op == "=":
+            return a == b
+        if op == "!=":
+            return a != b
+        if op == "<":
+            return a < b
+        if op == ">":
+            return a > b
+        if op == "<=":
+            return a <= b
+        return a >= b
+    except TypeError:
+        raise _ExpressionError(f"Cannot compare {a} and {b}")
+
+
+def _arithmetic(op, a, b):
+    if not (_is_number(a) and _is_number(b)):
+        raise _ExpressionError(f"Cannot apply {op} to {a} and {b}")
+    a, b = _get_value(a), _get_value(b)
+    try:
+        if op == "+":
+            return _literal(a + b)
+        if op == "-":
+            return _literal(a - b)
+        if op == "*":
+            return _literal(a * b)
+        return _literal(float(a) / b)
+    except ZeroDivisionError:
+        raise _ExpressionError("Division by zero")
+
+
+def _order_key(term):
+    # Unbound, blank nodes, IRIs and literals, numbers by value
+    if term is None:
+        return (0, 0, "")
+    if term[0] == "bnode":
+        return (1, 0, term[1])
+    if term[0] == "uri":
+        return (2, 0, term[1])
+    if _is_number(term):
+        try:
+            return (3, 0, _get_value(term))
+        except _ExpressionError:
+            pass
+    if term[2] in TEMPORAL_TYPES:
+        value = _get_value(term)
+        if isinstance(value, datetime):
+            return (3, 1, value.replace(tzinfo=None))
+    return (3, 2, term[1])
+
+
+def _lang_matches(tag, language_range):
+    tag = tag.lower()
+    language_range = language_range.lower()
+    if language_range == "*":
+        return tag != ""
+    return tag == language_range or tag.startswith(language_range + "-")
+
+
+def _call(name, args):
+    if name == "isliteral":
+        return TRUE if args[0][0] == "literal" else FALSE
+    if name in ("isiri", "isuri"):
+        return TRUE if args[0][0] == "uri" else FALSE
+    if name == "isblank":
+        return TRUE if args[0][0] == "bnode" else FALSE
+    if name == "isnumeric":
+        return TRUE if _is_number(args[0]) else FALSE
+    if name == "lang":
+        if args[0][0] != "literal":
+            raise _ExpressionError("lang of a non literal")
+        return _literal(args[0][3] or "")
+    if name == "langmatches":
+        return TRUE if _lang_matches(args[0][1], args[1][1]) else FALSE
+    if name == "datatype":
+        term = args[0]
+        if term[0] != "literal":
+            raise _ExpressionError("datatype of a non literal")
+        if term[3]:
+            return ("uri", RDF + "langString")
+        return ("uri", term[2] or XSD + "string")
+    if name == "str":
+        if args[0][0] == "bnode":
+            raise _ExpressionError("str of a blank node")
+        return _literal(args[0][1])
+    if name == "lcase":
+        return ("literal", args[0][1].lower(), args[0][2], args[0][3])
+    if name == "ucase":
+        return ("literal", args[0][1].upper(), args[0][2], args[0][3])
+    if name == "strlen":
+        return _literal(len(args[0][1]))
+    if name == "contains":
+        return TRUE if args[1][1] in args[0][1] else FALSE
+    if name == "strstarts":
+        return TRUE if args[0][1].startswith(args[1][1]) else FALSE
+    if name == "strends":
+        return TRUE if args[0][1].endswith(args[1][1]) else FALSE
+    if name == "rand":
+        return _literal(random.random())
+    if name == "regex":
+        flags = re.IGNORECASE if len(args) > 2 and "i" in args[2][1] else 0
+        return TRUE if re.search(args[1][1], args[0][1], flags) else FALSE
+    raise ValueError(f"Unsupported function {name}")
+
+
+def _get_variables(expr):
+    kind = expr[0]
+    if kind == "var":
+        return {expr[1]}
+    if kind == "term":
+        return set()
+    if kind in ("call", "aggregate"):
+        args = expr[-1] if expr[-1] != "*" else []
+        return set().union(*[_get_variables(i) for i in args])
+    return set().union(*[_get_variables(i) for i in expr[1:] if isinstance(i, tuple)])
+
+
+def _has_aggregate(expr):
+    if expr[0] == "aggregate":
+        return True
+    if expr[0] in ("var", "term"):
+        return False
+    if expr[0] == "call":
+        return any(_has_aggregate(i) for i in expr[2])
+    return any(_has_aggregate(i) for i in expr[1:] if isinstance(i, tuple))
+
+
+class _Parser:
+    def __init__(self, query):
+        self.query = query
+        self.tokens = []
+        pos = 0
+        query = query.rstrip()
+        while pos < len(query):
+            match = TOKEN_PATTERN.match(query, pos)
+            if match is None or match.end() == pos:
+                raise ValueError(f"Invalid input at: {query[pos:pos + 20]}")
+            kind = match.lastgroup
+            self.tokens.append((kind, match.group(kind)))
+            pos = match.end()
+        self.pos = 0
+        self.prefixes = dict(DEFAULT_PREFIXES)
+        self.num_unnamed = 0
+
+    def _peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise ValueError("Unexpected end of query")
+        self.pos += 1
+        return token
+
+    def _is_keyword(self, keyword, offset=0):
+        kind, value = self._peek(offset)
+        return kind == "name" and value.upper() == keyword
+
+    def _accept_keyword(self, keyword):
+        if self._is_keyword(keyword):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect_keyword(self, keyword):
+        if not self._accept_keyword(keyword):
+            raise ValueError(f"Expected {keyword} at: {self._peek()[1]}")
+
+    def _is_symbol(self, symbol, offset=0):
+        return self._peek(offset) == ("symbol", symbol)
+
+    def _accept_symbol(self, symbol):
+        if self._is_symbol(symbol):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect_symbol(self, symbol):
+        if not self._accept_symbol(symbol):
+            raise ValueError(f"Expected {symbol} at: {self._peek()[1]}")
+
+    def _variable(self):
+        kind, value = self._next()
+        if kind != "var":
+            raise ValueError(f"Expected a variable at: {value}")
+        return value[1:]
+
+    def _iri(self, kind, value):
+        if kind == "iri":
+            return ("uri", value[1:-1])
+        prefix, local = value.split(":", 1)
+        if prefix not in self.prefixes:
+            raise ValueError(f"Unknown prefix {prefix}:")
+        return ("uri", self.prefixes[prefix] + local)
+
+    def parse(self):
+        while True:
+            if self._accept_keyword("PREFIX"):
+                kind, value = self._next()
+                if kind != "pname" or not value.endswith(":"):
+                    raise ValueError(f"Invalid prefix {value}")
+                self.prefixes[value[:-1]] = self._iri(*self._next())[1]
+            elif self._accept_keyword("BASE"):
+                self._next()
+            else:
+                break
+        query = self._select()
+        if self._peek()[0] is not None:
+            raise ValueError(f"Unexpected input: {self._peek()[1]}")
+        return query
+
+    def _select(self):
+        # SELECT query up to the end of the query or of the subquery
+        self._expect_keyword("SELECT")
+        query = {
+            "distinct": False,
+            "items": None,
+            "patterns": [],
+            "filters": [],
+            "unions": [],
+            "group_by": [],
+            "having": [],
+            "order_by": [],
+            "limit": None,
+            "offset": 0,
+        }
+        if self._accept_keyword("DISTINCT"):
+            query["distinct"] = True
+        else:
+            self._accept_keyword("REDUCED")
+        if self._accept_symbol("*"):
+            query["items"] = None
+        else:
+            query["items"] = self._select_items()
+
+        self._accept_keyword("WHERE")
+        self._expect_symbol("{")
+        self._group(query)
+
+        while self._peek()[0] is not None and not self._is_symbol("}"):
+            if self._is_keyword("GROUP"):
+                self.pos += 1
+                self._expect_keyword("BY")
+                while self._peek()[0] == "var" or self._is_symbol("("):
+                    query["group_by"].append(self._order_expression())
+            elif self._accept_keyword("HAVING"):
+                while self._is_symbol("(") or self._peek()[0] == "name":
+                    query["having"].append(self._constraint())
+                    if self._is_keyword("ORDER") or self._is_keyword("LIMIT"):
+                        break
+                    if self._is_keyword("OFFSET") or self._is_keyword("GROUP"):
+                        break
+            elif self._is_keyword("ORDER"):
+                self.pos += 1
+                self._expect_keyword("BY")
+                while True:
+                    if self._accept_keyword("DESC"):
+                        query["order_by"].append((self._bracketted(), True))
+                    elif self._accept_keyword("ASC"):
+                        query["order_by"].append((self._bracketted(), False))
+                    elif (
+                        self._peek()[0] == "var"
+                        or self._is_symbol("(")
+                        or (self._peek()[0] == "name" and self._is_symbol("(", 1))
+                    ):
+                        query["order_by"].append((self._order_expression(), False))
+                    else:
+                        break
+            elif self._accept_keyword("LIMIT"):
+                query["limit"] = int(self._next()[1])
+            elif self._accept_keyword("OFFSET"):
+                query["offset"] = int(self._next()[1])
+            else:
+                raise ValueError(f"Unexpected input: {self._peek()[1]}")
+        return query
+
+    def _select_items(self):
+        items = []
+        while True:
+            kind, value = self._peek()
+            if kind == "var":
+                self.pos += 1
+                items.append((value[1:], ("var", value[1:])))
+            elif kind == "symbol" and value == "(":
+                self.pos += 1
+                expr = self._expression()
+                self._expect_keyword("AS")
+                items.append((self._variable(), expr))
+                self._expect_symbol(")")
+            elif self._is_keyword("COUNT") and self._is_keyword("DISTINCT", 1):
+                # COUNT DISTINCT ?x, the legacy Virtuoso form the query writer uses
+                self.pos += 2
+                expr = ("aggregate", "count", True, [("var", self._variable())])
+                items.append((self._unnamed(), expr))
+            elif kind == "name" and value.upper() not in ("WHERE", "FROM"):
+                # Unnamed expression, named like Virtuoso does
+                items.append((self._unnamed(), self._primary()))
+            else:
+                break
+            # Virtuoso also accepts commas between the items
+            self._accept_symbol(",")
+        if not items:
+            raise ValueError("SELECT without variables")
+        return items
+
+    def _unnamed(self):
+        name = f"callret-{self.num_unnamed}"
+        self.num_unnamed += 1
+        return name
+
+    def _group(self, query):
+        while not self._accept_symbol("}"):
+            if self._accept_keyword("FILTER"):
+                query["filters"].append(self._constraint())
+            elif self._accept_symbol("."):
+                continue
+            elif self._is_symbol("{"):
+                query["unions"].append(self._union())
+            else:
+                self._triples(query["patterns"])
+
+    def _union(self):
+        # { SELECT ... } UNION { SELECT ... }, only subqueries are supported
+        subqueries = []
+        while True:
+            self._expect_symbol("{")
+            if not self._is_keyword("SELECT"):
+                raise ValueError("Only subqueries are supported in nested groups")
+            subqueries.append(self._select())
+            self._expect_symbol("}")
+            if not self._accept_keyword("UNION"):
+                return subqueries
+
+    def _triples(self, patterns):
+        subject = self._pattern_term()
+        while True:
+            predicate = self._pattern_term(predicate=True)
+            while True:
+                patterns.append((subject, predicate, self._pattern_term()))
+                if not self._accept_symbol(","):
+                    break
+            if not self._accept_symbol(";"):
+                break
+            if self._is_symbol(".") or self._is_symbol("}"):
+                break
+
+    def _pattern_term(self, predicate=False):
+        kind, value = self._peek()
+        if kind == "var":
+            self.pos += 1
+            return ("var", value[1:])
+        if predicate and kind == "name" and value == "a":
+            self.pos += 1
+            return ("term", RDF_TYPE)
+        return ("term", self._constant())
+
+    def _constant(self):
+        kind, value = self._next()
+        if kind in ("iri", "pname"):
+            return self._iri(kind, value)
+        if kind == "string":
+            lexical = _unescape(value[1:-1])
+            if self._peek()[0] == "langtag":
+                return ("literal", lexical, None, self._next()[1][1:].lower())
+            if self._accept_symbol("^^"):
+                return _typed_literal(lexical, self._iri(*self._next())[1], None)
+            return ("literal", lexical, None, None)
+        if kind == "number":
+            if "e" in value.lower():
+                return ("literal", value, XSD + "double", None)
+            if "." in value:
+                return ("literal", value, XSD + "decimal", None)
+            return ("literal", value, XSD + "integer", None)
+        if kind == "name" and value.lower() in ("true", "false"):
+            return TRUE if value.lower() == "true" else FALSE
+        raise ValueError(f"Unexpected token: {value}")
+
+    def _constraint(self):
+        if self._is_symbol("("):
+            return self._bracketted()
+        return self._primary()
+
+    def _bracketted(self):
+        self._expect_symbol("(")
+        expr = self._expression()
+        self._expect_symbol(")")
+        return expr
+
+    def _order_expression(self):
+        if self._peek()[0] == "var":
+            return ("var", self._variable())
+        if self._peek()[0] == "name":
+            # A function call, e.g. RAND()
+            return self._primary()
+        return self._bracketted()
+
+    def _expression(self):
+        expr = self._and_expression()
+        # OR and AND as keywords are Virtuoso extensions the grounder uses
+        while self._accept_symbol("||") or self._accept_keyword("OR"):
+            expr = ("or", expr, self._and_expression())
+        return expr
+
+    def _and_expression(self):
+        expr = self._relational()
+        while self._accept_symbol("&&") or self._accept_keyword("AND"):
+            expr = ("and", expr, self._relational())
+        return expr
+
+    def _relational(self):
+        expr = self._additive()
+        kind, value = self._peek()
+        if kind == "symbol" and value in ("=", "!=", "<", ">", "<=", ">="):
+            self.pos += 1
+            expr = ("compare", value, expr, self._additive())
+        return expr
+
+    def _additive(self):
+        expr = self._multiplicative()
+        while self._is_symbol("+") or self._is_symbol("-"):
+            op = self._next()[1]
+            expr = ("arithmetic", op, expr, self._multiplicative())
+        return expr
+
+    def _multiplicative(self):
+        expr = self._unary()
+        while self._is_symbol("*") or self._is_symbol("/"):
+            op = self._next()[1]
+            expr = ("arithmetic", op, expr, self._unary())
+        return expr
+
+    def _unary(self):
+        if self._accept_symbol("!"):
+            return ("not", self._unary())
+        if self._accept_symbol("-"):
+            return ("arithmetic", "-", ("term", _literal(0)), self._unary())
+        if self._accept_symbol("+"):
+            return self._unary()
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind == "symbol" and value == "(":
+            return self._bracketted()
+        if kind == "var":
+            self.pos += 1
+            return ("var", value[1:])
+        if kind == "name" and self._is_symbol("(", 1):
+            self.pos += 2
+            name = value.lower()
+            if name in AGGREGATES:
+                distinct = self._accept_keyword("DISTINCT")
+                if self._accept_symbol("*"):
+                    self._expect_symbol(")")
+                    return ("aggregate", name, distinct, "*")
+                args = [self._expression()]
+                self._expect_symbol(")")
+                return ("aggregate", name, distinct, args)
+            args = []
+            if not self._accept_symbol(")"):
+                args.append(self._expression())
+                while self._accept_symbol(","):
+                    args.append(self._expression())
+                self._expect_symbol(")")
+            if name == "bound":
+                return ("bound", args[0][1])
+            return ("call", name, args)
+        return ("term", self._constant())
+
+
+@lru_cache(maxsize=4096)
+def parse_query(query):
+    return _Parser(query).parse()
+
+
+def _evaluate(expr, row):
+    kind = expr[0]
+    if kind == "var":
+        if row.get(expr[1]) is None:
+            raise _ExpressionError(f"Unbound variable ?{expr[1]}")
+        return row[expr[1]]
+    if kind == "term":
+        return expr[1]
+    if kind == "or":
+        # An error on one side is ignored when the other side is true
+        error = None
+        for operand in expr[1:]:
+            try:
+                if _effective_boolean_value(_evaluate(operand, row)):
+                    return TRUE
+            except _ExpressionError as e:
+                error = e
+        if error is not None:
+            raise error
+        return FALSE
+    if kind == "and":
+        error = None
+        for operand in expr[1:]:
+            try:
+                if not _effective_boolean_value(_evaluate(operand, row)):
+                    return FALSE
+            except _ExpressionError as e:
+                error = e
+        if error is not None:
+            raise error
+        return TRUE
+    if kind == "not":
+        return FALSE if _effective_boolean_value(_evaluate(expr[1], row)) else TRUE
+    if kind == "compare":
+        a = _evaluate(expr[2], row)
+        b = _evaluate(expr[3], row)
+        return TRUE if _compare(expr[1], a, b) else FALSE
+    if kind == "arithmetic":
+        return _arithmetic(expr[1], _evaluate(expr[2], row), _evaluate(expr[3], row))
+    if kind == "bound":
+        return TRUE if row.get(expr[1]) is not None else FALSE
+    if kind == "call":
+        return _call(expr[1], [_evaluate(i, row) for i in expr[2]])
+    if kind == "aggregate":
+        raise ValueError("Aggregation outside of SELECT, HAVING or ORDER BY")
+    raise ValueError(f"Unknown expression {kind}")
+
+
+def _test(expr, row):
+    try:
+        return _effective_boolean_value(_evaluate(expr, row))
+    except _ExpressionError:
+        return False
+
+
+def _aggregate(expr, rows):
+    _, name, distinct, args = expr
+    if args == "*":
+        values = rows
+        if distinct:
+            values = {tuple(sorted(i.items())) for i in rows}
+        return _literal(len(values))
+    values = []
+    for row in rows:
+        try:
+            values.append(_evaluate(args[0], row))
+        except _ExpressionError:
+            continue
+    if distinct:
+        values = list(dict.fromkeys(values))
+    if name == "count":
+        return _literal(len(values))
+    if name == "sample":
+        if not values:
+            raise _ExpressionError("SAMPLE of no values")
+        return values[0]
+    if name in ("min", "max"):
+        if not values:
+            raise _ExpressionError(f"{name.upper()} of no values")
+        select = min if name == "min" else max
+        return select(values, key=_order_key)
+    if not all(_is_number(i) for i in values):
+        raise _ExpressionError(f"{name.upper()} of a non numeric value")
+    total = sum(_get_value(i) for i in values)
+    if name == "sum":
+        return _literal(total)
+    if not values:
+        return _literal(0)
+    return _literal(total / len(values))
+
+
+def _evaluate_group(expr, rows):
+    # The aggregations of the expression are computed over the rows of the group,
+    # then the rest of it is evaluated on the first row
+    def substitute(expr):
+        kind = expr[0]
+        if kind == "aggregate":
+            try:
+                return ("term", _aggregate(expr, rows))
+            except _ExpressionError:
+                return ("var", None)
+        if kind in ("var", "term", "bound"):
+            return expr
+        if kind == "call":
+            return ("call", expr[1], [substitute(i) for i in expr[2]])
+        return tuple(substitute(i) if isinstance(i, tuple) else i for i in expr)
+
+    return _evaluate(substitute(expr), rows[0] if rows else {})
+
+
+class TripleStore:
+    def __init__(self, triples, terms):
+        # triples is an (n, 3) array of term ids, terms the term of every id
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        triples = np.unique(np.asarray(triples, dtype=np.int64).reshape(-1, 3), axis=0)
+        self.num_triples = len(triples)
+        # Every index is three sorted columns, a triple pattern with some of its
+        # positions bound is a range of the index starting with those positions
+        self.indexes = {}
+        for name, columns in (
+            ("spo", (0, 1, 2)),
+            ("pos", (1, 2, 0)),
+            ("osp", (2, 0, 1)),
+        ):
+            order = np.lexsort(
+                (triples[:, columns[2]], triples[:, columns[1]], triples[:, columns[0]])
+            )
+            self.indexes[name] = (
+                columns,
+                [np.ascontiguousarray(triples[order, i]) for i in columns],
+            )
+
+    @classmethod
+    def load(cls, path):
+        # N-Triples, gzipped if the path ends with .gz
+        terms = []
+        term_ids = {}
+        triples = []
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as file:
+            for line_number, line in enumerate(file):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                match = NTRIPLES_LINE.match(line)
+                if match is None:
+                    raise ValueError(f"Invalid N-Triples at line {line_number + 1}")
+                for value in match.groups():
+                    term = _parse_ntriples_term(value)
+                    if term not in term_ids:
+                        term_ids[term] = len(terms)
+                        terms.append(term)
+                    triples.append(term_ids[term])
+        return cls(np.array(triples, dtype=np.int64), terms)
+
+    def close(self):
+        pass
+
+    def submit(self, fn, *args):
+        # Same interface as SPARQLClient.submit, the work runs right away
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _get_range(self, pattern):
+        # The index and range matching the bound positions of a (s, p, o) pattern
+        bound = tuple(i is not None for i in pattern)
+        if bound[0]:
+            name = "osp" if bound[2] and not bound[1] else "spo"
+        elif bound[1]:
+            name = "pos"
+        elif bound[2]:
+            name = "osp"
+        else:
+            name = "spo"
+        columns, index = self.indexes[name]
+        lo, hi = 0, self.num_triples
+        for position, column in zip(columns, index):
+            if pattern[position] is None:
+                break
+            values = column[lo:hi]
+            lo, hi = (
+                lo + int(np.searchsorted(values, pattern[position], "left")),
+                lo + int(np.searchsorted(values, pattern[position], "right")),
+            )
+        return columns, index, lo, hi
+
+    def _match(self, pattern):
+        # Bindings of the variables of a triple pattern, as columns of term ids
+        ids = []
+        for kind, value in pattern:
+            if kind == "term":
+                if value not in self.term_ids:
+                    return None
+                ids.append(self.term_ids[value])
+            else:
+                ids.append(None)
+        columns, index, lo, hi = self._get_range(ids)
+        values = [None, None, None]
+        for position, column in zip(columns, index):
+            values[position] = column[lo:hi]
+        bindings = {}
+        mask = None
+        for (kind, value), column in zip(pattern, values):
+            if kind != "var":
+                continue
+            if value in bindings:
+                equal = bindings[value] == column
+                mask = equal if mask is None else mask & equal
+            else:
+                bindings[value] = column
+        if mask is not None:
+            bindings = {k: v[mask] for k, v in bindings.items()}
+        return bindings
+
+    def _count(self, pattern):
+        ids = []
+        for kind, value in pattern:
+            if kind == "term":
+                if value not in self.term_ids:
+                    return 0
+                ids.append(self.term_ids[value])
+            else:
+                ids.append(None)
+        _, _, lo, hi = self._get_range(ids)
+        return hi - lo
+
+    def _join(self, table, size, bindings):
+        # Hash join on the shared variables, by sorting the new bindings and looking
+        # up the rows of the table with searchsorted
+        new_size = len(next(iter(bindings.values()))) if bindings else 1
+        shared = [i for i in bindings if i in table]
+        if not shared:
+            left = np.repeat(np.arange(size), new_size)
+            right = np.tile(np.arange(new_size), size)
+        else:
+            order = np.argsort(bindings[shared[0]], kind="stable")
+            keys = bindings[shared[0]][order]
+            lo = np.searchsorted(keys, table[shared[0]], "left")
+            hi = np.searchsorted(keys, table[shared[0]], "right")
+            counts = hi - lo
+            left = np.repeat(np.arange(size), counts)
+            offsets = np.arange(len(left)) - np.repeat(
+                np.cumsum(counts) - counts, counts
+            )
+            right = order[np.repeat(lo, counts) + offsets]
+            for var in shared[1:]:
+                mask = table[var][left] == bindings[var][right]
+                left, right = left[mask], right[mask]
+        joined = {k: v[left] for k, v in table.items()}
+        for k, v in bindings.items():
+            if k not in joined:
+                joined[k] = v[right]
+        return joined, len(left)
+
+    def _filter(self, expr, variables, table, size):
+        if len(variables) == 1:
+            # Evaluated once per distinct term
+            var = next(iter(variables))
+            values, inverse = np.unique(table[var], return_inverse=True)
+            keep = np.array(
+                [_test(expr, {var: self.terms[i]}) for i in values.tolist()],
+                dtype=bool,
+            )
+            mask = keep[inverse.reshape(-1)]
+        else:
+            names = list(variables)
+            columns = [table[i].tolist() for i in names]
+            mask = np.array(
+                [
+                    _test(expr, {k: self.terms[v] for k, v in zip(names, row)})
+                    for row in zip(*columns)
+                ],
+                dtype=bool,
+            )
+        return {k: v[mask] for k, v in table.items()}, int(mask.sum())
+
+    def _evaluate_where(self, query):
+        # Triple patterns joined from the most selective one, each one connected
+        # to the previous ones when possible. Filters run as soon as their variables
+        # are bound
+        patterns = list(query["patterns"])
+        filters = [(i, _get_variables(i)) for i in query["filters"]]
+        table = {}
+        size = 1
+        while patterns:
+            bound = set(table)
+            candidates = [
+                i
+                for i in patterns
+                if not bound or any(k == "var" and v in bound for k, v in i)
+            ] or patterns
+            pattern = min(candidates, key=self._count)
+            patterns.remove(pattern)
+            bindings = self._match(pattern)
+            if bindings is None:
+                return []
+            if not bindings:
+                # A pattern without variables only checks that the triple exists
+                if self._count(pattern) == 0:
+                    return []
+                continue
+            table, size = self._join(table, size, bindings)
+            for expr, variables in list(filters):
+                if variables and variables <= set(table):
+                    table, size = self._filter(expr, variables, table, size)
+                    filters.remove((expr, variables))
+            if size == 0:
+                return []
+
+        names = list(table)
+        columns = [table[i].tolist() for i in names]
+        if names:
+            rows = [
+                {k: self.terms[v] for k, v in zip(names, row)} for row in zip(*columns)
+            ]
+        else:
+            rows = [{} for _ in range(size)]
+        for subqueries in query["unions"]:
+            # Nested loop join with the solutions of the subqueries
+            solutions = []
+            for subquery in subqueries:
+                names, subquery_solutions = self._run(subquery)
+                for solution in subquery_solutions:
+                    solutions.append(
+                        {k: v for k, v in zip(names, solution) if v is not None}
+                    )
+            rows = [
+                {**row, **solution}
+                for row in rows
+                for solution in solutions
+                if all(row.get(k, v) == v for k, v in solution.items())
+            ]
+        for expr, _ in filters:
+            # Filters on variables the patterns do not bind
+            rows = [i for i in rows if _test(expr, i)]
+        return rows
+
+    def _aggregate_rows(self, query, rows):
+        items = query["items"]
+        keys = query["group_by"]
+        if not keys:
+            # No GROUP BY, like Virtuoso the rows are grouped by the selected
+            # expressions that are not aggregations
+            keys = [expr for _, expr in items if not _has_aggregate(expr)]
+        groups = {}
+        for row in rows:
+            key = []
+            for expr in keys:
+                try:
+                    key.append(_evaluate(expr, row))
+                except _ExpressionError:
+                    key.append(None)
+            groups.setdefault(tuple(key), []).append(row)
+        if not groups and not query["group_by"] and not keys:
+            groups[()] = []
+
+        output = []
+        for key, group_rows in groups.items():
+            if not all(_test_group(i, group_rows) for i in query["having"]):
+                continue
+            row = {}
+            for expr, value in zip(keys, key):
+                if expr[0] == "var" and value is not None:
+                    row[expr[1]] = value
+            for name, expr in items:
+                try:
+                    row[name] = _evaluate_group(expr, group_rows)
+                except _ExpressionError:
+                    row[name] = None
+            row["__group__"] = group_rows
+            output.append(row)
+        return output
+
+    def _order_rows(self, query, rows, aggregated):
+        for expr, descending in reversed(query["order_by"]):
+
+            def key(row):
+                try:
+                    if aggregated:
+                        return _order_key(_evaluate_group(expr, row["__group__"]))
+                    return _order_key(_evaluate(expr, row))
+                except _ExpressionError:
+                    return _order_key(None)
+
+            rows.sort(key=key, reverse=descending)
+        return rows
+
+    def run(self, query):
+        # Solutions of the query as a list of dicts from variable to term, and the
+        # selected variables
+        return self._run(parse_query(query))
+
+    def _run(self, query):
+        rows = self._evaluate_where(query)
+
+        items = query["items"]
+        if items is None:
+            names = []
+            for pattern in query["patterns"]:
+                for kind, value in pattern:
+                    if kind == "var" and value not in names:
+                        names.append(value)
+            for subqueries in query["unions"]:
+                for subquery in subqueries:
+                    for name, _ in subquery["items"] or []:
+                        if name not in names:
+                            names.append(name)
+            items = [(i, ("var", i)) for i in names]
+            query = dict(query, items=items)
+
+        aggregated = bool(query["group_by"]) or any(
+            _has_aggregate(expr) for _, expr in items
+        )
+        if aggregated:
+            rows = self._aggregate_rows(query, rows)
+        else:
+            for row in rows:
+                for name, expr in items:
+                    if expr[0] != "var" or expr[1] != name:
+                        try:
+                            row[name] = _evaluate(expr, row)
+                        except _ExpressionError:
+                            row[name] = None
+        if query["order_by"]:
+            rows = self._order_rows(query, rows, aggregated)
+
+        names = [name for name, _ in items]
+        solutions = []
+        seen = set()
+        for row in rows:
+            solution = tuple(row.get(i) for i in names)
+            if query["distinct"]:
+                if solution in seen:
+                    continue
+                seen.add(solution)
+            solutions.append(solution)
+        end = None if query["limit"] is None else query["offset"] + query["limit"]
+        return names, solutions[query["offset"] : end]
+
+    def query(self, query, timeout=None):
+        # Same answer as SPARQLClient.query, in the SPARQL JSON results format. The
+        # queries run in process, without timeout
+        names, solutions = self.run(query)
+        bindings = []
+        for solution in solutions:
+            binding = {}
+            for name, term in zip(names, solution):
+                if term is not None:
+                    binding[name] = _to_json(term)
+            bindings.append(binding)
+        return {"head": {"vars": names}, "results": {"bindings": bindings}}
+
+
+def _test_group(expr, rows):
+    try:
+        return _effective_boolean_value(_evaluate_group(expr, rows))
+    except _ExpressionError:
+        return False
+
+
+def _to_json(term):
+    if term[0] == "uri":
+        return {"type": "uri", "value": term[1]}
+    if term[0] == "bnode":
+        return {"type": "bnode", "value": term[1]}
+    if term[3]:
+        return {"type": "literal", "value": term[1], "xml:lang": term[3]}
+    if term[2]:
+        return {"type": "typed-literal", "datatype": term[2], "value": term[1]}
+    return {"type": "literal", "value": term[1]}